@@ -0,0 +1,185 @@
+"""
+Cache of serialized Variant and Relation data for API reads.
+
+Entries are stored in the 'api' cache (see CACHES in settings), keyed by
+object and by the site's base URL (serialized data contains absolute URLs).
+It must be shared by all processes, as writes only invalidate entries in the
+cache they can reach; without one configured, it's a dummy cache.
+
+Each object has a generation token in the cache, and entries record the token
+they were built under. Writes delete the tokens of the objects they change
+when their transaction commits, and a token is always read before the
+database is, so an entry built from data that was read before a write is
+never served after it.
+"""
+from collections import OrderedDict
+import hashlib
+import uuid
+
+from django.conf import settings
+from django.core.cache import caches
+from django.db import transaction
+
+CACHE_ALIAS = 'api'
+KEY_PREFIX = 'gennotes'
+STATS = ('hits', 'misses')
+
+
+# Backends that each process has its own copy of.
+PROCESS_LOCAL_BACKENDS = (
+    'django.core.cache.backends.dummy.DummyCache',
+    'django.core.cache.backends.locmem.LocMemCache',
+)
+
+
+def get_cache():
+    return caches[CACHE_ALIAS]
+
+
+def is_shared():
+    """
+    Return whether the cache is shared by all processes (e.g. memcached).
+    """
+    return (settings.CACHES[CACHE_ALIAS]['BACKEND'] not in
+            PROCESS_LOCAL_BACKENDS)
+
+
+def _object_key(model, pk):
+    return '{}:{}:{}'.format(KEY_PREFIX, model._meta.model_name, pk)
+
+
+def _generation_key(model, pk):
+    return _object_key(model, pk) + ':generation'
+
+
+def _hash(value):
+    return hashlib.md5(value.encode('utf-8')).hexdigest()
+
+
+def _entry_key(model, pk, base_url):
+    return '{}:{}'.format(_object_key(model, pk), _hash(base_url))
+
+
+def _b37_key(b37_id):
+    # Lookups are client input, so they're hashed to get a safe key.
+    return '{}:variant-b37:{}'.format(KEY_PREFIX, _hash(b37_id))
+
+
+def _stats_key(name):
+    return '{}:stats:{}'.format(KEY_PREFIX, name)
+
+
+def _count(name, number):
+    if not number:
+        return
+    cache = get_cache()
+    try:
+        cache.incr(_stats_key(name), number)
+    except ValueError:
+        if not cache.add(_stats_key(name), number):
+            cache.incr(_stats_key(name), number)
+
+
+def get_stats():
+    """
+    Return a dict of hit and miss counts since the last reset.
+    """
+    counts = get_cache().get_many([_stats_key(name) for name in STATS])
+    return OrderedDict((name, counts.get(_stats_key(name), 0))
+                       for name in STATS)
+
+
+def reset_stats():
+    get_cache().delete_many([_stats_key(name) for name in STATS])
+
+
+def get_entries(model, pks, base_url):
+    """
+    Return cached entries for objects, and generation tokens for the rest.
+
+    Returns a tuple of two dicts keyed by pk. The first has valid cached
+    entries: dicts with serialized 'data' and the 'versions' it's from. The
+    second has a generation token for each object not found, to be passed to
+    set_entries once its data is loaded and serialized.
+    """
+    cache = get_cache()
+    keys = OrderedDict((pk, (_generation_key(model, pk),
+                             _entry_key(model, pk, base_url))) for pk in pks)
+    cached = cache.get_many([key for pair in keys.values() for key in pair])
+
+    found, generations, new_generations = {}, {}, {}
+    for pk, (generation_key, entry_key) in keys.items():
+        generation = cached.get(generation_key)
+        entry = cached.get(entry_key)
+        if (generation is not None and entry is not None and
+                entry['generation'] == generation):
+            found[pk] = entry
+            continue
+        if generation is None:
+            # Overwriting a token set concurrently only invalidates entries.
+            generation = uuid.uuid4().hex
+            new_generations[generation_key] = generation
+        generations[pk] = generation
+    cache.set_many(new_generations)
+    _count('hits', len(found))
+    _count('misses', len(generations))
+    return found, generations
+
+
+def set_entries(model, entries, generations, base_url):
+    """
+    Cache entries, a dict of pk to (data, versions).
+
+    'generations' is the dict of tokens returned by get_entries.
+    """
+    get_cache().set_many({
+        _entry_key(model, pk, base_url): {
+            'generation': generations[pk],
+            'data': data,
+            'versions': versions,
+        } for pk, (data, versions) in entries.items()
+        if generations.get(pk) is not None})
+
+
+def get_variant_ids(b37_ids):
+    """
+    Return a dict mapping b37 IDs to the IDs of the Variants they refer to.
+
+    A Variant's build 37 position can't be changed, so these don't need
+    invalidation.
+    """
+    cached = get_cache().get_many([_b37_key(b37_id) for b37_id in b37_ids])
+    return {b37_id: cached[_b37_key(b37_id)] for b37_id in b37_ids
+            if _b37_key(b37_id) in cached}
+
+
+def set_variant_ids(variant_ids):
+    get_cache().set_many({_b37_key(b37_id): variant_id for
+                          b37_id, variant_id in variant_ids.items()})
+
+
+def invalidate_variant_ids(b37_ids):
+    """
+    Forget the Variants cached for b37 IDs, e.g. when they're deleted.
+
+    Entries are deleted straight away and again once the transaction commits,
+    as invalidate does.
+    """
+    keys = [_b37_key(b37_id) for b37_id in b37_ids]
+    if keys:
+        get_cache().delete_many(keys)
+        transaction.on_commit(lambda: get_cache().delete_many(keys))
+
+
+def invalidate(objects):
+    """
+    Invalidate cached data for a list of (model, pk).
+
+    Tokens are deleted straight away, so later reads in the writing
+    transaction don't see stale data, and again once it commits, as other
+    reads may have cached data from before the commit in between.
+    """
+    keys = [_generation_key(model, pk) for model, pk in objects]
+    if keys:
+        get_cache().delete_many(keys)
+        transaction.on_commit(lambda: get_cache().delete_many(keys))
@@ -0,0 +1,87 @@
+"""
+Cache of authorization data checked on every API write.
+
+Write requests check the user's email verification status and, for OAuth2,
+look up their access token. Both are cached in the 'api' cache so that in the
+steady state a bot submitting many edits costs no queries for authorization.
+Entries are deleted by the receivers in models.py when the EmailAddress,
+AccessToken or user they depend on is saved or deleted, which covers allauth
+email confirmation and token revocation.
+
+Those receivers only reach the cache of the process making the change, so
+nothing is cached unless the cache is shared by all processes. Otherwise a
+revoked token or removed email address could still authorize writes in other
+processes until their copies expired.
+"""
+import hashlib
+
+from django.db import transaction
+from django.utils import timezone
+
+from .api_cache import get_cache, is_shared, KEY_PREFIX
+
+
+def _email_verified_key(user_id):
+    return '{}:user:{}:email-verified'.format(KEY_PREFIX, user_id)
+
+
+def _token_key(token):
+    # Tokens are secrets, so they're hashed rather than stored in keys.
+    return '{}:token:{}'.format(
+        KEY_PREFIX, hashlib.sha256(token.encode('utf-8')).hexdigest())
+
+
+def get_email_verified(user_id):
+    """
+    Return the cached email verification status of a user, or None.
+    """
+    if not is_shared():
+        return None
+    return get_cache().get(_email_verified_key(user_id))
+
+
+def set_email_verified(user_id, verified):
+    if is_shared():
+        get_cache().set(_email_verified_key(user_id), verified)
+
+
+def _delete(keys):
+    # As in api_cache.invalidate: delete now and again once the change
+    # commits, in case another request cached old data in between.
+    if keys:
+        get_cache().delete_many(keys)
+        transaction.on_commit(lambda: get_cache().delete_many(keys))
+
+
+def invalidate_email_verified(user_id):
+    _delete([_email_verified_key(user_id)])
+
+
+def get_access_token(token):
+    """
+    Return a cached AccessToken, with its application and user, or None.
+    """
+    if not is_shared():
+        return None
+    return get_cache().get(_token_key(token))
+
+
+def set_access_token(access_token):
+    """
+    Cache an AccessToken, for no longer than it remains unexpired.
+    """
+    if not (is_shared() and access_token.expires):
+        return
+    cache = get_cache()
+    timeout = (access_token.expires - timezone.now()).total_seconds()
+    if cache.default_timeout is not None:
+        timeout = min(timeout, cache.default_timeout)
+    if timeout > 0:
+        cache.set(_token_key(access_token.token), access_token, timeout)
+
+
+def invalidate_access_tokens(tokens):
+    """
+    Invalidate cached AccessTokens, given a list of their token strings.
+    """
+    _delete([_token_key(token) for token in tokens])
@@ -0,0 +1,388 @@
+"""
+Data structures and helpers for the add_clinvar_data command.
+
+A full ClinVar release has hundreds of thousands of variants and RCV
+accessions, so the importer's indexes of them dominate its memory use. Each
+index here has a default implementation, matching how the importer has
+always kept them, and a compact one (the '--compact-index' option).
+"""
+from array import array
+from collections import deque
+import itertools
+import json
+import multiprocessing
+import re
+import resource
+import struct
+
+from django.db import connection
+
+from .models import Relation, Variant
+
+
+def peak_memory_mb():
+    """
+    Return this process's peak resident memory in megabytes.
+    """
+    # ru_maxrss is in kilobytes on Linux.
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024.0
+
+
+# A step in a FieldExtractor path: a child tag, with an optional attribute
+# value test, e.g. 'ElementValue[@Type="Preferred"]'.
+PATH_STEP_RE = re.compile(
+    r'^(?P<tag>[^\[\]/]+)(?:\[@(?P<attr>[^=\]]+)="(?P<value>[^"]*)"\])?$')
+
+
+class _PathNode(object):
+    __slots__ = ('children', 'fields')
+
+    def __init__(self):
+        # Map of tag to a list of (attribute, value, node), one per test.
+        self.children = {}
+        # Indexes of the fields whose path ends here.
+        self.fields = []
+
+
+class FieldExtractor(object):
+    """
+    Extract tag values from an XML element, in a single traversal.
+
+    'fields' is a list of (key, path, getter). Each path is a list of child
+    steps from the element, like an ElementTree path but limited to tags and
+    attribute tests: 'TraitSet/Trait/Name/ElementValue[@Type="Preferred"]'.
+
+    The paths are compiled into a tree when the extractor is made. Each
+    extraction then visits only the elements on some path, once, in document
+    order. Getters are called with the list of matches for their path, each
+    a list of the elements along it, and values that are empty or None are
+    left out. A field with a path of None has its getter called with no
+    matches.
+    """
+
+    def __init__(self, fields):
+        self.fields = fields
+        self.root = _PathNode()
+        for index, (key, path, getter) in enumerate(fields):
+            node = self.root
+            for step in (path.split('/') if path else []):
+                match = PATH_STEP_RE.match(step)
+                if not match:
+                    raise ValueError('Invalid path step: {}'.format(step))
+                tests = node.children.setdefault(match.group('tag'), [])
+                test = (match.group('attr'), match.group('value'))
+                for attr, value, child_node in tests:
+                    if (attr, value) == test:
+                        node = child_node
+                        break
+                else:
+                    child_node = _PathNode()
+                    tests.append(test + (child_node,))
+                    node = child_node
+            node.fields.append(index)
+
+    def _walk(self, element, node, path, matches):
+        for child in element:
+            for attr, value, child_node in node.children.get(child.tag, ()):
+                if attr is not None and child.get(attr) != value:
+                    continue
+                path.append(child)
+                for index in child_node.fields:
+                    matches[index].append(list(path))
+                if child_node.children:
+                    self._walk(child, child_node, path, matches)
+                path.pop()
+
+    def extract(self, element):
+        """
+        Return a dict of the non-empty field values for an element.
+        """
+        matches = [[] for _ in self.fields]
+        self._walk(element, self.root, [], matches)
+        values = {}
+        for (key, path, getter), field_matches in zip(self.fields, matches):
+            value = getter(field_matches)
+            if value:
+                values[key] = value
+        return values
+
+
+def first_text(matches):
+    """
+    FieldExtractor getter for the text of the first match.
+    """
+    return matches[0][-1].text if matches else None
+
+
+def first_attribute(name, level=-1):
+    """
+    Return a getter for an attribute of the first match.
+
+    'level' picks the element along the path, e.g. -2 for the parent of the
+    matched element.
+    """
+    def getter(matches):
+        return matches[0][level].get(name) if matches else None
+    return getter
+
+
+def first_findtext(path, level=-1):
+    """
+    Return a getter for findtext(path) on the first match.
+    """
+    def getter(matches):
+        return matches[0][level].findtext(path) if matches else None
+    return getter
+
+
+def update_relation_tags(relations):
+    """
+    Write the tags of saved Relations to the database with one UPDATE.
+    """
+    if not relations:
+        return
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'UPDATE {table} SET tags = new.tags '
+            'FROM unnest(%s::integer[], %s::jsonb[]) AS new(id, tags) '
+            'WHERE {table}.id = new.id'.format(
+                table=Relation._meta.db_table),
+            [[relation.id for relation in relations],
+             [json.dumps(relation.tags) for relation in relations]])
+
+
+def chunks(iterable, size):
+    """
+    Yield lists of up to 'size' items from an iterable.
+    """
+    iterator = iter(iterable)
+    while True:
+        chunk = list(itertools.islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def element_texts(lines, tag):
+    """
+    Yield the XML text of each 'tag' element, from an XML file's lines.
+
+    The elements mustn't be nested, and must start and end their lines, as
+    ClinVarSets do in ClinVar's XML releases. They're not parsed, so this is
+    much faster than iterparse.
+    """
+    start, end = '<' + tag, '</' + tag + '>'
+    element = None
+    for line in lines:
+        if element is None:
+            if not line.lstrip().startswith(start):
+                continue
+            element = []
+        element.append(line)
+        if end in line:
+            yield ''.join(element)
+            element = None
+
+
+def ordered_pool_map(function, iterable, workers):
+    """
+    Yield function(item) for each item, run by a pool of worker processes.
+
+    Results are yielded in the order of the items. At most two items per
+    worker are queued at a time, so the iterable isn't read ahead into
+    memory while results are being consumed.
+    """
+    pool = multiprocessing.Pool(workers)
+    try:
+        pending = deque()
+        for item in iterable:
+            pending.append(pool.apply_async(function, (item,)))
+            if len(pending) >= 2 * workers:
+                yield pending.popleft().get()
+        while pending:
+            yield pending.popleft().get()
+    finally:
+        pool.terminate()
+        pool.join()
+
+
+class VariantIndex(object):
+    """
+    Index Variants by build 37 key, a tuple of their four b37 tag values.
+
+    Handles for variants are their keys, and existing and new Variant
+    instances are kept in memory.
+    """
+
+    def __init__(self):
+        self.variants = {}
+        self.new = []
+
+    def load_existing(self):
+        self.variants.update(
+            ((v.tags['chrom_b37'], v.tags['pos_b37'],
+              v.tags['ref_allele_b37'], v.tags['var_allele_b37']), v)
+            for v in Variant.objects.filter(chrom_b37__isnull=False))
+
+    def __len__(self):
+        return len(self.variants)
+
+    def add(self, var_key):
+        """
+        Return the handle for a variant key, adding a new Variant if needed.
+        """
+        if var_key not in self.variants:
+            chrom, pos, ref_allele, var_allele = var_key
+            variant = Variant(tags={
+                'chrom_b37': chrom,
+                # Check pos is a valid int before adding.
+                'pos_b37': str(int(pos)),
+                'ref_allele_b37': ref_allele,
+                'var_allele_b37': var_allele})
+            self.variants[var_key] = variant
+            self.new.append(variant)
+        return var_key
+
+    def num_new(self):
+        return len(self.new)
+
+    def new_variant_chunks(self, chunk_size):
+        """
+        Yield lists of new, unsaved Variants. They must be saved in turn.
+        """
+        for i in range(0, len(self.new), chunk_size):
+            yield self.new[i:i + chunk_size]
+
+    def variant_id(self, handle):
+        return self.variants[handle].pk
+
+
+class CompactVariantIndex(object):
+    """
+    Index Variants by build 37 key, packed into a short string.
+
+    Existing variants are streamed from the typed b37 columns without
+    creating model instances, and handles are integers: the ID of an
+    existing Variant, or for a new one the negated position of its key in
+    'new' (Variant instances are only made as new variants are saved). This
+    takes around an order of magnitude less memory than VariantIndex.
+    """
+
+    def __init__(self):
+        self.variants = {}
+        self.new = []
+        self.new_ids = array('l')
+
+    @staticmethod
+    def _pack(chrom, pos, ref_allele, var_allele):
+        # Alleles can't contain tabs, so this is unambiguous.
+        return (struct.pack('<HI', int(chrom), int(pos)) +
+                str(ref_allele) + '\t' + str(var_allele))
+
+    @staticmethod
+    def _unpack(key):
+        chrom, pos = struct.unpack('<HI', key[:6])
+        ref_allele, var_allele = key[6:].split('\t')
+        return str(chrom), str(pos), ref_allele, var_allele
+
+    def load_existing(self):
+        for chrom, pos, ref_allele, var_allele, variant_id in (
+                Variant.objects.filter(chrom_b37__isnull=False).values_list(
+                    'chrom_b37', 'pos_b37', 'ref_allele_b37',
+                    'var_allele_b37', 'id').iterator()):
+            self.variants[self._pack(
+                chrom, pos, ref_allele, var_allele)] = variant_id
+
+    def __len__(self):
+        return len(self.variants)
+
+    def add(self, var_key):
+        key = self._pack(*var_key)
+        handle = self.variants.get(key)
+        if handle is None:
+            self.new.append(key)
+            handle = self.variants[key] = -len(self.new)
+        return handle
+
+    def num_new(self):
+        return len(self.new)
+
+    def new_variant_chunks(self, chunk_size):
+        """
+        Yield lists of new, unsaved Variants. They must be saved in turn.
+
+        Their IDs are recorded once each list has been saved.
+        """
+        for i in range(0, len(self.new), chunk_size):
+            variants = []
+            for key in self.new[i:i + chunk_size]:
+                chrom, pos, ref_allele, var_allele = self._unpack(key)
+                variants.append(Variant(tags={
+                    'chrom_b37': chrom,
+                    'pos_b37': pos,
+                    'ref_allele_b37': ref_allele,
+                    'var_allele_b37': var_allele}))
+            yield variants
+            self.new_ids.extend(variant.pk for variant in variants)
+
+    def variant_id(self, handle):
+        if handle > 0:
+            return handle
+        return self.new_ids[-handle - 1]
+
+
+class AccessionIndex(object):
+    """
+    Map RCV accessions to the handles of the variants they're reported for.
+    """
+
+    def __init__(self):
+        self.accessions = {}
+
+    def add(self, rcv_acc, handle):
+        self.accessions.setdefault(rcv_acc, set()).add(handle)
+
+    def __contains__(self, rcv_acc):
+        return rcv_acc in self.accessions
+
+    def unique_handle(self, rcv_acc):
+        """
+        Return the handle of an accession's variant, or None if not unique.
+        """
+        handles = self.accessions[rcv_acc]
+        if len(handles) != 1:
+            return None
+        return next(iter(handles))
+
+
+class CompactAccessionIndex(object):
+    """
+    Map RCV accessions to integer variant handles, without sets or strings.
+
+    Accessions like 'RCV000116253' are stored as their number, and an
+    accession reported for more than one variant maps to AMBIGUOUS.
+    """
+    AMBIGUOUS = 0
+
+    def __init__(self):
+        self.accessions = {}
+
+    @staticmethod
+    def _key(rcv_acc):
+        if rcv_acc.startswith('RCV') and rcv_acc[3:].isdigit():
+            return int(rcv_acc[3:])
+        return rcv_acc
+
+    def add(self, rcv_acc, handle):
+        key = self._key(rcv_acc)
+        if self.accessions.setdefault(key, handle) != handle:
+            self.accessions[key] = self.AMBIGUOUS
+
+    def __contains__(self, rcv_acc):
+        return self._key(rcv_acc) in self.accessions
+
+    def unique_handle(self, rcv_acc):
+        handle = self.accessions[self._key(rcv_acc)]
+        if handle == self.AMBIGUOUS:
+            return None
+        return handle
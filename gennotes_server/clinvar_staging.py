@@ -0,0 +1,248 @@
+"""
+Staging tables for the add_clinvar_data command's '--staging' mode.
+
+Parsed VCF alleles and XML RCVA records are streamed into unlogged tables
+with COPY. New Variants and Relations, and changed Relations, are then found
+and written with set-based SQL against the Variant and Relation tables, so
+nothing is indexed or compared in Python. Each write takes a limit, so an
+import can write and record its changes in batches, a transaction each.
+"""
+import json
+
+from django.db import connection
+
+ALLELES_TABLE = 'clinvar_staging_allele'
+RCVAS_TABLE = 'clinvar_staging_rcva'
+
+CREATE_SQL = """
+CREATE UNLOGGED TABLE clinvar_staging_allele (
+    seq serial PRIMARY KEY,
+    chrom smallint NOT NULL,
+    pos integer NOT NULL,
+    ref_allele text NOT NULL,
+    var_allele text NOT NULL,
+    accessions text[] NOT NULL
+);
+CREATE UNLOGGED TABLE clinvar_staging_rcva (
+    seq serial PRIMARY KEY,
+    accession text NOT NULL,
+    tags jsonb NOT NULL
+)
+"""
+
+# Variants for staged alleles that aren't in the Variant table yet, added in
+# order of first appearance in the VCF, up to a limit.
+INSERT_VARIANTS_SQL = """
+INSERT INTO gennotes_server_variant
+    (id, tags, chrom_b37, pos_b37, ref_allele_b37, var_allele_b37)
+SELECT nextval(pg_get_serial_sequence('gennotes_server_variant', 'id')),
+       hstore(ARRAY['chrom_b37', 'pos_b37', 'ref_allele_b37',
+                    'var_allele_b37'],
+              ARRAY[chrom::text, pos::text, ref_allele, var_allele]),
+       chrom, pos, ref_allele, var_allele
+FROM (
+    SELECT DISTINCT ON (chrom, pos, ref_allele, var_allele) *
+    FROM clinvar_staging_allele allele
+    WHERE NOT EXISTS (
+        SELECT 1 FROM gennotes_server_variant variant
+        WHERE variant.chrom_b37 = allele.chrom
+          AND variant.pos_b37 = allele.pos
+          AND variant.ref_allele_b37 = allele.ref_allele
+          AND variant.var_allele_b37 = allele.var_allele)
+    ORDER BY chrom, pos, ref_allele, var_allele, seq
+) new
+ORDER BY seq
+LIMIT %s
+RETURNING id
+"""
+
+# Staged RCVA records for accessions reported for exactly one Variant in the
+# VCF, with that Variant's ID. If an accession's in the XML more than once,
+# its first record is used.
+STAGED_RECORDS_SQL = """
+WITH accession_variant AS (
+    SELECT accession, min(variant.id) AS variant_id
+    FROM (SELECT unnest(accessions) AS accession, chrom, pos, ref_allele,
+                 var_allele
+          FROM clinvar_staging_allele) allele
+    JOIN gennotes_server_variant variant
+      ON variant.chrom_b37 = allele.chrom
+     AND variant.pos_b37 = allele.pos
+     AND variant.ref_allele_b37 = allele.ref_allele
+     AND variant.var_allele_b37 = allele.var_allele
+    GROUP BY accession
+    HAVING count(DISTINCT variant.id) = 1
+), record AS (
+    SELECT DISTINCT ON (rcva.accession) rcva.seq, rcva.accession,
+           rcva.tags, accession_variant.variant_id
+    FROM clinvar_staging_rcva rcva
+    JOIN accession_variant USING (accession)
+    ORDER BY rcva.accession, rcva.seq
+)
+"""
+
+RELATION_MATCHES_SQL = """
+relation.tags @> json_build_object(
+    'type', 'clinvar-rcva',
+    'clinvar-rcva:accession', record.accession)::jsonb
+"""
+
+INSERT_RELATIONS_SQL = STAGED_RECORDS_SQL + """
+INSERT INTO gennotes_server_relation (id, variant_id, tags)
+SELECT nextval(pg_get_serial_sequence('gennotes_server_relation', 'id')),
+       variant_id, tags
+FROM (
+    SELECT record.* FROM record
+    WHERE NOT EXISTS (
+        SELECT 1 FROM gennotes_server_relation relation
+        WHERE {matches})
+    ORDER BY seq
+    LIMIT %s
+) new
+RETURNING id
+""".format(matches=RELATION_MATCHES_SQL)
+
+# A Relation has changed if any RCVA tag differs, treating missing tags as
+# empty (as the command's _hash_xml_dict does). Its tags are updated with the
+# record's, keeping any others. Changed Relations are updated in ID order,
+# after a given ID and up to a limit. (A Relation can still differ once
+# updated, if it has a tag the record lacks, so batches go by ID rather than
+# by what's left to change.)
+UPDATE_RELATIONS_SQL = STAGED_RECORDS_SQL + """, changed AS (
+    SELECT relation.id, record.tags
+    FROM gennotes_server_relation relation
+    JOIN record ON {matches}
+    WHERE relation.id > %s
+      AND EXISTS (
+          SELECT 1 FROM unnest(%s::text[]) AS key
+          WHERE coalesce(relation.tags ->> key, '') <>
+                coalesce(record.tags ->> key, ''))
+    ORDER BY relation.id
+    LIMIT %s
+)
+UPDATE gennotes_server_relation relation
+SET tags = (
+    SELECT json_object_agg(key, value) FROM (
+        SELECT key, value FROM jsonb_each(relation.tags)
+        WHERE NOT changed.tags ? key
+        UNION ALL
+        SELECT key, value FROM jsonb_each(changed.tags)) merged)::jsonb
+FROM changed
+WHERE relation.id = changed.id
+RETURNING relation.id
+""".format(matches=RELATION_MATCHES_SQL)
+
+
+def _copy_value(value):
+    if value is None:
+        return r'\N'
+    if isinstance(value, (list, tuple)):
+        value = u'{' + u','.join(
+            u'"' + item.replace(u'\\', u'\\\\').replace(u'"', u'\\"') + u'"'
+            for item in value) + u'}'
+    elif not isinstance(value, basestring):
+        value = unicode(value)
+    return (value.replace(u'\\', u'\\\\').replace(u'\t', u'\\t')
+            .replace(u'\n', u'\\n').replace(u'\r', u'\\r'))
+
+
+class CopyStream(object):
+    """
+    A file-like object reading rows as COPY text format, for copy_expert.
+
+    Rows are formatted as they're read, so they're never all in memory.
+    Values may be strings, numbers, lists of strings (as arrays) or None.
+    """
+
+    def __init__(self, rows):
+        self.lines = (
+            (u'\t'.join(_copy_value(value) for value in row) +
+             u'\n').encode('utf-8')
+            for row in rows)
+        self.buffer = ''
+
+    def read(self, size=-1):
+        chunks = [self.buffer]
+        length = len(self.buffer)
+        for line in self.lines:
+            chunks.append(line)
+            length += len(line)
+            if 0 <= size <= length:
+                break
+        data = ''.join(chunks)
+        if size < 0:
+            self.buffer = ''
+            return data
+        self.buffer = data[size:]
+        return data[:size]
+
+
+def _copy(table, columns, rows):
+    with connection.cursor() as cursor:
+        cursor.copy_expert(
+            'COPY {} ({}) FROM STDIN'.format(table, ', '.join(columns)),
+            CopyStream(rows))
+
+
+def _returned_ids(sql, params=None):
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return sorted(row[0] for row in cursor.fetchall())
+
+
+def create_staging_tables():
+    """
+    Create empty staging tables, dropping any left by an earlier import.
+    """
+    drop_staging_tables()
+    with connection.cursor() as cursor:
+        cursor.execute(CREATE_SQL)
+
+
+def drop_staging_tables():
+    with connection.cursor() as cursor:
+        cursor.execute('DROP TABLE IF EXISTS {}, {}'.format(
+            ALLELES_TABLE, RCVAS_TABLE))
+
+
+def copy_alleles(alleles):
+    """
+    Stage VCF alleles, an iterable of (b37 key, list of RCV accessions).
+    """
+    _copy(ALLELES_TABLE,
+          ('chrom', 'pos', 'ref_allele', 'var_allele', 'accessions'),
+          (tuple(var_key) + (rcv_accs,) for var_key, rcv_accs in alleles))
+
+
+def copy_rcvas(records):
+    """
+    Stage XML RCVA records, an iterable of (accession, tags dict).
+    """
+    _copy(RCVAS_TABLE, ('accession', 'tags'),
+          ((rcv_acc, json.dumps(tags)) for rcv_acc, tags in records))
+
+
+def insert_new_variants(limit=None):
+    """
+    Add Variants for up to 'limit' new staged alleles, and return their IDs.
+    """
+    return _returned_ids(INSERT_VARIANTS_SQL, [limit])
+
+
+def insert_new_relations(limit=None):
+    """
+    Add Relations for up to 'limit' new staged RCVA records, and return their
+    IDs.
+    """
+    return _returned_ids(INSERT_RELATIONS_SQL, [limit])
+
+
+def update_changed_relations(tag_keys, after=0, limit=None):
+    """
+    Update Relations whose staged record differs in any of 'tag_keys'.
+
+    Up to 'limit' Relations with IDs after 'after' are updated, in ID order.
+    Returns their IDs.
+    """
+    return _returned_ids(UPDATE_RELATIONS_SQL,
+                         [after, list(tag_keys), limit])
@@ -0,0 +1,253 @@
+"""
+Push revision events to subscribers, using Postgres LISTEN/NOTIFY.
+
+Each committed revision sends a notification with its ID on CHANNEL (see the
+post_revision_commit receiver in models.py). Postgres only delivers it once
+the writing transaction commits, and not at all if it rolls back.
+
+In each process a single RevisionBroker thread listens on its own database
+connection, reads each notified revision's changes with one query, and puts
+the events on its subscribers' queues. An idle subscriber costs a queue and
+a blocked worker thread (see the gthread workers in the Procfile), not a
+database connection or any polling. Each process takes at most
+EVENT_STREAMS_PER_PROCESS subscribers, leaving its other threads for API
+requests. Streams that fall behind, or whose listener fails, are ended;
+clients reconnect with Last-Event-ID and catch up.
+"""
+from collections import OrderedDict
+import json
+import Queue
+import select
+import threading
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Max
+from reversion.models import Revision
+
+from .history import changes_since
+
+CHANNEL = 'gennotes_revisions'
+# Seconds between keep-alive comments on idle streams, and between checks
+# of whether the broker still has subscribers.
+HEARTBEAT_SECONDS = 15
+# Revisions with more changes than this (e.g. imports) are sent as a single
+# 'revision' event, pointing at the change feed, rather than per change.
+EVENT_MAX_CHANGES = 1000
+# Events queued for a subscriber before it's dropped as too slow.
+SUBSCRIBER_QUEUE_SIZE = 1000
+EVENT_FIELDS = ('revision', 'date', 'user', 'comment', 'type', 'id',
+                'version', 'action', 'variant')
+
+
+def notify_revision(revision_id):
+    """
+    Notify listeners of a revision, once the current transaction commits.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_notify(%s, %s)', [CHANNEL, str(revision_id)])
+
+
+def revision_events(since, until):
+    """
+    Return a list of (event type, data) for revisions from 'since' to 'until'.
+
+    There's a 'change' event for each change, unless there are more than
+    EVENT_MAX_CHANGES; then there's a single 'revision' event with the range
+    of revisions, for subscribers to read from the change feed.
+    """
+    changes = changes_since(since, until=until, limit=EVENT_MAX_CHANGES + 1)
+    if len(changes) > EVENT_MAX_CHANGES:
+        return [('revision', OrderedDict([
+            ('revision', until),
+            ('since', since),
+            ('truncated', True),
+        ]))]
+    return [('change', OrderedDict((field, change[field])
+                                   for field in EVENT_FIELDS
+                                   if field in change))
+            for change in changes]
+
+
+def format_event(event_type, data):
+    """
+    Format an event for a text/event-stream response.
+
+    The revision ID is the event ID, so reconnecting clients send it back as
+    Last-Event-ID and get the changes they missed.
+    """
+    return 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+        data['revision'], event_type,
+        json.dumps(data, default=lambda value: value.isoformat()))
+
+
+class Subscriber(object):
+    """
+    A bounded queue of (event type, data) for one stream.
+
+    Once closed, no more events are queued, and the stream ends after the
+    queued ones.
+    """
+
+    def __init__(self):
+        self.queue = Queue.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.closed = False
+
+    def put(self, event):
+        """
+        Queue an event, returning False if the queue's full.
+        """
+        try:
+            self.queue.put_nowait(event)
+        except Queue.Full:
+            return False
+        return True
+
+    def close(self):
+        self.closed = True
+        # Wakes a waiting stream, unless the queue's full.
+        self.put(None)
+
+
+class RevisionBroker(object):
+    """
+    Listen for revision notifications and fan their events out to queues.
+
+    The listening thread starts with the first subscriber and stops, closing
+    its connection, once there are none. If it fails, its subscribers are
+    closed, and the next subscriber starts a new one. Subscribers whose
+    queues fill up are closed and dropped.
+
+    'streams' counts subscribers until they unsubscribe, including closed
+    ones whose streams are still ending, as each holds a worker thread.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.subscribers = set()
+        self.streams = 0
+        self.thread = None
+
+    def subscribe(self):
+        """
+        Return a new Subscriber that receives events for revisions.
+
+        Returns None if the process already has EVENT_STREAMS_PER_PROCESS
+        subscribers. Each Subscriber must be passed to unsubscribe when its
+        stream ends.
+        """
+        subscriber = Subscriber()
+        with self.lock:
+            if self.streams >= settings.EVENT_STREAMS_PER_PROCESS:
+                return None
+            self.streams += 1
+            self.subscribers.add(subscriber)
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._listen)
+                self.thread.daemon = True
+                self.thread.start()
+        return subscriber
+
+    def unsubscribe(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+            self.streams -= 1
+
+    def _drop(self, subscriber):
+        with self.lock:
+            self.subscribers.discard(subscriber)
+        subscriber.close()
+
+    def _publish(self, revision_ids):
+        for revision_id in sorted(revision_ids):
+            events = revision_events(revision_id - 1, revision_id)
+            with self.lock:
+                subscribers = list(self.subscribers)
+            for subscriber in subscribers:
+                if not all(subscriber.put(event) for event in events):
+                    self._drop(subscriber)
+
+    def _listen(self):
+        # Database connections are per thread, so this one is the thread's
+        # own. It's in autocommit mode, so notifications arrive as they're
+        # sent and reads see the notified revisions.
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute('LISTEN {}'.format(CHANNEL))
+            pg_connection = connection.connection
+            while True:
+                with self.lock:
+                    if not self.subscribers:
+                        self.thread = None
+                        return
+                if not select.select([pg_connection], [], [],
+                                     HEARTBEAT_SECONDS)[0]:
+                    continue
+                pg_connection.poll()
+                revision_ids = set()
+                while pg_connection.notifies:
+                    revision_ids.add(int(pg_connection.notifies.pop().payload))
+                self._publish(revision_ids)
+        finally:
+            with self.lock:
+                # Still set only if the listener failed. Its subscribers
+                # would get no more events, so end their streams.
+                if self.thread is threading.current_thread():
+                    self.thread = None
+                    subscribers = list(self.subscribers)
+                    self.subscribers.clear()
+                else:
+                    subscribers = []
+            for subscriber in subscribers:
+                subscriber.close()
+            connection.close()
+
+
+broker = RevisionBroker()
+
+
+def event_stream(subscriber, last_event_id=None):
+    """
+    Yield a text/event-stream of a subscriber's revision events.
+
+    If 'last_event_id' (a revision ID) is given, events for revisions since
+    then are sent first. Live events are then sent from the broker, with a
+    keep-alive comment every HEARTBEAT_SECONDS while idle, until the broker
+    closes the subscriber. It's unsubscribed when the stream ends.
+    """
+    # IDs of the revisions sent while catching up, so they aren't sent again
+    # by the broker.
+    sent = set()
+    try:
+        # The subscriber gets revisions committed from now on, so catching
+        # up from here on misses none.
+        if last_event_id is not None:
+            until = (Revision.objects.aggregate(Max('id'))['id__max'] or
+                     last_event_id)
+            events = revision_events(last_event_id, until)
+            if events and events[0][0] == 'revision':
+                sent.update(Revision.objects.filter(
+                    id__gt=last_event_id, id__lte=until).values_list(
+                        'id', flat=True))
+            else:
+                sent.update(data['revision'] for _, data in events)
+            for event in events:
+                yield format_event(*event)
+            # Don't hold a connection while idle.
+            connection.close()
+        yield ': connected\n\n'
+        while True:
+            try:
+                event = subscriber.queue.get(timeout=HEARTBEAT_SECONDS)
+            except Queue.Empty:
+                if subscriber.closed:
+                    return
+                yield ': keep-alive\n\n'
+                continue
+            if event is None:
+                return
+            event_type, data = event
+            if data['revision'] not in sent:
+                yield format_event(event_type, data)
+    finally:
+        broker.unsubscribe(subscriber)
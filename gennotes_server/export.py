@@ -0,0 +1,79 @@
+"""
+Export Variants, with their Relations, as newline-delimited JSON.
+"""
+from collections import OrderedDict
+import json
+
+from django.db.models import Prefetch
+
+from .models import Relation, Variant
+from .serializers import VariantSerializer
+from .versions import latest_version_ids
+
+EXPORT_CHUNK_SIZE = 1000
+
+
+def export_variants(chrom=None, relation_type=None,
+                    chunk_size=EXPORT_CHUNK_SIZE):
+    """
+    Yield a dict for each Variant and its Relations, in order of ID.
+
+    Variants are fetched in chunks, each seeking past the last ID of the
+    previous chunk (as KeysetCursorPagination does), with their Relations
+    prefetched. Memory use doesn't grow with the number of variants, and no
+    transaction or cursor is held open while the caller consumes them.
+    Objects saved without a current_version pointer get their latest
+    Version's ID, looked up with one query per chunk for each model.
+
+    'chrom' restricts the export to a chromosome index (e.g. 23 for X).
+    'relation_type' restricts it to variants with Relations of that type,
+    and only those Relations are included.
+    """
+    variants = Variant.objects.order_by('id')
+    relations = Relation.objects.order_by('id')
+    if chrom is not None:
+        variants = variants.filter(chrom_b37=chrom)
+    if relation_type is not None:
+        relations = relations.filter(tags__contains={'type': relation_type})
+        variants = variants.filter(id__in=relations.values('variant_id'))
+    variants = variants.prefetch_related(
+        Prefetch('relation_set', queryset=relations))
+
+    last_id = 0
+    while True:
+        chunk = list(variants.filter(id__gt=last_id)[:chunk_size])
+        chunk_relations = [relation for variant in chunk
+                           for relation in variant.relation_set.all()]
+        unversioned = {
+            model: latest_version_ids(model, [
+                obj.id for obj in objects if obj.current_version_id is None])
+            for model, objects in [(Variant, chunk),
+                                   (Relation, chunk_relations)]}
+
+        def version_id(obj):
+            return (obj.current_version_id or
+                    unversioned[obj.__class__].get(obj.id, None))
+
+        for variant in chunk:
+            yield OrderedDict([
+                ('id', variant.id),
+                ('b37_id', VariantSerializer.get_b37_id(variant)),
+                ('current_version', version_id(variant)),
+                ('tags', variant.tags),
+                ('relation_set', [OrderedDict([
+                    ('id', relation.id),
+                    ('current_version', version_id(relation)),
+                    ('tags', relation.tags),
+                ]) for relation in variant.relation_set.all()]),
+            ])
+        if len(chunk) < chunk_size:
+            return
+        last_id = chunk[-1].id
+
+
+def export_lines(**kwargs):
+    """
+    Yield export_variants data as lines of JSON.
+    """
+    for variant in export_variants(**kwargs):
+        yield json.dumps(variant) + '\n'
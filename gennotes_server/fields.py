@@ -0,0 +1,39 @@
+from rest_framework import serializers
+
+
+class TemplatedHyperlinkMixin(object):
+    """
+    Build hyperlinks from a URL template reversed once, not once per object.
+
+    A field instance is shared by every object serialized with 'many=True',
+    so the URL for a placeholder pk is reversed on first use and later
+    objects' URLs are made by substituting their pk.
+    """
+    pk_placeholder = 'pk-placeholder'
+
+    def get_url(self, obj, view_name, request, format):
+        if hasattr(obj, 'pk') and obj.pk in (None, ''):
+            return None
+        if self.lookup_field != 'pk':
+            return super(TemplatedHyperlinkMixin, self).get_url(
+                obj, view_name, request, format)
+
+        url_templates = self.__dict__.setdefault('_url_templates', {})
+        if (view_name, format) not in url_templates:
+            url = self.reverse(
+                view_name, kwargs={self.lookup_url_kwarg: self.pk_placeholder},
+                request=request, format=format)
+            url_templates[(view_name, format)] = url.rsplit(
+                self.pk_placeholder, 1)
+        prefix, suffix = url_templates[(view_name, format)]
+        return prefix + str(obj.pk) + suffix
+
+
+class TemplatedHyperlinkedRelatedField(TemplatedHyperlinkMixin,
+                                       serializers.HyperlinkedRelatedField):
+    pass
+
+
+class TemplatedHyperlinkedIdentityField(TemplatedHyperlinkMixin,
+                                        serializers.HyperlinkedIdentityField):
+    pass
@@ -0,0 +1,252 @@
+"""
+Read the edit history of Variants and Relations from django-reversion data.
+
+Queries here join Version to Revision in SQL and extract tags from each
+Version's serialized data in the database, rather than loading and
+deserializing Versions in Python.
+"""
+from collections import OrderedDict
+
+from django.contrib.auth import get_user_model
+from django.contrib.contenttypes.models import ContentType
+from django.db import connection
+
+from reversion.models import Revision, Version
+
+from .models import CommitDeletion, Relation, Variant
+
+# A Version's tags as jsonb. Versions store tags serialized as a JSON string
+# (hstore, and older Relation versions) or as an object (jsonb).
+VERSION_TAGS_SQL = """
+    CASE jsonb_typeof(
+        version.serialized_data::jsonb -> 0 -> 'fields' -> 'tags')
+    WHEN 'string' THEN
+        (version.serialized_data::jsonb -> 0 -> 'fields' ->> 'tags')::jsonb
+    ELSE version.serialized_data::jsonb -> 0 -> 'fields' -> 'tags'
+    END
+"""
+
+# Largest ID of an integer primary key.
+MAX_ID = 2 ** 31 - 1
+
+# The Variant ID in a Relation Version's serialized data. Migration 0010
+# indexes this expression, to find the Relations a Variant had at a time.
+VERSION_VARIANT_SQL = (
+    "(version.serialized_data::jsonb -> 0 -> 'fields' ->> 'variant')::integer")
+
+HISTORY_SQL = """
+    SELECT history.*,
+        (SELECT json_object_agg(key, value) FROM jsonb_each(tags)
+         WHERE previous_tags IS NULL OR NOT previous_tags ? key) AS added,
+        (SELECT json_object_agg(
+            key, json_build_array(previous_tags -> key, value))
+         FROM jsonb_each(tags)
+         WHERE previous_tags ? key AND (previous_tags -> key) <> value
+         ) AS changed,
+        (SELECT json_object_agg(key, value) FROM jsonb_each(previous_tags)
+         WHERE NOT tags ? key) AS removed
+    FROM (
+        SELECT version.id, version.revision_id, revision.date_created,
+            revision.comment, account.username,
+            deletion.id IS NOT NULL AS deleted,
+            {tags} AS tags,
+            lag({tags}) OVER (ORDER BY version.id) AS previous_tags
+        FROM {version} version
+        JOIN {revision} revision ON revision.id = version.revision_id
+        LEFT JOIN {user} account ON account.id = revision.user_id
+        LEFT JOIN {deletion} deletion ON deletion.revision_id = revision.id
+        WHERE version.content_type_id = %s AND version.object_id_int = %s
+    ) history
+    WHERE history.id > %s
+    ORDER BY history.id
+    LIMIT %s
+"""
+
+
+def version_history(model, object_id, after=None, limit=None):
+    """
+    Return a list of an object's Versions, oldest first, with tag diffs.
+
+    Each is a dict with the version and revision IDs, the revision's date,
+    username and comment, whether it recorded a deletion, and 'tags_diff':
+    tags 'added' and 'removed' by the version (with their values), and tags
+    'changed' (with a list of their old and new values). Versions start after
+    the version ID 'after', if given, and are limited to 'limit'.
+    """
+    content_type = ContentType.objects.get_for_model(model)
+    sql = HISTORY_SQL.format(
+        tags=VERSION_TAGS_SQL,
+        version=Version._meta.db_table,
+        revision=Revision._meta.db_table,
+        user=get_user_model()._meta.db_table,
+        deletion=CommitDeletion._meta.db_table)
+    with connection.cursor() as cursor:
+        # 'LIMIT NULL' is no limit.
+        cursor.execute(sql, [content_type.id, object_id, after or 0, limit])
+        columns = [column[0] for column in cursor.description]
+        rows = [dict(zip(columns, row)) for row in cursor.fetchall()]
+    return [OrderedDict([
+        ('id', row['id']),
+        ('revision', row['revision_id']),
+        ('date', row['date_created']),
+        ('user', row['username']),
+        ('comment', row['comment']),
+        ('deleted', row['deleted']),
+        ('tags_diff', OrderedDict([
+            ('added', row['added'] or {}),
+            ('changed', row['changed'] or {}),
+            ('removed', row['removed'] or {}),
+        ])),
+    ]) for row in rows]
+
+
+AS_OF_SQL = """
+    SELECT DISTINCT ON (version.object_id_int)
+        version.object_id_int, version.id, {tags} AS tags,
+        {variant} AS variant_id, deletion.id IS NOT NULL AS deleted
+    FROM {version} version
+    JOIN {revision} revision ON revision.id = version.revision_id
+    LEFT JOIN {deletion} deletion ON deletion.revision_id = revision.id
+    WHERE version.content_type_id = %s AND {lookup} = ANY(%s)
+        AND revision.date_created <= %s
+    ORDER BY version.object_id_int, version.id DESC
+"""
+
+
+def _versions_as_of(model, lookup, ids, when):
+    """
+    Return the latest Version, as of 'when', of objects matched by 'lookup'.
+
+    Returns a list of (object ID, version ID, tags, variant ID) tuples.
+    Objects created after 'when', or deleted by then, are left out.
+    """
+    if not ids:
+        return []
+    content_type = ContentType.objects.get_for_model(model)
+    sql = AS_OF_SQL.format(
+        tags=VERSION_TAGS_SQL,
+        variant=VERSION_VARIANT_SQL,
+        lookup=lookup,
+        version=Version._meta.db_table,
+        revision=Revision._meta.db_table,
+        deletion=CommitDeletion._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [content_type.id, list(ids), when])
+        return [row[:4] for row in cursor.fetchall() if not row[4]]
+
+
+def _set_relation_set(variant, relations):
+    # As prefetch_related does, so 'variant.relation_set.all()' returns these
+    # Relations without a query.
+    queryset = variant.relation_set.all()
+    queryset._result_cache = relations
+    queryset._prefetch_done = True
+    cache_name = Relation._meta.get_field('variant').related_query_name()
+    variant._prefetched_objects_cache = {cache_name: queryset}
+
+
+def objects_as_of(model, object_ids, when):
+    """
+    Return a dict of Variants or Relations, by ID, as they were at 'when'.
+
+    The objects are unsaved instances built from the Version of each that
+    was current at 'when', with that Version as their current_version.
+    Variants have their relation_set as of 'when' too, including Relations
+    since deleted. Objects that didn't exist at 'when' are left out.
+
+    This is one query for the objects, and one for Variants' Relations.
+    """
+    objects = {}
+    for object_id, version_id, tags, variant_id in _versions_as_of(
+            model, 'version.object_id_int', object_ids, when):
+        objects[object_id] = model(id=object_id, tags=tags,
+                                   current_version_id=version_id)
+        if model is Relation:
+            objects[object_id].variant_id = variant_id
+
+    if model is Variant:
+        relation_sets = {variant_id: [] for variant_id in objects}
+        for relation_id, version_id, tags, variant_id in _versions_as_of(
+                Relation, VERSION_VARIANT_SQL, objects.keys(), when):
+            relation_sets[variant_id].append(Relation(
+                id=relation_id, variant_id=variant_id, tags=tags,
+                current_version_id=version_id))
+        for variant_id, relations in relation_sets.items():
+            _set_relation_set(objects[variant_id],
+                              sorted(relations, key=lambda r: r.id))
+    return objects
+
+
+CHANGES_SQL = """
+    SELECT version.revision_id, version.id, version.content_type_id,
+        version.object_id_int, revision.date_created, account.username,
+        revision.comment, deletion.id IS NOT NULL AS deleted,
+        NOT EXISTS (
+            SELECT 1 FROM {version} previous
+            WHERE previous.content_type_id = version.content_type_id
+                AND previous.object_id_int = version.object_id_int
+                AND previous.id < version.id) AS created,
+        {tags} AS tags, {variant} AS variant_id
+    FROM {version} version
+    JOIN {revision} revision ON revision.id = version.revision_id
+    LEFT JOIN {user} account ON account.id = revision.user_id
+    LEFT JOIN {deletion} deletion ON deletion.revision_id = revision.id
+    WHERE version.content_type_id = ANY(%s)
+        AND version.revision_id > %s AND version.revision_id <= %s
+        AND (version.revision_id, version.id) > (%s, %s)
+    ORDER BY version.revision_id, version.id
+    LIMIT %s
+"""
+
+
+def changes_since(since, after=None, limit=None, until=MAX_ID):
+    """
+    Return Variant and Relation changes in revisions after 'since', in order.
+
+    Each change is a dict of the revision's ID, date, username and comment,
+    the object's type ('variant' or 'relation') and ID, the ID of the Version
+    recording the change, the 'action' ('created', 'updated' or 'deleted'),
+    and the tags (and, for Relations, the Variant ID) the change left it
+    with.
+
+    Changes are ordered by revision and version ID, and may be limited to
+    revisions up to 'until'. 'after', a (revision ID, version ID) pair,
+    starts them after that change instead. The composite index from
+    migration 0011 makes each call cost time proportional to the number of
+    changes returned, however many Versions there are.
+    """
+    content_types = ContentType.objects.get_for_models(Variant, Relation)
+    models_by_id = {content_type.id: model
+                    for model, content_type in content_types.items()}
+    sql = CHANGES_SQL.format(
+        tags=VERSION_TAGS_SQL,
+        variant=VERSION_VARIANT_SQL,
+        version=Version._meta.db_table,
+        revision=Revision._meta.db_table,
+        user=get_user_model()._meta.db_table,
+        deletion=CommitDeletion._meta.db_table)
+    with connection.cursor() as cursor:
+        cursor.execute(sql, [list(models_by_id.keys()), since, until] +
+                       list(after or (0, 0)) + [limit])
+        rows = cursor.fetchall()
+
+    changes = []
+    for (revision_id, version_id, content_type_id, object_id, date,
+         username, comment, deleted, created, tags, variant_id) in rows:
+        model = models_by_id[content_type_id]
+        change = OrderedDict([
+            ('revision', revision_id),
+            ('date', date),
+            ('user', username),
+            ('comment', comment),
+            ('type', model._meta.model_name),
+            ('id', object_id),
+            ('version', version_id),
+            ('action', 'deleted' if deleted else
+                       'created' if created else 'updated'),
+            ('tags', tags),
+        ])
+        if model is Relation:
+            change['variant'] = variant_id
+        changes.append(change)
+    return changes
@@ -1,4 +1,5 @@
 import codecs
+from collections import OrderedDict
 import fileinput
 from ftplib import FTP
 import gzip
@@ -14,11 +15,22 @@ import tempfile
 from django.contrib.auth import get_user_model
 from django.core.management.base import BaseCommand, CommandError
 from django.db import transaction
-import reversion
+from reversion import revisions as reversion
 from vcf2clinvar.clinvar import ClinVarVCFLine
 
-from gennotes_server.models import Variant, Relation
+from gennotes_server import clinvar_staging
+from gennotes_server.clinvar_import import (AccessionIndex,
+                                            CompactAccessionIndex,
+                                            CompactVariantIndex,
+                                            FieldExtractor, VariantIndex,
+                                            chunks, element_texts,
+                                            first_attribute, first_findtext,
+                                            first_text, ordered_pool_map,
+                                            peak_memory_mb,
+                                            update_relation_tags)
+from gennotes_server.models import Relation, Variant, reserve_ids
 from gennotes_server.utils import map_chrom_to_index
+from gennotes_server.versions import save_revision_bulk
 
 try:
     # faster implementation using bindings to libxml
@@ -35,6 +47,9 @@ CV_XML_REGEX = r'^ClinVarFullRelease_[0-9]{4}-[0-9]{2}.xml.gz$'
 
 SPLITTER = re.compile('[,|]')
 
+# ClinVarSets sent to each worker process at a time, with '--workers'.
+XML_BATCH_SIZE = 500
+
 # Keep track of tags used for ReferenceClinVarAssertion data. Tags are keys.
 # Values are tuples of (variable-type, function); during parsing the function
 # is applied to that variable type to retrieve corresponding data from the XML.
@@ -84,6 +99,48 @@ RCVA_DATA = {
             'ElementValue[@Type="Preferred"]')),
     }
 
+# The same tags, as FieldExtractor fields for a ClinVarSet element. These are
+# what's imported; the functions in RCVA_DATA are kept as a reference (see
+# the benchmark_rcva_extraction command).
+RCVA_PATH = 'ReferenceClinVarAssertion/'
+RCVA_TRAIT_NAME_PATH = (
+    RCVA_PATH + 'TraitSet/Trait/Name/ElementValue[@Type="Preferred"]')
+RCVA_GENE_PATH = (RCVA_PATH + 'MeasureSet/Measure/MeasureRelationship'
+                  '[@Type="variant in gene"]')
+RCVA_FIELDS = [
+    ('type', None, lambda matches: 'clinvar-rcva'),
+    ('clinvar-rcva:accession', RCVA_PATH + 'ClinVarAccession',
+     first_attribute('Acc')),
+    ('clinvar-rcva:version', RCVA_PATH + 'ClinVarAccession',
+     first_attribute('Version')),
+    ('clinvar-rcva:trait-name', RCVA_TRAIT_NAME_PATH, first_text),
+    # The Type of the Trait the preferred name is in.
+    ('clinvar-rcva:trait-type', RCVA_TRAIT_NAME_PATH,
+     first_attribute('Type', level=-3)),
+    ('clinvar-rcva:significance',
+     RCVA_PATH + 'ClinicalSignificance/Description', first_text),
+    ('clinvar-rcva:num-submissions', 'ClinVarAssertion',
+     lambda matches: str(len(matches))),
+    ('clinvar-rcva:record-status', RCVA_PATH + 'RecordStatus', first_text),
+    ('clinvar-rcva:gene-name', RCVA_GENE_PATH,
+     first_findtext('Name/ElementValue')),
+    ('clinvar-rcva:gene-symbol', RCVA_GENE_PATH,
+     first_findtext('Symbol/ElementValue')),
+    ('clinvar-rcva:citations',
+     RCVA_PATH + 'MeasureSet/Measure/Citation/ID[@Source="PubMed"]',
+     lambda matches: ';'.join(['PMID%s' % match[-1].text
+                               for match in matches])),
+    # The allele frequency is in the AttributeSet with the ESP XRef.
+    ('clinvar-rcva:esp-allele-frequency',
+     RCVA_PATH + 'MeasureSet/Measure/AttributeSet/XRef'
+     '[@DB="NHLBI GO Exome Sequencing Project (ESP)"]',
+     first_findtext('Attribute[@Type="AlleleFrequency"]', level=-2)),
+    ('clinvar-rcva:preferred-name',
+     RCVA_PATH + 'MeasureSet[@Type="Variant"]/Measure/Name/'
+     'ElementValue[@Type="Preferred"]', first_text),
+]
+RCVA_EXTRACTOR = FieldExtractor(RCVA_FIELDS)
+
 
 class Command(BaseCommand):
     help = 'Download latest ClinVar VCF, import variants not already in db.'
@@ -97,7 +154,31 @@ class Command(BaseCommand):
                     help='Open local ClinVar XML file'),
         make_option('-n', '--num-vars',
                     dest='max_num',
-                    help="Maximum number of variants to store in db.")
+                    help="Maximum number of variants to store in db."),
+        make_option('--compact-index',
+                    action='store_true',
+                    dest='compact_index',
+                    default=False,
+                    help='Index variants and RCV accessions compactly, '
+                         'using much less memory for a full import.'),
+        make_option('--bulk',
+                    action='store_true',
+                    dest='bulk',
+                    default=False,
+                    help='Insert new objects and their versions in bulk, '
+                         'a query per thousand rather than two per object.'),
+        make_option('--staging',
+                    action='store_true',
+                    dest='staging',
+                    default=False,
+                    help='Copy parsed data to staging tables, and find new '
+                         'and changed records there with SQL.'),
+        make_option('-w', '--workers',
+                    dest='workers',
+                    type='int',
+                    default=1,
+                    help='Number of processes to parse the ClinVar XML '
+                         'with (default 1).'),
         )
 
     def _hash_xml_dict(self, d):
@@ -160,57 +241,69 @@ class Command(BaseCommand):
     @transaction.atomic()
     @reversion.create_revision()
     def _save_as_revision(self, object_list, user, comment):
+        # Committing the revision also invalidates API cache entries for the
+        # saved objects (see models.update_current_versions).
+        reversion.set_user(user=user)
+        reversion.set_comment(comment=comment)
         for object in object_list:
             object.save()
-            reversion.set_user(user=user)
-            reversion.set_comment(comment=comment)
-
-    def handle(self, local_vcf=None, local_xml=None, max_num=None, *args, **options):
-        # The clinvar_user will be recorded as the editor by reversion.
-        logging.basicConfig(level=logging.INFO,
-                            format='%(asctime)s - %(message)s')
-        clinvar_user = get_user_model().objects.get(
-            username='clinvar-data-importer')
-
-        # Store objects that need to be saved (created or updated) to db.
-        # These are saved in a separate function so they're represented as
-        # different Revisions (sets of changes) in django-reversion.
-        variants_new = []
-        relations_new = []
-        relations_updated = []
-
-        # Load ClinVar VCF.
-        logging.info('Loading ClinVar VCF file...')
-        if not (local_vcf and local_xml):
-            tempdir = tempfile.mkdtemp()
-            logging.info('Created tempdir {}'.format(tempdir))
-        if local_vcf:
-            cv_fp, vcf_filename = local_vcf, os.path.split(local_vcf)[-1]
-        else:
-            cv_fp, vcf_filename = self._download_latest_clinvar(tempdir)
-        logging.info('Loaded Clinvar VCF, stored at {}'.format(cv_fp))
 
-        logging.info('Caching existing variants with build 37 lookup info.')
-        variant_map = {(
-            v.tags['chrom-b37'],
-            v.tags['pos-b37'],
-            v.tags['ref-allele-b37'],
-            v.tags['var-allele-b37']): v for v in Variant.objects.all() if
-            'chrom-b37' in v.tags and
-            'pos-b37' in v.tags and
-            'ref-allele-b37' in v.tags and
-            'var-allele-b37' in v.tags}
-
-        # Dict to track ClinVar RCV records in VCF and corresponding Variants.
-        # Key: RCV accession number. Value: set of tuples of values for Variant
-        # tags: ('chrom-b37', 'pos-b37', 'ref-allele-b37', 'var-allele-b37')
-        rcv_map = {}
-
-        logging.info('Done caching variants. Reading VCF.')
-        clinvar_vcf = self._open(cv_fp)
+    @transaction.atomic()
+    def _bulk_save_as_revision(self, object_list, user, comment):
+        # New objects get IDs reserved from their sequence, so they can be
+        # inserted with bulk_create and still be recorded by reversion. The
+        # Revision is the same as _save_as_revision's, with its Versions
+        # inserted in bulk too.
+        new = [object for object in object_list if object.pk is None]
+        for object in object_list:
+            if object.pk is not None:
+                object.save()
+        for object, pk in zip(new, reserve_ids(type(object_list[0]),
+                                               len(new))):
+            object.pk = pk
+            if isinstance(object, Variant):
+                object.sync_b37_fields()
+        if new:
+            type(new[0]).objects.bulk_create(new, batch_size=1000)
+        save_revision_bulk(object_list, user=user, comment=comment)
 
-        # Add Variants if they have ClinVar data. Variants are initially added
-        # only with the build 37 position information from the VCF.
+    @transaction.atomic()
+    def _update_relations(self, updates, user, comment):
+        # 'updates' is a list of (Relation ID, tags to update). The Relations
+        # are fetched with one query and written back with one UPDATE, then
+        # recorded as a revision as _save_as_revision would.
+        relations = Relation.objects.in_bulk(
+            [rel_id for rel_id, _ in updates])
+        for rel_id, val_store in updates:
+            relations[rel_id].tags.update(val_store)
+        relations = [relations[rel_id] for rel_id, _ in updates]
+        update_relation_tags(relations)
+        save_revision_bulk(relations, user=user, comment=comment)
+
+    def _save_staged(self, model, write, user, comment):
+        # 'write(after, limit)' inserts or updates up to 'limit' rows from
+        # the staging tables, returning their IDs; 'after' is the largest ID
+        # it's returned so far. Each batch of 10k or less is written and
+        # recorded as a revision in its own transaction, as in the other
+        # modes, so other edits only wait for one batch to commit (see
+        # models.lock_revision_commits).
+        after = 0
+        while True:
+            with transaction.atomic():
+                ids = write(after, 10000)
+                if not ids:
+                    break
+                save_revision_bulk(
+                    list(model.objects.filter(id__in=ids).order_by('id')),
+                    user=user, comment=comment)
+            logging.info('Wrote and recorded {} {} objects.'.format(
+                len(ids), model.__name__))
+            after = max(ids)
+
+    def _read_vcf(self, clinvar_vcf, max_num=None):
+        """
+        Yield (build 37 key, RCV accessions) for each ClinVar VCF allele.
+        """
         num_vars = 0
         for line in clinvar_vcf:
             if line.startswith('#'):
@@ -236,55 +329,93 @@ class Command(BaseCommand):
                          if len(v) == 2}
 
             for allele in info_dict['CLNALLE'].split(','):
-                # Check if we already have this Variant. If not, add it.
                 var_allele = all_alleles[int(allele)]
-                var_key = (chrom, pos, ref_allele, var_allele)
-                if var_key not in variant_map:
-                    # logging.info('Inserting new Variant'
-                    #               '{}, {}, {}, {}'.format(*var_key))
-                    variant = Variant(tags={
-                        'chrom-b37': chrom,
-                        # Check pos is a valid int before adding.
-                        'pos-b37': str(int(pos)),
-                        'ref-allele-b37': ref_allele,
-                        'var-allele-b37': var_allele})
-                    variants_new.append(variant)
-                    variant_map[var_key] = variant
-
-                # Keep track of RCV Assertion IDs we encounter, we'll add later
+                rcv_accs = []
                 for record in cvvl['alleles'][int(allele)].get('records', []):
                     rcv_acc, _ = record['acc'].split('.')
-                    rcv_map.setdefault(
-                        rcv_acc, set()).add(var_key)
-
-        # Close VCF, save new variants to db bundled revisions of 10k or less.
-        clinvar_vcf.close()
-        logging.info('VCF closed. Now adding {} new variants to db.'.format(
-            len(variants_new)))
-        for i in range(1 + int(len(variants_new) / 10000)):
-            variants_subset = variants_new[i * 10000: (i + 1) * 10000]
-            if len(variants_subset) == 0:
-                break
-            logging.info('Adding {} through {} to db...'.format(
-                1 + i * 10000, i * 10000 + len(variants_subset)))
-            self._save_as_revision(
-                object_list=variants_subset,
-                user=clinvar_user,
-                comment='Variant added based on presence in ClinVar ' +
-                        'VCF file: {}'.format(vcf_filename))
+                    rcv_accs.append(rcv_acc)
+                yield (chrom, pos, ref_allele, var_allele), rcv_accs
+
+    def _rcva_tags(self, ele):
+        """
+        Return tags for a ClinVarSet's RCVA, using RCVA_EXTRACTOR.
+        """
+        return RCVA_EXTRACTOR.extract(ele)
+
+    def _lambda_rcva_tags(self, ele):
+        """
+        Return tags for a ClinVarSet's RCVA, using the functions in RCVA_DATA.
+        """
+        rcva = ele.find('ReferenceClinVarAssertion')
+        val_store = dict()
+        for rcva_key in RCVA_DATA:
+            variable_type = RCVA_DATA[rcva_key][0]
+            try:
+                if not variable_type:
+                    value = RCVA_DATA[rcva_key][1]()
+                elif variable_type == 'ele':
+                    value = RCVA_DATA[rcva_key][1](ele)
+                elif variable_type == 'rcva':
+                    value = RCVA_DATA[rcva_key][1](rcva)
+            except AttributeError:
+                # Some retrieval functions are chained and the parent elem
+                # isn't present. In that case, the data doesn't exist.
+                value = None
+            if value:
+                val_store[rcva_key] = value
+        return val_store
+
+    def _parse_clinvar_set(self, ele, wanted=None):
+        """
+        Return (RCV accession, tags, hash) for a ClinVarSet element.
+
+        Returns None if 'wanted' is given and returns False for the accession.
+        """
+        # Retrieve Reference ClinVar Assertion (RCVA) data.
+        # Each RCV Assertion is intended to represent a single phenotype,
+        # and may contain multiple Submitter ClinVar Assertions.
+        # Each Variant may have multiple associated RCVA accessions.
+        # Discrepencies in phenotype labeling by SCVAs can lead to multiple
+        # RCVAs which should theoretically be merged.
+        rcva = ele.find('ReferenceClinVarAssertion')
+        rcv_acc = rcva.find('ClinVarAccession').get('Acc')
+        if wanted is not None and not wanted(rcv_acc):
+            return None
+        val_store = self._rcva_tags(ele)
+        return rcv_acc, val_store, self._hash_xml_dict(val_store)
+
+    def _read_xml(self, clinvar_xml, wanted=None, workers=1):
+        """
+        Yield (RCV accession, tags, hash) for each ClinVarSet in the XML.
+
+        If 'wanted' is given, ClinVarSets whose accession it returns False for
+        are skipped. With more than one worker, ClinVarSets are parsed in
+        batches by a pool of processes, and yielded in the same order.
+        """
+        if workers > 1:
+            batches = chunks(element_texts(clinvar_xml, 'ClinVarSet'),
+                             XML_BATCH_SIZE)
+            for records in ordered_pool_map(_parse_clinvar_sets, batches,
+                                            workers):
+                for record in records:
+                    if wanted is None or wanted(record[0]):
+                        yield record
+            return
 
-        # print 'Multiple variants for single RCV Assertion ID:'
-        # for k, v in rcv_map.iteritems():
-        #     if len(v) > 1:
-        #         print '\t', k[0], v
+        for ele in self._get_elements(clinvar_xml, 'ClinVarSet'):
+            record = self._parse_clinvar_set(ele, wanted)
+            if record is not None:
+                yield record
 
-        # Load ClinVar XML file.
-        logging.info('Loading latest ClinVar XML...')
-        if local_xml:
-            cv_fp, xml_filename = local_xml, os.path.split(local_xml)[-1]
-        else:
-            cv_fp, xml_filename = self._download_latest_clinvar_xml(tempdir)
-        logging.info('Loaded latest Clinvar XML, stored at {}'.format(cv_fp))
+    def _import_xml(self, clinvar_xml, xml_filename, clinvar_user,
+                    variant_index, rcv_index, save_as_revision, workers):
+        # Store objects that need to be saved (created or updated) to db.
+        # These are saved in a separate function so they're represented as
+        # different Revisions (sets of changes) in django-reversion.
+        relations_new = []
+        # Tag updates for changed Relations, by ID. The Relations are fetched
+        # and written in batches once the XML has been read.
+        relation_updates = OrderedDict()
 
         logging.info('Caching existing clinvar-rcva Relations by accession')
         rcv_hash_cache = {
@@ -293,52 +424,22 @@ class Command(BaseCommand):
             rel in Relation.objects.filter(
                 **{'tags__type': RCVA_DATA['type'][1]()})}
 
-        logging.info('Reading XML, parsing each ClinVarSet')
-        clinvar_xml = self._open(cv_fp)
-
-        for ele in self._get_elements(clinvar_xml, 'ClinVarSet'):
-            # Retrieve Reference ClinVar Assertion (RCVA) data.
-            # Each RCV Assertion is intended to represent a single phenotype,
-            # and may contain multiple Submitter ClinVar Assertions.
-            # Each Variant may have multiple associated RCVA accessions.
-            # Discrepencies in phenotype labeling by SCVAs can lead to multiple
-            # RCVAs which should theoretically be merged.
-            rcva = ele.find('ReferenceClinVarAssertion')
-            rcv_acc = rcva.find('ClinVarAccession').get('Acc')
-
-            if rcv_acc not in rcv_map:
-                # We do not have a record of this RCV from VCF, skip parsing...
-                continue
-
-            if len(rcv_map[rcv_acc]) != 1:
-                # either no or too many variations for this RCV
-                continue
+        def wanted(rcv_acc):
+            # Skip RCVs we have no record of from the VCF, and those with no
+            # or too many variations.
+            return (rcv_acc in rcv_index and
+                    rcv_index.unique_handle(rcv_acc) is not None)
 
-            # Use the functions in RCVA_DATA to retrieve data for tags.
-            val_store = dict()
-            for rcva_key in RCVA_DATA:
-                variable_type = RCVA_DATA[rcva_key][0]
-                try:
-                    if not variable_type:
-                        value = RCVA_DATA[rcva_key][1]()
-                    elif variable_type == 'ele':
-                        value = RCVA_DATA[rcva_key][1](ele)
-                    elif variable_type == 'rcva':
-                        value = RCVA_DATA[rcva_key][1](rcva)
-                except AttributeError:
-                    # Some retrieval functions are chained and the parent elem
-                    # isn't present. In that case, the data doesn't exist.
-                    value = None
-                if value:
-                    val_store[rcva_key] = value
-
-            # Get the hash of this data.
-            xml_hash = self._hash_xml_dict(val_store)
+        logging.info('Reading XML, parsing each ClinVarSet')
+        for rcv_acc, val_store, xml_hash in self._read_xml(
+                clinvar_xml, wanted, workers):
+            variant_handle = rcv_index.unique_handle(rcv_acc)
 
             if rcv_acc not in rcv_hash_cache:
                 # We got a brand new record
-                rel = Relation(variant=variant_map[list(rcv_map[rcv_acc])[0]],
-                               tags=val_store)
+                rel = Relation(
+                    variant_id=variant_index.variant_id(variant_handle),
+                    tags=val_store)
                 relations_new.append(rel)
                 rcv_hash_cache[rcv_acc] = (rel.pk, xml_hash)
 
@@ -347,10 +448,12 @@ class Command(BaseCommand):
                 # logging.info('Added new RCVA, accession: {}, {}'.format(
                 #              rcv_acc, str(val_store)))
             elif rcv_hash_cache[rcv_acc][1] != xml_hash:
-                # XML parameters have changed, update required
-                rel = Relation.objects.get(id=rcv_hash_cache[rcv_acc][0])
-                rel.tags.update(val_store)
-                relations_updated.append(rel)
+                # XML parameters have changed, update required. (A repeated
+                # accession that's new in this file has no ID yet, and keeps
+                # its first record.)
+                rel_id = rcv_hash_cache[rcv_acc][0]
+                if rel_id is not None:
+                    relation_updates.setdefault(rel_id, {}).update(val_store)
                 # logging.info('Need to update accession {} with: {}'.format(
                 #     rcv_acc, str(val_store)))
             else:
@@ -367,26 +470,163 @@ class Command(BaseCommand):
                 break
             logging.info('Adding {} through {} to db...'.format(
                 1 + i * 10000, i * 10000 + len(relations_subset)))
-            self._save_as_revision(
+            save_as_revision(
                 object_list=relations_subset,
                 user=clinvar_user,
                 comment='Relation added based on presence in ClinVar ' +
                         'XML file: {}'.format(xml_filename))
 
         logging.info('Updating {} clinvar-rcva Relations in db.'.format(
-            str(len(relations_updated))))
-        for i in range(1 + int(len(relations_updated) / 10000)):
-            relations_subset = relations_updated[i * 10000: (i + 1) * 10000]
-            if len(relations_subset) == 0:
-                break
-            logging.info('Adding {} through {} to db...'.format(
-                1 + i * 10000, i * 10000 + len(relations_subset)))
-            self._save_as_revision(
-                object_list=relations_subset,
+            str(len(relation_updates))))
+        for i, updates_subset in enumerate(
+                chunks(relation_updates.items(), 10000)):
+            logging.info('Updating {} through {} in db...'.format(
+                1 + i * 10000, i * 10000 + len(updates_subset)))
+            self._update_relations(
+                updates=updates_subset,
                 user=clinvar_user,
                 comment='Relation updated based on updated data detected in ' +
                         'ClinVar XML file: {}'.format(xml_filename))
 
+    def _stage_xml(self, clinvar_xml, xml_filename, clinvar_user, workers):
+        logging.info('Reading XML, staging each ClinVarSet')
+        clinvar_staging.copy_rcvas(
+            (rcv_acc, val_store) for rcv_acc, val_store, _ in
+            self._read_xml(clinvar_xml, workers=workers))
+        clinvar_xml.close()
+
+        logging.info('ClinVar XML closed. Now adding new clinvar-rcva ' +
+                     'Relations to db.')
+        self._save_staged(
+            Relation,
+            lambda after, limit: clinvar_staging.insert_new_relations(limit),
+            user=clinvar_user,
+            comment='Relation added based on presence in ClinVar ' +
+                    'XML file: {}'.format(xml_filename))
+
+        # Changes are detected by comparing each RCVA_DATA tag, as the hashes
+        # from _hash_xml_dict would.
+        logging.info('Updating changed clinvar-rcva Relations in db.')
+        self._save_staged(
+            Relation,
+            lambda after, limit: clinvar_staging.update_changed_relations(
+                RCVA_DATA.keys(), after, limit),
+            user=clinvar_user,
+            comment='Relation updated based on updated data detected in ' +
+                    'ClinVar XML file: {}'.format(xml_filename))
+
+    def handle(self, local_vcf=None, local_xml=None, max_num=None,
+               compact_index=False, bulk=False, staging=False, workers=1,
+               *args, **options):
+        # The clinvar_user will be recorded as the editor by reversion.
+        logging.basicConfig(level=logging.INFO,
+                            format='%(asctime)s - %(message)s')
+        clinvar_user = get_user_model().objects.get(
+            username='clinvar-data-importer')
+        save_as_revision = (self._bulk_save_as_revision if bulk else
+                            self._save_as_revision)
+
+        # Load ClinVar VCF.
+        logging.info('Loading ClinVar VCF file...')
+        if not (local_vcf and local_xml):
+            tempdir = tempfile.mkdtemp()
+            logging.info('Created tempdir {}'.format(tempdir))
+        if local_vcf:
+            cv_fp, vcf_filename = local_vcf, os.path.split(local_vcf)[-1]
+        else:
+            cv_fp, vcf_filename = self._download_latest_clinvar(tempdir)
+        logging.info('Loaded Clinvar VCF, stored at {}'.format(cv_fp))
+
+        if staging:
+            logging.info('Creating staging tables.')
+            clinvar_staging.create_staging_tables()
+        else:
+            logging.info('Caching existing variants with build 37 lookup '
+                         'info.')
+            # Index of variants by their build 37 tag values, ('chrom_b37',
+            # 'pos_b37', 'ref_allele_b37', 'var_allele_b37'). New variants
+            # found in the VCF are added, and each variant has a handle to
+            # refer to it.
+            variant_index = (CompactVariantIndex() if compact_index else
+                             VariantIndex())
+            variant_index.load_existing()
+
+            # Track ClinVar RCV records in VCF and the handles of their
+            # Variants.
+            rcv_index = (CompactAccessionIndex() if compact_index else
+                         AccessionIndex())
+            logging.info('Done caching variants.')
+
+        logging.info('Reading VCF.')
+        clinvar_vcf = self._open(cv_fp)
+
+        # Add Variants if they have ClinVar data. Variants are initially added
+        # only with the build 37 position information from the VCF.
+        alleles = self._read_vcf(clinvar_vcf, max_num)
+        if staging:
+            clinvar_staging.copy_alleles(alleles)
+        else:
+            for var_key, rcv_accs in alleles:
+                # Check if we already have this Variant. If not, add it.
+                handle = variant_index.add(var_key)
+
+                # Keep track of RCV Assertion IDs we encounter, we'll add later
+                for rcv_acc in rcv_accs:
+                    rcv_index.add(rcv_acc, handle)
+
+        # Close VCF, save new variants to db bundled revisions of 10k or less.
+        clinvar_vcf.close()
+        variant_comment = ('Variant added based on presence in ClinVar ' +
+                           'VCF file: {}'.format(vcf_filename))
+        if staging:
+            logging.info('VCF closed. Now adding new staged variants to db.')
+            self._save_staged(
+                Variant,
+                lambda after, limit: clinvar_staging.insert_new_variants(
+                    limit),
+                user=clinvar_user, comment=variant_comment)
+        else:
+            logging.info('VCF closed. Now adding {} new variants to '
+                         'db.'.format(variant_index.num_new()))
+            for i, variants_subset in enumerate(
+                    variant_index.new_variant_chunks(10000)):
+                logging.info('Adding {} through {} to db...'.format(
+                    1 + i * 10000, i * 10000 + len(variants_subset)))
+                save_as_revision(
+                    object_list=variants_subset,
+                    user=clinvar_user,
+                    comment=variant_comment)
+
+        # Load ClinVar XML file.
+        logging.info('Loading latest ClinVar XML...')
+        if local_xml:
+            cv_fp, xml_filename = local_xml, os.path.split(local_xml)[-1]
+        else:
+            cv_fp, xml_filename = self._download_latest_clinvar_xml(tempdir)
+        logging.info('Loaded latest Clinvar XML, stored at {}'.format(cv_fp))
+
+        clinvar_xml = self._open(cv_fp)
+        if staging:
+            self._stage_xml(clinvar_xml, xml_filename, clinvar_user, workers)
+            clinvar_staging.drop_staging_tables()
+        else:
+            self._import_xml(clinvar_xml, xml_filename, clinvar_user,
+                             variant_index, rcv_index, save_as_revision,
+                             workers)
+
         if not (local_vcf and local_xml):
             shutil.rmtree(tempdir)
             logging.info('Removed tempdir {}'.format(tempdir))
+
+        logging.info('Peak memory use: {:.0f} MB'.format(peak_memory_mb()))
+
+
+def _parse_clinvar_sets(texts):
+    """
+    Return (RCV accession, tags, hash) for a list of ClinVarSet XML texts.
+
+    This is run by '--workers' processes, so it's a module level function.
+    """
+    command = Command()
+    return [command._parse_clinvar_set(ET.fromstring(text))
+            for text in texts]
@@ -0,0 +1,32 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand
+
+from gennotes_server import api_cache
+
+
+class Command(BaseCommand):
+    help = 'Report hits and misses of the API cache since the last reset.'
+
+    option_list = BaseCommand.option_list + (
+        make_option('-r', '--reset',
+                    action='store_true',
+                    dest='reset',
+                    default=False,
+                    help='Reset the counts after reporting them.'),
+    )
+
+    def handle(self, reset=False, *args, **options):
+        if not api_cache.is_shared():
+            self.stderr.write('The API cache is not shared between '
+                              'processes (see API_CACHE_BACKEND), so there '
+                              'are no counts to report here.')
+        stats = api_cache.get_stats()
+        lookups = stats['hits'] + stats['misses']
+        for name, count in stats.items():
+            self.stdout.write('{}: {}'.format(name, count))
+        if lookups:
+            self.stdout.write('hit rate: {:.1%}'.format(
+                float(stats['hits']) / lookups))
+        if reset:
+            api_cache.reset_stats()
@@ -0,0 +1,56 @@
+import itertools
+from optparse import make_option
+import timeit
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gennotes_server.management.commands import add_clinvar_data
+
+
+class Command(BaseCommand):
+    help = ('Compare the speed of extracting RCVA tags from ClinVar XML by '
+            "add_clinvar_data's compiled extractor and by the RCVA_DATA "
+            'functions.')
+    args = '<ClinVar XML file>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('-n', '--num-sets',
+                    dest='num_sets',
+                    type='int',
+                    default=10000,
+                    help='Number of ClinVarSets to read from the file'),
+        make_option('-r', '--repeat',
+                    dest='repeat',
+                    type='int',
+                    default=3,
+                    help='Times to run each, reporting the fastest'),
+    )
+
+    def handle(self, xml_file=None, num_sets=10000, repeat=3,
+               *args, **options):
+        if not xml_file:
+            raise CommandError('Please specify a ClinVar XML file.')
+        importer = add_clinvar_data.Command()
+        clinvar_xml = importer._open(xml_file)
+        clinvar_sets = list(itertools.islice(
+            importer._get_elements(clinvar_xml, 'ClinVarSet'), num_sets))
+        clinvar_xml.close()
+        if not clinvar_sets:
+            raise CommandError('No ClinVarSets found in {}'.format(xml_file))
+        self.stdout.write('Read {} ClinVarSets ({})'.format(
+            len(clinvar_sets), add_clinvar_data.ET.__name__))
+
+        for name, extract in [
+                ('RCVA_DATA functions', importer._lambda_rcva_tags),
+                ('Compiled extractor', importer._rcva_tags)]:
+            seconds = min(timeit.repeat(
+                lambda: [extract(ele) for ele in clinvar_sets],
+                number=1, repeat=repeat))
+            self.stdout.write('{}: {:.0f} records/s'.format(
+                name, len(clinvar_sets) / seconds))
+
+        differing = [
+            ele for ele in clinvar_sets
+            if importer._rcva_tags(ele) != importer._lambda_rcva_tags(ele)]
+        self.stdout.write('{} of {} records differ'.format(
+            len(differing), len(clinvar_sets)))
@@ -0,0 +1,52 @@
+import gzip
+from optparse import make_option
+import sys
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gennotes_server.export import export_lines
+from gennotes_server.utils import map_chrom_to_index
+
+
+class Command(BaseCommand):
+    help = ('Export all variants, with their relations, as newline-delimited '
+            'JSON.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('-c', '--chrom',
+                    dest='chrom',
+                    help='Only export variants on this chromosome'),
+        make_option('-t', '--relation-type',
+                    dest='relation_type',
+                    help='Only export relations of this type, and their '
+                         'variants'),
+        make_option('-o', '--output',
+                    dest='output',
+                    help='File to write to (default is stdout)'),
+        make_option('-z', '--gzip',
+                    action='store_true',
+                    dest='compress',
+                    default=False,
+                    help='Gzip compress the export'),
+    )
+
+    def handle(self, chrom=None, relation_type=None, output=None,
+               compress=False, *args, **options):
+        if chrom:
+            try:
+                chrom = int(map_chrom_to_index(chrom))
+            except ValueError as err:
+                raise CommandError(str(err))
+
+        out_file = open(output, 'wb') if output else sys.stdout
+        export_file = (gzip.GzipFile(fileobj=out_file, mode='wb') if compress
+                       else out_file)
+        try:
+            for line in export_lines(chrom=chrom or None,
+                                     relation_type=relation_type):
+                export_file.write(line)
+        finally:
+            if compress:
+                export_file.close()
+            if output:
+                out_file.close()
@@ -0,0 +1,38 @@
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+
+from gennotes_server import tag_indexes
+
+
+class Command(BaseCommand):
+    help = ('Create expression indexes for the Variant tag keys listed in '
+            'the HOT_VARIANT_TAG_KEYS setting.')
+
+    option_list = BaseCommand.option_list + (
+        make_option('-d', '--drop',
+                    action='store_true',
+                    dest='drop',
+                    default=False,
+                    help='Drop indexes of keys no longer listed'),
+    )
+
+    def handle(self, drop=False, *args, **options):
+        hot_keys = tag_indexes.hot_tag_keys()
+        for key in hot_keys:
+            try:
+                tag_indexes.index_name(key)
+            except ValueError as err:
+                raise CommandError(str(err))
+
+        existing = tag_indexes.existing_indexes()
+        for key in sorted(hot_keys - set(existing)):
+            self.stdout.write('Creating index for tag "{}"'.format(key))
+            tag_indexes.create_index(key)
+        for key in sorted(set(existing) - hot_keys):
+            if drop:
+                self.stdout.write('Dropping index for tag "{}"'.format(key))
+                tag_indexes.drop_index(existing[key])
+            else:
+                self.stdout.write('Tag "{}" is no longer hot; use --drop to '
+                                  'drop its index'.format(key))
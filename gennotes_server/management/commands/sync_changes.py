@@ -0,0 +1,130 @@
+from itertools import groupby
+from optparse import make_option
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import transaction
+from django.utils.dateparse import parse_datetime
+import requests
+from reversion import revisions as reversion
+from reversion.models import Revision
+
+from gennotes_server.models import (ChangeFeedSync, CommitDeletion, Relation,
+                                    Variant, advance_id_sequence)
+
+MODELS = {'variant': Variant, 'relation': Relation}
+
+
+class Command(BaseCommand):
+    help = ("Apply changes from another GenNotes server's change feed "
+            '(/api/changes/) to this database, making it a replica.')
+    args = '<source server URL, e.g. https://gennotes.herokuapp.com>'
+
+    option_list = BaseCommand.option_list + (
+        make_option('-s', '--since',
+                    dest='since',
+                    type='int',
+                    help='Revision ID to sync from (default is the last '
+                         'revision synced from this source)'),
+        make_option('-p', '--page-size',
+                    dest='page_size',
+                    type='int',
+                    default=1000,
+                    help='Changes to fetch per request'),
+    )
+
+    def handle(self, source=None, since=None, page_size=1000,
+               *args, **options):
+        if not source:
+            raise CommandError('Please specify the source server URL.')
+        source = source.rstrip('/')
+        sync, _ = ChangeFeedSync.objects.get_or_create(source=source)
+        if since is None:
+            since = sync.last_revision
+
+        # Changes are applied a revision at a time, so a revision split
+        # across pages is held until its last change is fetched.
+        pending = []
+        applied = 0
+        for change in self._changes(source, since, page_size):
+            if pending and change['revision'] != pending[0]['revision']:
+                self._apply_revision(sync, pending)
+                applied += 1
+                pending = []
+            pending.append(change)
+        if pending:
+            self._apply_revision(sync, pending)
+            applied += 1
+        self.stdout.write('Applied {} revisions, up to revision {}'.format(
+            applied, sync.last_revision))
+
+    @staticmethod
+    def _changes(source, since, page_size):
+        url = source + '/api/changes/'
+        params = {'since': since, 'cursor': '', 'page_size': page_size}
+        while url:
+            response = requests.get(url, params=params)
+            if response.status_code != 200:
+                raise CommandError('Change feed request failed ({}): {}'
+                                   .format(response.status_code,
+                                           response.text))
+            data = response.json()
+            for change in data['results']:
+                yield change
+            # The next link carries all parameters.
+            url, params = data['next'], None
+
+    @transaction.atomic()
+    def _apply_revision(self, sync, changes):
+        """
+        Apply a source revision's changes, and record them as one revision.
+
+        Versions are recorded so current_version pointers, history and as_of
+        reads work on the replica; the revision gets the source's date and
+        comment. Objects keep the source's IDs, and the local ID sequences
+        are advanced past them.
+        """
+        objects = []
+        deleted = []
+        # Variants first, as new Relations may refer to them.
+        changes = sorted(changes, key=lambda c: c['type'] != 'variant')
+        for object_type, typed_changes in groupby(
+                changes, key=lambda c: c['type']):
+            model = MODELS[object_type]
+            typed_changes = list(typed_changes)
+            existing = model.objects.select_for_update().in_bulk(
+                [change['id'] for change in typed_changes])
+            new = []
+            for change in typed_changes:
+                instance = existing.get(change['id'])
+                if instance is None:
+                    instance = model(id=change['id'])
+                    if change['action'] != 'deleted':
+                        new.append(instance)
+                instance.tags = change['tags']
+                if model is Relation:
+                    instance.variant_id = change['variant']
+                if change['action'] == 'deleted':
+                    deleted.append(instance)
+                elif instance.id in existing:
+                    instance.save()
+                objects.append(instance)
+            if model is Variant:
+                for instance in new:
+                    instance.sync_b37_fields()
+            model.objects.bulk_create(new)
+            # The source's IDs aren't drawn from the local sequence.
+            if new:
+                advance_id_sequence(model)
+
+        reversion.default_revision_manager.save_revision(
+            objects, comment=changes[0]['comment'],
+            meta=[(CommitDeletion, {})] if deleted else ())
+        # Revisions are dated when saved, so the source's date is set after.
+        Revision.objects.filter(
+            version__id=objects[0].current_version_id).update(
+                date_created=parse_datetime(changes[0]['date']))
+        for instance in deleted:
+            instance.__class__.objects.filter(id=instance.id).delete()
+
+        sync.last_revision = changes[0]['revision']
+        sync.save()
@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+# Variants whose dash-style b37 keys are renamed are recorded in a revision,
+# so their latest versions match their tags.
+RECORD_RENAMES_SQL = """
+WITH revision AS (
+    INSERT INTO reversion_revision (manager_slug, date_created, comment)
+    SELECT 'default', now(),
+        'Renamed dash-style build 37 tags (e.g. chrom-b37) to the special '
+        'tags (e.g. chrom_b37).'
+    WHERE EXISTS (SELECT 1 FROM renamed_b37_variant)
+    RETURNING id
+)
+INSERT INTO reversion_version (revision_id, object_id, object_id_int,
+    content_type_id, format, serialized_data, object_repr)
+SELECT revision.id, variant.id::text, variant.id, content_type.id, 'json',
+    json_build_array(json_build_object(
+        'model', 'gennotes_server.variant',
+        'pk', variant.id,
+        'fields', json_build_object(
+            'tags', hstore_to_json(variant.tags)::text,
+            'chrom_b37', variant.chrom_b37,
+            'pos_b37', variant.pos_b37,
+            'ref_allele_b37', variant.ref_allele_b37,
+            'var_allele_b37', variant.var_allele_b37)))::text,
+    (SELECT string_agg(key || '=' || value, '; ') FROM each(variant.tags))
+FROM revision
+CROSS JOIN renamed_b37_variant renamed
+JOIN gennotes_server_variant variant ON variant.id = renamed.id
+JOIN django_content_type content_type
+    ON content_type.app_label = 'gennotes_server'
+    AND content_type.model = 'variant'
+ORDER BY variant.id;
+DROP TABLE renamed_b37_variant;
+"""
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gennotes_server', '0004_auto_20160318_1926'),
+        ('reversion', '0002_auto_20141216_1509'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='variant',
+            name='chrom_b37',
+            field=models.SmallIntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='variant',
+            name='pos_b37',
+            field=models.IntegerField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='variant',
+            name='ref_allele_b37',
+            field=models.TextField(null=True, blank=True),
+        ),
+        migrations.AddField(
+            model_name='variant',
+            name='var_allele_b37',
+            field=models.TextField(null=True, blank=True),
+        ),
+        # The ClinVar importer used to write dash-style keys ('chrom-b37',
+        # etc.). Rename them to the special tags, so those variants get typed
+        # columns and are found by later imports rather than re-created.
+        # Underscore tags already present are kept. The renamed Variants'
+        # IDs are kept until they're recorded, below.
+        migrations.RunSQL(
+            'CREATE TEMPORARY TABLE renamed_b37_variant (id integer); '
+            'WITH renamed AS ('
+            'UPDATE gennotes_server_variant SET tags = '
+            "hstore(ARRAY['chrom_b37', 'pos_b37', 'ref_allele_b37', "
+            "'var_allele_b37'], ARRAY[tags->'chrom-b37', tags->'pos-b37', "
+            "tags->'ref-allele-b37', tags->'var-allele-b37']) || "
+            "(tags - ARRAY['chrom-b37', 'pos-b37', 'ref-allele-b37', "
+            "'var-allele-b37']) "
+            "WHERE tags ?& ARRAY['chrom-b37', 'pos-b37', 'ref-allele-b37', "
+            "'var-allele-b37'] RETURNING id) "
+            'INSERT INTO renamed_b37_variant SELECT id FROM renamed;',
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        # Copy existing special tags into the typed columns.
+        migrations.RunSQL(
+            'UPDATE gennotes_server_variant SET '
+            "chrom_b37 = (tags->'chrom_b37')::smallint, "
+            "pos_b37 = (tags->'pos_b37')::integer, "
+            "ref_allele_b37 = tags->'ref_allele_b37', "
+            "var_allele_b37 = tags->'var_allele_b37' "
+            "WHERE tags ?& ARRAY['chrom_b37', 'pos_b37', "
+            "'ref_allele_b37', 'var_allele_b37'];",
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+        migrations.RunSQL(RECORD_RENAMES_SQL,
+                          reverse_sql=migrations.RunSQL.noop),
+        # A btree index entry must fit in about 2.7 KB, and ClinVar has
+        # longer indels, so the alleles are indexed by their hashes. Lookups
+        # by b37 key use the chromosome and position columns of the index.
+        migrations.RunSQL(
+            'CREATE UNIQUE INDEX "gennotes_server_variant_b37_key_uniq" ON '
+            'gennotes_server_variant (chrom_b37, pos_b37, '
+            'md5(ref_allele_b37), md5(var_allele_b37));',
+            reverse_sql='DROP INDEX "gennotes_server_variant_b37_key_uniq";',
+        ),
+        # The old expression indexes are on tag keys lookups no longer use.
+        migrations.RunSQL(
+            'DROP INDEX IF EXISTS "gennotes_server_variant_tags_chrom_b37_idx";'
+            'DROP INDEX IF EXISTS "gennotes_server_variant_tags_pos_b37_idx";'
+            'DROP INDEX IF EXISTS '
+            '"gennotes_server_variant_tags_ref_allele_b37_idx";'
+            'DROP INDEX IF EXISTS '
+            '"gennotes_server_variant_tags_var_allele_b37_idx";',
+            reverse_sql=(
+                'CREATE INDEX "gennotes_server_variant_tags_chrom_b37_idx" on '
+                "gennotes_server_variant USING btree (( tags->'chrom-b37' )); "
+                'CREATE INDEX "gennotes_server_variant_tags_pos_b37_idx" on '
+                "gennotes_server_variant USING btree (( tags->'pos-b37' ));"
+                'CREATE INDEX "gennotes_server_variant_tags_ref_allele_b37_idx" '
+                "on gennotes_server_variant USING btree "
+                "(( tags->'ref-allele-b37' ));"
+                'CREATE INDEX "gennotes_server_variant_tags_var_allele_b37_idx" '
+                "on gennotes_server_variant USING btree "
+                "(( tags->'var-allele-b37' ));"
+            ),
+        ),
+    ]
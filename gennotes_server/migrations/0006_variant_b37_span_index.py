@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gennotes_server', '0005_variant_b37_fields'),
+    ]
+
+    operations = [
+        # Index each variant's span (chromosome-offset position through the
+        # end of the reference allele) for region overlap queries.
+        migrations.RunSQL(
+            'CREATE INDEX "gennotes_server_variant_b37_span_idx" ON '
+            'gennotes_server_variant USING gist (('
+            "int8range(chrom_b37::bigint * 1000000000 + pos_b37, "
+            "chrom_b37::bigint * 1000000000 + pos_b37 + "
+            "greatest(length(ref_allele_b37), 1), '[)')));",
+            reverse_sql=(
+                'DROP INDEX "gennotes_server_variant_b37_span_idx";'),
+        ),
+    ]
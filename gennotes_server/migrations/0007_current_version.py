@@ -0,0 +1,42 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+BACKFILL_SQL = (
+    'UPDATE gennotes_server_{model} SET current_version_id = latest.id '
+    'FROM (SELECT object_id_int, MAX(id) AS id FROM reversion_version '
+    'WHERE content_type_id = (SELECT id FROM django_content_type '
+    "WHERE app_label = 'gennotes_server' AND model = '{model}') "
+    'GROUP BY object_id_int) AS latest '
+    'WHERE gennotes_server_{model}.id = latest.object_id_int;'
+)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('reversion', '0002_auto_20141216_1509'),
+        ('gennotes_server', '0006_variant_b37_span_index'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='relation',
+            name='current_version',
+            field=models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, blank=True, editable=False, to='reversion.Version', null=True),
+        ),
+        migrations.AddField(
+            model_name='variant',
+            name='current_version',
+            field=models.ForeignKey(related_name='+', on_delete=django.db.models.deletion.SET_NULL, blank=True, editable=False, to='reversion.Version', null=True),
+        ),
+        # Point existing objects at their latest Version.
+        migrations.RunSQL(
+            BACKFILL_SQL.format(model='variant') +
+            BACKFILL_SQL.format(model='relation'),
+            reverse_sql=migrations.RunSQL.noop,
+        ),
+    ]
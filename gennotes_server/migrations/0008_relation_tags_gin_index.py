@@ -0,0 +1,23 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gennotes_server', '0007_current_version'),
+    ]
+
+    operations = [
+        # Index relation tags for containment (@>) queries, e.g. filtering
+        # by type and clinical significance. jsonb_path_ops indexes are
+        # smaller and faster than the default jsonb_ops, but only support @>.
+        migrations.RunSQL(
+            'CREATE INDEX "gennotes_server_relation_tags_path_ops_idx" ON '
+            'gennotes_server_relation USING gin (tags jsonb_path_ops);',
+            reverse_sql=(
+                'DROP INDEX "gennotes_server_relation_tags_path_ops_idx";'),
+        ),
+    ]
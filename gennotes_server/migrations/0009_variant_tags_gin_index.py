@@ -0,0 +1,22 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gennotes_server', '0008_relation_tags_gin_index'),
+    ]
+
+    operations = [
+        # Index variant tags for key existence (?) and containment (@>)
+        # queries, i.e. the 'has_tag' and 'tag' filters. Frequently searched
+        # keys can also get expression indexes: see tag_indexes.py.
+        migrations.RunSQL(
+            'CREATE INDEX "gennotes_server_variant_tags_gin_idx" ON '
+            'gennotes_server_variant USING gin (tags);',
+            reverse_sql='DROP INDEX "gennotes_server_variant_tags_gin_idx";',
+        ),
+    ]
@@ -0,0 +1,25 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gennotes_server', '0009_variant_tags_gin_index'),
+        ('reversion', '0002_auto_20141216_1509'),
+    ]
+
+    operations = [
+        # Index the Variant ID in Relation Versions' serialized data, so
+        # 'as_of' reads can find the Relations a Variant had at a time,
+        # including deleted ones. The expression matches VERSION_VARIANT_SQL
+        # in history.py; it's null for Versions of other models.
+        migrations.RunSQL(
+            'CREATE INDEX "gennotes_server_version_variant_idx" ON '
+            'reversion_version (((serialized_data::jsonb -> 0 -> '
+            "'fields' ->> 'variant')::integer));",
+            reverse_sql='DROP INDEX "gennotes_server_version_variant_idx";',
+        ),
+    ]
@@ -0,0 +1,32 @@
+# -*- coding: utf-8 -*-
+# Generated by Django 1.9.4 on 2026-10-18 00:11
+from __future__ import unicode_literals
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('gennotes_server', '0010_version_variant_index'),
+        ('reversion', '0002_auto_20141216_1509'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ChangeFeedSync',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('source', models.URLField(unique=True)),
+                ('last_revision', models.IntegerField(default=0)),
+            ],
+        ),
+        # Index Versions in change feed order, so a page of the feed is read
+        # straight from the index, even within a revision of many Versions.
+        migrations.RunSQL(
+            'CREATE INDEX "gennotes_server_version_revision_id_idx" ON '
+            'reversion_version (revision_id, id);',
+            reverse_sql=(
+                'DROP INDEX "gennotes_server_version_revision_id_idx";'),
+        ),
+    ]
@@ -9,12 +9,25 @@ later optimizing with db indexing and Django): `^[a-z][a-z0-9]*(_[a-z0-9]+)*`.
     -- Madeleine
 """
 from django.contrib.postgres.fields import HStoreField, JSONField
-from django.db import models
+from django.conf import settings
+from django.db import connection, models
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 
 from oauth2_provider.models import AbstractApplication
 
 from reversion import revisions as reversion
-from reversion.models import Revision
+from reversion.models import Revision, Version
+from reversion.signals import post_revision_commit, pre_revision_commit
+
+from . import api_cache, auth_cache
+from .versions import set_current_versions
+
+# Largest values the typed chrom_b37 and pos_b37 columns can hold.
+MAX_CHROM = 2 ** 15 - 1
+MAX_POSITION = 2 ** 31 - 1
+# Advisory lock key held from saving a revision until its transaction ends.
+REVISION_LOCK_KEY = 418
 
 
 class Variant(models.Model):
@@ -29,12 +42,73 @@ class Variant(models.Model):
     """
     ALLOWED_CHROMS = [str(i) for i in range(1, 25)]
     tags = HStoreField()
+    current_version = models.ForeignKey(
+        Version, null=True, blank=True, editable=False, related_name='+',
+        on_delete=models.SET_NULL)
     special_tags = ['chrom_b37', 'pos_b37', 'ref_allele_b37', 'var_allele_b37']
     required_tags = special_tags
 
+    # Typed copies of the special tags, kept in sync by save(). Lookups by
+    # build 37 position use these (via the unique index on the position and
+    # the alleles' hashes, from migration 0005) instead of the hstore keys.
+    chrom_b37 = models.SmallIntegerField(null=True, blank=True)
+    pos_b37 = models.IntegerField(null=True, blank=True)
+    ref_allele_b37 = models.TextField(null=True, blank=True)
+    var_allele_b37 = models.TextField(null=True, blank=True)
+
     def __unicode__(self):
         return u'; '.join([u'%s=%s' % (k, v) for k, v in self.tags.iteritems()])
 
+    @classmethod
+    def b37_key_from_tags(cls, tags):
+        """
+        Return a typed (chrom, pos, ref, var) tuple for special tag data.
+
+        Returns None if any special tag is missing. Raises ValueError if the
+        chromosome or position can't be interpreted.
+        """
+        if not all(tag in tags for tag in cls.special_tags):
+            return None
+        chrom, pos = int(tags['chrom_b37']), int(tags['pos_b37'])
+        if not (0 < chrom <= MAX_CHROM and 0 < pos <= MAX_POSITION):
+            raise ValueError('Invalid build 37 location: {}-{}'.format(
+                tags['chrom_b37'], tags['pos_b37']))
+        return (chrom, pos, tags['ref_allele_b37'], tags['var_allele_b37'])
+
+    @classmethod
+    def b37_key_from_id(cls, b37_id):
+        """
+        Return a typed (chrom, pos, ref, var) tuple for e.g. "b37-1-883516-G-A".
+
+        Returns None if the string isn't a valid build 37 variant ID.
+        """
+        parts = b37_id.split('-')
+        if len(parts) != 5 or parts[0] != 'b37':
+            return None
+        try:
+            return cls.b37_key_from_tags(dict(zip(cls.special_tags, parts[1:])))
+        except ValueError:
+            return None
+
+    @classmethod
+    def b37_filter_kwargs(cls, b37_key):
+        """
+        Return filter kwargs for the typed columns matching a b37 key tuple.
+        """
+        return dict(zip(cls.special_tags, b37_key))
+
+    def sync_b37_fields(self):
+        """
+        Copy the special tags to their typed columns.
+        """
+        b37_key = self.b37_key_from_tags(self.tags) or (None,) * 4
+        (self.chrom_b37, self.pos_b37,
+         self.ref_allele_b37, self.var_allele_b37) = b37_key
+
+    def save(self, *args, **kwargs):
+        self.sync_b37_fields()
+        super(Variant, self).save(*args, **kwargs)
+
 
 class Relation(models.Model):
     """
@@ -47,6 +121,9 @@ class Relation(models.Model):
     """
     variant = models.ForeignKey(Variant)
     tags = JSONField()
+    current_version = models.ForeignKey(
+        Version, null=True, blank=True, editable=False, related_name='+',
+        on_delete=models.SET_NULL)
     special_tags = ['type']
     required_tags = ['type']
 
@@ -59,8 +136,133 @@ class CommitDeletion(models.Model):
     deletion = models.BooleanField(default=True)
 
 
-reversion.register(Variant)
-reversion.register(Relation)
+class ChangeFeedSync(models.Model):
+    """
+    Progress of the sync_changes command, for each server it syncs from.
+
+    'last_revision' is the ID of the last revision in the source server's
+    change feed that's been applied here.
+    """
+    source = models.URLField(unique=True)
+    last_revision = models.IntegerField(default=0)
+
+
+def reserve_ids(model, count):
+    """
+    Return a list of 'count' new primary keys from a model's ID sequence.
+
+    Django's bulk_create doesn't set primary keys with Postgres. Objects given
+    reserved keys first can be recorded by django-reversion after bulk_create.
+    """
+    if not count:
+        return []
+    with connection.cursor() as cursor:
+        cursor.execute(
+            "SELECT nextval(pg_get_serial_sequence(%s, 'id')) "
+            'FROM generate_series(1, %s)', [model._meta.db_table, count])
+        return [row[0] for row in cursor.fetchall()]
+
+
+def advance_id_sequence(model):
+    """
+    Move a model's ID sequence past its largest ID, if it's behind.
+
+    Needed after inserting objects with given IDs (e.g. a replica's copies of
+    another server's objects), so new objects don't get the same IDs.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')",
+                       [model._meta.db_table])
+        sequence = cursor.fetchone()[0]
+        cursor.execute(
+            'SELECT setval(%s, max(id)) FROM {table} '
+            'HAVING max(id) > (SELECT last_value FROM {sequence})'.format(
+                table=model._meta.db_table, sequence=sequence),
+            [sequence])
+
+
+# The current_version pointer isn't versioned; it's maintained on each commit.
+reversion.register(Variant, exclude=['current_version'])
+reversion.register(Relation, exclude=['current_version'])
+
+
+@receiver(pre_revision_commit)
+def lock_revision_commits(sender, **kwargs):
+    """
+    Make revisions commit in ID order, by saving one at a time.
+
+    Revision IDs are assigned on insert, so without this a long transaction
+    (e.g. an import chunk) could commit revision R after R+1 has been read,
+    and the change feed and events, which follow revision IDs, would skip
+    it. The lock is taken before the revision gets its ID and released when
+    its transaction commits or rolls back.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT pg_advisory_xact_lock(%s)',
+                       [REVISION_LOCK_KEY])
+
+
+@receiver(post_revision_commit)
+def update_current_versions(sender, instances, revision, versions,
+                            **kwargs):
+    """
+    Point Variants and Relations at new Versions, in the same transaction.
+
+    Also invalidates cached API data for them, and for the Variants of
+    Relations (which include them in their serialized data), and notifies
+    event subscribers of the revision when it commits.
+    """
+    set_current_versions(versions, instances)
+    changed = set()
+    for instance in instances:
+        changed.add((instance.__class__, instance.pk))
+        if isinstance(instance, Relation):
+            changed.add((Variant, instance.variant_id))
+    api_cache.invalidate(changed)
+    # Imported here as events.py needs this module's models.
+    from .events import notify_revision
+    notify_revision(revision.id)
+
+
+@receiver(post_delete, sender=Variant)
+def invalidate_variant_b37_id(sender, instance, **kwargs):
+    """
+    Forget a deleted Variant's cached b37 ID, so lookups don't resolve to it.
+    """
+    if all(tag in instance.tags for tag in Variant.special_tags):
+        api_cache.invalidate_variant_ids(['-'.join(
+            ['b37'] + [instance.tags[tag] for tag in Variant.special_tags])])
+
+
+@receiver(post_save, sender='account.EmailAddress')
+@receiver(post_delete, sender='account.EmailAddress')
+def invalidate_email_verified(sender, instance, **kwargs):
+    """
+    Invalidate a user's cached verification status, e.g. on confirmation.
+    """
+    auth_cache.invalidate_email_verified(instance.user_id)
+
+
+@receiver(post_save, sender='oauth2_provider.AccessToken')
+@receiver(post_delete, sender='oauth2_provider.AccessToken')
+def invalidate_access_token(sender, instance, **kwargs):
+    """
+    Invalidate a cached AccessToken when it's changed or revoked.
+    """
+    auth_cache.invalidate_access_tokens([instance.token])
+
+
+@receiver(post_save, sender=settings.AUTH_USER_MODEL)
+def invalidate_user_access_tokens(sender, instance, created, **kwargs):
+    """
+    Invalidate cached AccessTokens holding a copy of a changed user.
+    """
+    # A new user has no AccessTokens. (Migration 0002 creates one before
+    # the AccessToken table exists.)
+    if created:
+        return
+    auth_cache.invalidate_access_tokens(
+        instance.accesstoken_set.values_list('token', flat=True))
 
 
 class EditingApplication(AbstractApplication):
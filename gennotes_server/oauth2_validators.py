@@ -0,0 +1,37 @@
+from oauth2_provider.oauth2_validators import OAuth2Validator
+from oauth2_provider.models import AccessToken
+
+from . import auth_cache
+
+
+class CachedOAuth2Validator(OAuth2Validator):
+    """
+    OAuth2Validator that caches the access tokens it validates.
+
+    Requests are validated by both OAuth2TokenMiddleware and REST Framework's
+    authentication, and a token is usually used for many requests, so tokens
+    are cached until they expire or are changed (see auth_cache). Expiry and
+    scopes are still checked on every request.
+    """
+    def validate_bearer_token(self, token, scopes, request):
+        if not token:
+            return False
+
+        access_token = auth_cache.get_access_token(token)
+        if access_token is None:
+            try:
+                access_token = AccessToken.objects.select_related(
+                    'application', 'user').get(token=token)
+            except AccessToken.DoesNotExist:
+                return False
+            auth_cache.set_access_token(access_token)
+
+        if access_token.is_valid(scopes):
+            request.client = access_token.application
+            request.user = access_token.user
+            request.scopes = scopes
+
+            # this is needed by django rest framework
+            request.access_token = access_token
+            return True
+        return False
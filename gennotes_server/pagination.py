@@ -1,6 +1,177 @@
-from rest_framework.pagination import PageNumberPagination
+from base64 import urlsafe_b64decode, urlsafe_b64encode
+from collections import OrderedDict
+import json
+
+from django.core.exceptions import ValidationError
+from django.utils import six
+from rest_framework.exceptions import NotFound
+from rest_framework.pagination import (BasePagination, PageNumberPagination,
+                                       _positive_int)
+from rest_framework.response import Response
+from rest_framework.settings import api_settings
+from rest_framework.utils.urls import replace_query_param
 
 
 class PageNumberPaginationUpTo1000(PageNumberPagination):
     page_size_query_param = 'page_size'
     max_page_size = 1000
+
+
+class KeysetCursorPagination(BasePagination):
+    """
+    Paginate by seeking past the last row of the previous page.
+
+    Each page is a single indexed query: no COUNT(*) and no OFFSET, so deep
+    pages cost the same as the first. The opaque cursor encodes the ordering
+    values of the last row returned. Orderings must be unique; a view can
+    offer several by setting 'cursor_orderings', a dict mapping the names
+    clients pass as 'ordering' to tuples of field names. Only forward ('next')
+    links are provided.
+    """
+    cursor_query_param = 'cursor'
+    ordering_query_param = 'ordering'
+    page_size = api_settings.PAGE_SIZE
+    page_size_query_param = 'page_size'
+    max_page_size = 1000
+    default_orderings = {'id': ('id',)}
+    invalid_cursor_message = 'Invalid cursor'
+    invalid_ordering_message = 'Invalid ordering, options are: {}'
+
+    def get_page_size(self, request):
+        try:
+            return _positive_int(
+                request.query_params[self.page_size_query_param],
+                strict=True, cutoff=self.max_page_size)
+        except (KeyError, ValueError):
+            return self.page_size
+
+    def get_ordering(self, queryset, request, view):
+        orderings = getattr(view, 'cursor_orderings', self.default_orderings)
+        ordering_name = request.query_params.get(self.ordering_query_param)
+        if ordering_name:
+            if ordering_name not in orderings:
+                raise NotFound(self.invalid_ordering_message.format(
+                    ', '.join(sorted(orderings))))
+            return orderings[ordering_name]
+        # Keep the queryset's own ordering if it's one we can seek on.
+        if tuple(queryset.query.order_by) in orderings.values():
+            return tuple(queryset.query.order_by)
+        return orderings.get('id', ('id',))
+
+    def decode_cursor(self, request, converters):
+        """
+        Return the cursor's position, or None if there's no cursor.
+
+        'converters' are functions converting each value to the type of its
+        ordering field, raising ValueError or ValidationError if they can't.
+        """
+        encoded = request.query_params.get(self.cursor_query_param)
+        if not encoded:
+            return None
+        try:
+            position = json.loads(urlsafe_b64decode(encoded.encode('ascii')))
+        except (TypeError, ValueError):
+            raise NotFound(self.invalid_cursor_message)
+        if (not isinstance(position, list) or
+                len(position) != len(self.ordering) or not
+                all(isinstance(value, six.integer_types + six.string_types)
+                    for value in position)):
+            raise NotFound(self.invalid_cursor_message)
+        try:
+            return [convert(value) for convert, value in
+                    zip(converters, position)]
+        except (TypeError, ValueError, ValidationError):
+            raise NotFound(self.invalid_cursor_message)
+
+    def encode_cursor(self, position):
+        return urlsafe_b64encode(json.dumps(position))
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.request = request
+        self.ordering = self.get_ordering(queryset, request, view)
+        page_size = self.get_page_size(request)
+
+        model_meta = queryset.model._meta
+        fields = [model_meta.get_field(name) for name in self.ordering]
+        queryset = queryset.filter(**{
+            '{}__isnull'.format(field.name): False
+            for field in fields if field.null}).order_by(*self.ordering)
+
+        position = self.decode_cursor(
+            request, [field.to_python for field in fields])
+        if position is not None:
+            # Row comparison, so Postgres can seek using a composite index.
+            columns = ', '.join('"{}"."{}"'.format(model_meta.db_table,
+                                                   field.column)
+                                for field in fields)
+            queryset = queryset.extra(
+                where=['({}) > ({})'.format(
+                    columns, ', '.join(['%s'] * len(fields)))],
+                params=position)
+
+        results = list(queryset[:page_size + 1])
+        self.next_position = None
+        if len(results) > page_size:
+            results = results[:page_size]
+            self.next_position = [getattr(results[-1], field.attname)
+                                  for field in fields]
+        return results
+
+    def paginate_rows(self, fetch, request, ordering=('id',), types=None):
+        """
+        Paginate rows from a query the ORM can't express.
+
+        'fetch(position, limit)' must return up to 'limit' rows as dicts,
+        sorted by the keys in 'ordering' and starting after 'position' (a list
+        of their values, or None for the first page). 'types' are the types
+        of the ordering values, which default to int.
+        """
+        self.request = request
+        self.ordering = ordering
+        page_size = self.get_page_size(request)
+
+        position = self.decode_cursor(request, types or [int] * len(ordering))
+        results = fetch(position, page_size + 1)
+        self.next_position = None
+        if len(results) > page_size:
+            results = results[:page_size]
+            self.next_position = [results[-1][name] for name in ordering]
+        return results
+
+    def get_next_link(self):
+        if self.next_position is None:
+            return None
+        return replace_query_param(self.request.build_absolute_uri(),
+                                   self.cursor_query_param,
+                                   self.encode_cursor(self.next_position))
+
+    def get_paginated_response(self, data):
+        return Response(OrderedDict([
+            ('next', self.get_next_link()),
+            ('results', data)
+        ]))
+
+
+class PageNumberOrCursorPagination(PageNumberPaginationUpTo1000):
+    """
+    Page number pagination, or cursor pagination if 'cursor' is in the query.
+
+    Start walking with an empty cursor (e.g. '?cursor=') and follow 'next'.
+    """
+    cursor_pagination_class = KeysetCursorPagination
+
+    def paginate_queryset(self, queryset, request, view=None):
+        self.cursor_paginator = None
+        cursor_query_param = self.cursor_pagination_class.cursor_query_param
+        if cursor_query_param in request.query_params:
+            self.cursor_paginator = self.cursor_pagination_class()
+            return self.cursor_paginator.paginate_queryset(
+                queryset, request, view)
+        return super(PageNumberOrCursorPagination, self).paginate_queryset(
+            queryset, request, view)
+
+    def get_paginated_response(self, data):
+        if self.cursor_paginator:
+            return self.cursor_paginator.get_paginated_response(data)
+        return super(PageNumberOrCursorPagination,
+                     self).get_paginated_response(data)
@@ -2,6 +2,20 @@ from rest_framework import permissions
 from oauth2_provider.ext.rest_framework.permissions import TokenHasScope
 from allauth.account.models import EmailAddress
 
+from . import auth_cache
+
+
+def email_verified(user):
+    """
+    Return whether a user's email address is verified, cached per user.
+    """
+    verified = auth_cache.get_email_verified(user.pk)
+    if verified is None:
+        # Avoiding try/except; we think this will work for any user.
+        verified = EmailAddress.objects.get(user=user).verified
+        auth_cache.set_email_verified(user.pk, verified)
+    return verified
+
 
 class EditAuthorizedOrReadOnly(TokenHasScope):
     """
@@ -19,11 +33,8 @@ class EditAuthorizedOrReadOnly(TokenHasScope):
             if request.auth and hasattr(request.auth, 'scope'):
                 required_scopes = self.get_scopes(request, view)
                 token_valid = request.auth.is_valid(required_scopes)
-                user_verified = EmailAddress.objects.get(
-                    user=request.user).verified
-                return token_valid and user_verified
+                return token_valid and email_verified(request.user)
             if request.user and request.user.is_authenticated():
-                # Avoiding try/except; we think this will work for any user.
-                return EmailAddress.objects.get(user=request.user).verified
+                return email_verified(request.user)
 
         return False
@@ -1,32 +1,34 @@
-import datetime
-
 from django.contrib.auth import get_user_model
-from django.utils import timezone
-from rest_framework import permissions, serializers
-from reversion import revisions as reversion
+from django.db import IntegrityError, transaction
+from rest_framework import serializers
 
+from .fields import (TemplatedHyperlinkedIdentityField,
+                     TemplatedHyperlinkedRelatedField)
 from .models import Relation, Variant
+from .versions import current_version_id
 
 
 class CurrentVersionMixin(object):
 
     def get_current_version(self, obj):
         """
-        Return current version ID for non-edit methods, otherwise 'Unknown'.
+        Return the current version ID, from the object's stored pointer.
 
-        When editing, a new version will be created by django-reversion.
-        However, due to transaction timing the ID for this new Version hasn't
-        yet been generated and stored by the time the response for the editing
-        API call is generated. Rather than return the old, incorrect ID, we
-        simply report 'Unknown' for editing API calls.
+        The pointer is updated when a django-reversion revision is committed,
+        which API edits do before their response is generated, so edit
+        responses report the ID of the Version they just created.
 
-        An editing app will need to perform a new GET request to get the new
-        version ID for the object.
+        Objects saved without a pointer fall back to a lookup. Views
+        serializing many objects put a map of current version IDs, keyed by
+        model then object ID, in the serializer context as 'current_versions';
+        if present, that's used instead of a query.
         """
-        if self.context['request'].method in permissions.SAFE_METHODS:
-            return reversion.get_for_date(obj, timezone.now()).id
-        else:
-            return 'Unknown'
+        if obj.current_version_id is not None:
+            return obj.current_version_id
+        current_versions = self.context.get('current_versions', {})
+        if obj.__class__ in current_versions:
+            return current_versions[obj.__class__].get(obj.pk)
+        return current_version_id(obj)
 
 
 class SafeTagCurrentVersionUpdateMixin(object):
@@ -39,8 +41,7 @@ class SafeTagCurrentVersionUpdateMixin(object):
         edit is being made to a stale version of the model.
         """
         edited_version = self.context['request'].data['edited_version']
-        current_version = reversion.get_for_date(
-            instance, timezone.now()).id
+        current_version = current_version_id(instance)
         if not current_version == edited_version:
             raise serializers.ValidationError(detail={
                 'detail':
@@ -71,6 +72,17 @@ class SafeTagCurrentVersionUpdateMixin(object):
                         tag, instance.tags[tag], tag_data[tag])})
         return tag_data
 
+    def validate_tags_edit(self, instance, tags):
+        """
+        Validate tag data for an edit to instance, and return it.
+
+        For bulk edits, which check versions themselves and don't go through
+        update. Raises a ValidationError if the tags are invalid, or change
+        special tags.
+        """
+        tag_data = self.fields['tags'].run_validation(tags)
+        return self._check_tag_data(instance, {'tags': tag_data})
+
     def update(self, instance, validated_data):
         """
         Update tags. Accept edit to current version, check protected tags.
@@ -129,13 +141,15 @@ class RelationSerializer(CurrentVersionMixin,
     PATCH update will update any tags included in the request tag data. If
     special tags are listed, their values must be unchanged.
     """
+    serializer_url_field = TemplatedHyperlinkedIdentityField
     current_version = serializers.SerializerMethodField()
-    variant = serializers.HyperlinkedRelatedField(
+    variant = TemplatedHyperlinkedRelatedField(
         queryset=Variant.objects.all(), view_name='variant-detail',
         required=False)
 
     class Meta:
         model = Relation
+        fields = ('url', 'current_version', 'tags', 'variant')
 
     def create(self, validated_data):
         """
@@ -170,19 +184,20 @@ class VariantSerializer(CurrentVersionMixin,
     PATCH update will update any tags included in the request tag data. If
     special tags are listed, their values must be unchanged.
     """
+    serializer_url_field = TemplatedHyperlinkedIdentityField
     b37_id = serializers.SerializerMethodField()
     current_version = serializers.SerializerMethodField()
     relation_set = RelationSerializer(many=True, required=False)
 
     class Meta:
         model = Variant
+        fields = ('url', 'b37_id', 'current_version', 'relation_set', 'tags')
 
     @staticmethod
     def get_b37_id(obj):
         """
         Return an ID like "b37-1-883516-G-A".
         """
-        print obj.tags
         return '-'.join([
             'b37',
             obj.tags['chrom_b37'],
@@ -191,6 +206,27 @@ class VariantSerializer(CurrentVersionMixin,
             obj.tags['var_allele_b37'],
         ])
 
+    @staticmethod
+    def validate_new_tags(tags):
+        """
+        Check tag data for a new Variant, and return its build 37 key.
+        """
+        for tag in Variant.required_tags:
+            if tag not in tags:
+                raise serializers.ValidationError(detail={
+                    'detail': 'Create (POST) tag data must include all '
+                    'required tags: {}'.format(Variant.required_tags)})
+            if (tag == 'chrom_b37' and tags[tag] not in
+                    Variant.ALLOWED_CHROMS):
+                raise serializers.ValidationError(detail={
+                    'detail': 'Chromosomes must be numbers: "1", "2", '
+                    '"3"... and "23" for X, "24" for Y, and "25" for MT.'})
+        try:
+            return Variant.b37_key_from_tags(tags)
+        except ValueError:
+            raise serializers.ValidationError(detail={
+                'detail': 'Positions must be positive integers.'})
+
     def create(self, validated_data):
         """
         Check that all required tags are included in tag data before creating.
@@ -200,22 +236,16 @@ class VariantSerializer(CurrentVersionMixin,
                 'detail': "Create (POST) should include the 'tags' field."
                 "Your request contains the following "
                 'fields: {}'.format(str(validated_data.keys()))})
-        for tag in Variant.required_tags:
-            if tag not in validated_data['tags']:
-                raise serializers.ValidationError(detail={
-                    'detail': 'Create (POST) tag data must include all '
-                    'required tags: {}'.format(Relation.required_tags)})
-            if (tag == 'chrom_b37' and validated_data['tags'][tag] not
-                    in Variant.ALLOWED_CHROMS):
-                raise serializers.ValidationError(detail={
-                    'detail': 'Chromosomes must be numbers: "1", "2", '
-                    '"3"... and "23" for X, "24" for Y, and "25" for MT.'})
+        b37_key = self.validate_new_tags(validated_data['tags'])
+        duplicate_error = serializers.ValidationError(detail={
+            'detail': 'A variant for the following data already '
+                      'exists: {}'.format(validated_data['tags'])})
         if Variant.objects.filter(
-                tags__chrom_b37=validated_data['tags']['chrom_b37'],
-                tags__pos_b37=validated_data['tags']['pos_b37'],
-                tags__ref_allele_b37=validated_data['tags']['ref_allele_b37'],
-                tags__var_allele_b37=validated_data['tags']['var_allele_b37']):
-            raise serializers.ValidationError(detail={
-                'detail': 'A variant for the following data already '
-                          'exists: {}'.format(validated_data['tags'])})
-        return super(VariantSerializer, self).create(validated_data)
+                **Variant.b37_filter_kwargs(b37_key)).exists():
+            raise duplicate_error
+        # The unique index catches a concurrent create of the same variant.
+        try:
+            with transaction.atomic():
+                return super(VariantSerializer, self).create(validated_data)
+        except IntegrityError:
+            raise duplicate_error
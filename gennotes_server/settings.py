@@ -93,7 +93,6 @@ AUTHENTICATION_BACKENDS = [
 MIDDLEWARE_CLASSES = (
     'sslify.middleware.SSLifyMiddleware',
     'corsheaders.middleware.CorsMiddleware',
-    'reversion.middleware.RevisionMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
     'django.middleware.csrf.CsrfViewMiddleware',
@@ -143,6 +142,39 @@ elif dj_database_url.config():
 
 PSQL_USER_IS_SUPERUSER = to_bool('PSQL_USER_IS_SUPERUSER', 'True')
 
+# The 'api' cache holds serialized Variant and Relation data for API reads.
+# Writes invalidate entries in the cache they can reach, so it must be shared
+# by every process serving the API: set API_CACHE_BACKEND and
+# API_CACHE_LOCATION, e.g. for memcached. It's disabled (a dummy cache) if
+# they aren't set. Tests use a local memory cache, which is only suitable for
+# a single process.
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    },
+    'api': {
+        'BACKEND': os.getenv('API_CACHE_BACKEND',
+                             'django.core.cache.backends.dummy.DummyCache'),
+        'LOCATION': os.getenv('API_CACHE_LOCATION', 'gennotes-api'),
+        'TIMEOUT': int(os.getenv('API_CACHE_TIMEOUT', '3600')),
+        'OPTIONS': {
+            'MAX_ENTRIES': int(os.getenv('API_CACHE_MAX_ENTRIES', '100000')),
+        },
+    },
+}
+
+# Event streams (/api/events/) each hold a worker thread while open, so each
+# process serves at most this many, and answers more with a 503. Keep it
+# below the gunicorn thread count in the Procfile, so API requests still get
+# threads.
+EVENT_STREAMS_PER_PROCESS = int(os.getenv('EVENT_STREAMS_PER_PROCESS', '4'))
+
+# Variant tag keys that get their own expression index, for fast key=value
+# filtering. Set as a comma-separated list, then run 'index_hot_tags'.
+HOT_VARIANT_TAG_KEYS = [
+    key.strip() for key in os.getenv('HOT_VARIANT_TAG_KEYS', '').split(',')
+    if key.strip()]
+
 # Internationalization
 # https://docs.djangoproject.com/en/1.8/topics/i18n/
 
@@ -209,6 +241,8 @@ OAUTH2_PROVIDER = {
                'commit-edit': ('Can commit changes to GenNotes Variants '
                                'and Relations on your behalf.')},
     'REQUEST_APPROVAL_PROMPT': 'auto',
+    'OAUTH2_VALIDATOR_CLASS':
+        'gennotes_server.oauth2_validators.CachedOAuth2Validator',
 }
 
 # Settings for CORS (in dev)
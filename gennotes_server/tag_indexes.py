@@ -0,0 +1,116 @@
+"""
+Expression indexes for "hot" Variant tag keys.
+
+All Variant tags are covered by the GIN index on the hstore column (migration
+0009), which answers key existence (?) and containment (@>) queries. Keys
+listed in the HOT_VARIANT_TAG_KEYS setting can also get a btree index on the
+expression (tags -> 'key'), which is smaller and more selective for
+key=value lookups on frequently searched keys such as 'rsid'. These indexes
+are created and dropped by the 'index_hot_tags' management command.
+"""
+import hashlib
+import re
+
+from django.conf import settings
+from django.db import connection
+
+from .models import Variant
+
+# The tag key format recommended in the models docstring. Hot keys are used in
+# index names, so they're held to it.
+TAG_KEY_RE = re.compile(r'^[a-z][a-z0-9]*(_[a-z0-9]+)*$')
+INDEX_PREFIX = 'gennotes_server_variant_tag_'
+INDEX_SUFFIX = '_idx'
+# Postgres truncates longer identifiers.
+MAX_INDEX_NAME_LENGTH = 63
+# The key in an index expression, as shown by pg_get_expr.
+INDEX_KEY_RE = re.compile(r"^\(tags -> '(.*)'::text\)$")
+TAG_VALUE_SQL = '"{}"."tags" -> %s'.format(Variant._meta.db_table)
+
+
+def hot_tag_keys():
+    """
+    Return the set of hot tag keys configured in settings.
+    """
+    return set(getattr(settings, 'HOT_VARIANT_TAG_KEYS', []))
+
+
+def index_name(key):
+    """
+    Return the name of a hot tag key's index.
+
+    Keys too long for the name to fit in MAX_INDEX_NAME_LENGTH are shortened,
+    with a hash of the whole key appended to keep names distinct.
+    """
+    if not TAG_KEY_RE.match(key):
+        raise ValueError('Hot tag key "{}" must match the pattern {}'.format(
+            key, TAG_KEY_RE.pattern))
+    name = INDEX_PREFIX + key + INDEX_SUFFIX
+    if len(name) > MAX_INDEX_NAME_LENGTH:
+        digest = hashlib.md5(key).hexdigest()[:8]
+        length = (MAX_INDEX_NAME_LENGTH - len(INDEX_PREFIX) -
+                  len(INDEX_SUFFIX) - len(digest) - 1)
+        name = INDEX_PREFIX + key[:length] + '_' + digest + INDEX_SUFFIX
+    return name
+
+
+def existing_indexes():
+    """
+    Return a dict mapping hot tag keys to the names of their valid indexes.
+
+    Keys are read from the indexes' expressions, as shortened names don't
+    contain the whole key. An index left invalid by a failed CREATE INDEX
+    CONCURRENTLY isn't used by queries, so it isn't included.
+    """
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'SELECT cls.relname, pg_get_expr(idx.indexprs, idx.indrelid) '
+            'FROM pg_index idx '
+            'JOIN pg_class cls ON cls.oid = idx.indexrelid '
+            'WHERE idx.indrelid = %s::regclass AND idx.indisvalid '
+            'AND cls.relname LIKE %s',
+            [Variant._meta.db_table, INDEX_PREFIX.replace('_', r'\_') + '%'])
+        rows = cursor.fetchall()
+    indexes = {}
+    for name, expression in rows:
+        match = INDEX_KEY_RE.match(expression or '')
+        if match:
+            indexes[match.group(1)] = name
+    return indexes
+
+
+def create_index(key):
+    """
+    Build the expression index for a key without locking out writes.
+
+    Any invalid index left for the key by a failed build is dropped first.
+    CREATE INDEX CONCURRENTLY can't run in a transaction, so this must be
+    called in autocommit mode.
+    """
+    drop_index(index_name(key))
+    with connection.cursor() as cursor:
+        cursor.execute(
+            'CREATE INDEX CONCURRENTLY "{name}" '
+            'ON "{table}" ((tags -> \'{key}\'))'.format(
+                name=index_name(key), table=Variant._meta.db_table, key=key))
+
+
+def drop_index(name):
+    with connection.cursor() as cursor:
+        cursor.execute('DROP INDEX CONCURRENTLY IF EXISTS "{}"'.format(name))
+
+
+def filter_tag_value(queryset, key, value):
+    """
+    Filter Variants to those with the tag key=value.
+
+    All keys use hstore containment, which the GIN index serves. Hot keys
+    are also compared as (tags -> 'key') = 'value', the expression their
+    btree index is on, so either index can be used: queries stay indexed if
+    a key is made hot before its index is built.
+    """
+    queryset = queryset.filter(tags__contains={key: value})
+    if key in hot_tag_keys():
+        queryset = queryset.extra(where=[TAG_VALUE_SQL + ' = %s'],
+                                  params=[key, value])
+    return queryset
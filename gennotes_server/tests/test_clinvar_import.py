@@ -0,0 +1,545 @@
+import json
+import logging
+import os
+import time
+from unittest import skipIf
+from xml.etree import ElementTree
+
+from django.contrib.auth import get_user_model
+from django.core.management import call_command
+from django.db import connection, transaction
+from reversion import revisions as reversion
+from reversion.models import Revision
+
+from gennotes_server import clinvar_staging
+from gennotes_server.clinvar_import import (AccessionIndex,
+                                            CompactAccessionIndex,
+                                            CompactVariantIndex,
+                                            FieldExtractor, VariantIndex,
+                                            chunks, element_texts,
+                                            first_attribute, first_findtext,
+                                            first_text, ordered_pool_map,
+                                            update_relation_tags)
+from gennotes_server.models import Relation, Variant
+from gennotes_server.versions import save_revision_bulk
+
+from test_helpers import APITestCase
+
+try:
+    from gennotes_server.management.commands import add_clinvar_data
+except ImportError:
+    # add_clinvar_data needs vcf2clinvar, which the server itself doesn't.
+    add_clinvar_data = None
+
+CLINVAR_DATA_DIR = os.path.join(os.path.dirname(__file__), 'clinvar_data')
+
+# Sample ClinVar files, with the fixture's variants and RCVA records (one of
+# them changed since) and some new ones.
+CLINVAR_VCF = os.path.join(CLINVAR_DATA_DIR, 'clinvar_20160401.vcf')
+CLINVAR_XML = os.path.join(CLINVAR_DATA_DIR, 'ClinVarFullRelease_2016-04.xml')
+
+NEW_VARIANT_KEYS = [(1, 977028, 'G', 'A'), (1, 977028, 'G', 'T'),
+                    (2, 1000, 'C', 'T'), (23, 2000, 'A', 'G')]
+
+
+def b37_key(variant):
+    return (variant.chrom_b37, variant.pos_b37, variant.ref_allele_b37,
+            variant.var_allele_b37)
+
+
+def delayed_square(number):
+    # Later items in each run of five finish first.
+    time.sleep(0.01 * (5 - number % 5))
+    return number * number
+
+
+class ClinVarIndexTests(APITestCase):
+    """
+    Test the importer's indexes of variants and RCV accessions.
+    """
+
+    def test_compact_variant_index(self):
+        """
+        Test CompactVariantIndex finds and adds variants as VariantIndex does.
+        """
+        index = VariantIndex()
+        compact_index = CompactVariantIndex()
+        index.load_existing()
+        compact_index.load_existing()
+        self.assertEqual(len(compact_index), 10)
+        self.assertEqual(len(compact_index), len(index))
+
+        # Existing variants' handles are their IDs.
+        var_key = ('1', '883516', 'G', 'A')
+        self.assertEqual(compact_index.add(var_key), 1)
+        self.assertEqual(compact_index.variant_id(compact_index.add(var_key)),
+                         index.variant_id(index.add(var_key)))
+
+        # New variants are added once each.
+        var_keys = [tuple(str(value) for value in key)
+                    for key in NEW_VARIANT_KEYS[:2]]
+        handles = [compact_index.add(var_key) for var_key in var_keys]
+        self.assertEqual(handles, [-1, -2])
+        self.assertEqual(compact_index.add(var_keys[0]), -1)
+        self.assertEqual(compact_index.num_new(), 2)
+        self.assertEqual(len(compact_index), 12)
+
+        for variants in compact_index.new_variant_chunks(1):
+            self.assertEqual(len(variants), 1)
+            for variant in variants:
+                variant.save()
+        for var_key, handle in zip(var_keys, handles):
+            variant = Variant.objects.get(id=compact_index.variant_id(handle))
+            self.assertEqual(variant.tags, dict(zip(
+                ['chrom_b37', 'pos_b37', 'ref_allele_b37', 'var_allele_b37'],
+                var_key)))
+
+    def test_compact_accession_index(self):
+        """
+        Test CompactAccessionIndex finds unique handles as AccessionIndex does.
+        """
+        additions = [('RCV000116253', 10), ('RCV000116253', 10),
+                     ('RCV000200003', -1), ('RCV000200003', 13),
+                     ('SCV000000010', 5)]
+        for index in [AccessionIndex(), CompactAccessionIndex()]:
+            for rcv_acc, handle in additions:
+                index.add(rcv_acc, handle)
+            self.assertIn('RCV000116253', index)
+            self.assertNotIn('RCV000116254', index)
+            self.assertEqual(index.unique_handle('RCV000116253'), 10)
+            # An accession reported for more than one variant.
+            self.assertIsNone(index.unique_handle('RCV000200003'))
+            # Accessions that aren't RCV numbers are kept as given.
+            self.assertIn('SCV000000010', index)
+            self.assertEqual(index.unique_handle('SCV000000010'), 5)
+
+
+class ClinVarParsingTests(APITestCase):
+    """
+    Test the helpers for parsing ClinVar XML in worker processes.
+    """
+
+    def test_field_extractor(self):
+        """
+        Test fields are extracted from the elements on their paths.
+        """
+        element = ElementTree.fromstring(
+            '<Set><A Type="x"><B>1</B><C Id="c1"/></A>'
+            '<A Type="y"><B>2</B><B>3</B><C Id="c2"><D>d</D></C></A>'
+            '<E/></Set>')
+        extractor = FieldExtractor([
+            ('constant', None, lambda matches: 'value'),
+            ('first-b', 'A/B', first_text),
+            ('all-b', 'A/B', lambda matches: ','.join(
+                match[-1].text for match in matches)),
+            ('y-b', 'A[@Type="y"]/B', first_text),
+            ('y-type', 'A[@Type="y"]/B', first_attribute('Type', level=-2)),
+            ('y-d', 'A[@Type="y"]/C', first_findtext('D')),
+            ('c-id', 'A/C', first_attribute('Id')),
+            ('num-e', 'E', lambda matches: str(len(matches))),
+            # Empty or missing values are left out.
+            ('e-text', 'E', first_text),
+            ('missing', 'A/F', first_text),
+        ])
+        self.assertEqual(extractor.extract(element), {
+            'constant': 'value', 'first-b': '1', 'all-b': '1,2,3',
+            'y-b': '2', 'y-type': 'y', 'y-d': 'd', 'c-id': 'c1',
+            'num-e': '1'})
+        self.assertRaises(ValueError, FieldExtractor,
+                          [('bad', 'A//B', first_text)])
+
+    def test_ordered_pool_map(self):
+        """
+        Test results are yielded in the order of the items.
+        """
+        self.assertEqual(list(ordered_pool_map(delayed_square, range(20), 3)),
+                         [number * number for number in range(20)])
+        self.assertEqual(list(ordered_pool_map(delayed_square, [], 3)), [])
+
+    def test_element_texts(self):
+        """
+        Test ClinVarSets are split from the XML's lines, in chunks.
+        """
+        with open(CLINVAR_XML) as clinvar_xml:
+            texts = list(element_texts(clinvar_xml, 'ClinVarSet'))
+        self.assertEqual(len(texts), 14)
+        self.assertTrue(texts[0].startswith('<ClinVarSet ID="1">'))
+        self.assertTrue(texts[-1].endswith('</ClinVarSet>\n'))
+        self.assertEqual([len(chunk) for chunk in chunks(texts, 5)],
+                         [5, 5, 4])
+
+
+class ClinVarStagingTests(APITestCase):
+    """
+    Test the importer's staging tables and the SQL run against them.
+    """
+
+    def staged_variants(self, ids):
+        return [b37_key(variant) for variant in
+                Variant.objects.filter(id__in=ids).order_by('id')]
+
+    def test_copy_value(self):
+        """
+        Test values are escaped for COPY's text format.
+        """
+        self.assertEqual(clinvar_staging._copy_value(None), r'\N')
+        self.assertEqual(clinvar_staging._copy_value(u'\\N'), u'\\\\N')
+        self.assertEqual(clinvar_staging._copy_value(976629), u'976629')
+        self.assertEqual(
+            clinvar_staging._copy_value(u'a\tb\nc\rd\\e'),
+            u'a\\tb\\nc\\rd\\\\e')
+        # Array items are quoted, then escaped like any other text.
+        self.assertEqual(
+            clinvar_staging._copy_value([u'RCV1', u'a "b"', u'c\\d']),
+            u'{"RCV1","a \\\\"b\\\\"","c\\\\\\\\d"}')
+
+    def test_copy_stream(self):
+        """
+        Test CopyStream reads rows as lines of COPY text, in any size.
+        """
+        rows = [(1, u'caf\xe9', None), (2, u'a\tb', [u'x', u'y'])]
+        data = '1\tcaf\xc3\xa9\t\\N\n2\ta\\tb\t{"x","y"}\n'
+        self.assertEqual(clinvar_staging.CopyStream(rows).read(), data)
+        stream = clinvar_staging.CopyStream(rows)
+        chunks = iter(lambda: stream.read(4), '')
+        self.assertEqual(''.join(chunks), data)
+
+    def test_copy_round_trip(self):
+        """
+        Test copied values are read back as given, including nulls.
+        """
+        values = [None, u'\\N', u'tab\there', u'new\nline\r',
+                  u'back\\slash', u'caf\xe9']
+        with connection.cursor() as cursor:
+            cursor.execute('CREATE TEMPORARY TABLE copy_test '
+                           '(seq serial, value text, items text[])')
+            clinvar_staging._copy('copy_test', ('value', 'items'),
+                                  [(value, [value or u'', u'"x",{y}'])
+                                   for value in values])
+            cursor.execute('SELECT value, items FROM copy_test ORDER BY seq')
+            self.assertEqual(cursor.fetchall(),
+                             [(value, [value or u'', u'"x",{y}'])
+                              for value in values])
+
+    def test_staging(self):
+        """
+        Test new variants and relations, and changed relations, are written.
+        """
+        clinvar_staging.create_staging_tables()
+        clinvar_staging.copy_alleles([
+            ((1, 883516, 'G', 'A'), ['RCV000064926']),
+            ((1, 891344, 'G', 'A'), ['RCV000064927']),
+            ((1, 977028, 'G', 'A'), ['RCV000200001']),
+            ((1, 977028, 'G', 'T'), ['RCV000200002', 'RCV000200003']),
+            ((1, 977028, 'G', 'A'), ['RCV000200001']),
+            ((2, 1000, 'C', 'T'), ['RCV000200003'])])
+
+        # New variants are added once each, in order of appearance.
+        ids = clinvar_staging.insert_new_variants(2)
+        self.assertEqual(self.staged_variants(ids), [
+            (1, 977028, 'G', 'A'), (1, 977028, 'G', 'T')])
+        ids = clinvar_staging.insert_new_variants(10)
+        self.assertEqual(self.staged_variants(ids), [(2, 1000, 'C', 'T')])
+        self.assertEqual(Variant.objects.get(id=ids[0]).tags, {
+            'chrom_b37': '2', 'pos_b37': '1000', 'ref_allele_b37': 'C',
+            'var_allele_b37': 'T'})
+        self.assertEqual(clinvar_staging.insert_new_variants(10), [])
+
+        tags = {relation.id: relation.tags for relation in
+                Relation.objects.filter(id__in=[8, 9])}
+        new_tags = {
+            'type': 'clinvar-rcva', 'clinvar-rcva:accession': 'RCV000200001',
+            'clinvar-rcva:significance': 'Pathogenic'}
+        clinvar_staging.copy_rcvas([
+            ('RCV000064926', dict(tags[8], **{
+                'clinvar-rcva:significance': 'Benign'})),
+            ('RCV000064927', dict(tags[9], **{
+                'clinvar-rcva:significance': 'Benign'})),
+            ('RCV000200001', new_tags),
+            ('RCV000200001', dict(new_tags, **{
+                'clinvar-rcva:significance': 'Benign'})),
+            ('RCV000200002', dict(new_tags, **{
+                'clinvar-rcva:accession': 'RCV000200002'})),
+            # Reported for two variants.
+            ('RCV000200003', dict(new_tags, **{
+                'clinvar-rcva:accession': 'RCV000200003'})),
+            # Not in the VCF.
+            ('RCV000300000', dict(new_tags, **{
+                'clinvar-rcva:accession': 'RCV000300000'}))])
+
+        # New relations use an accession's first record.
+        ids = clinvar_staging.insert_new_relations(1)
+        self.assertEqual(len(ids), 1)
+        relation = Relation.objects.get(id=ids[0])
+        self.assertEqual(relation.tags, new_tags)
+        self.assertEqual(b37_key(relation.variant), (1, 977028, 'G', 'A'))
+        ids = clinvar_staging.insert_new_relations(10)
+        self.assertEqual(
+            [Relation.objects.get(id=rel_id).tags['clinvar-rcva:accession']
+             for rel_id in ids], ['RCV000200002'])
+        self.assertEqual(clinvar_staging.insert_new_relations(10), [])
+
+        # Changed relations are updated in ID order, keeping other tags.
+        Relation.objects.filter(id=9).update(
+            tags=dict(tags[9], comment='A comment.'))
+        tag_keys = tags[8].keys()
+        self.assertEqual(
+            clinvar_staging.update_changed_relations(tag_keys, 0, 1), [8])
+        self.assertEqual(
+            clinvar_staging.update_changed_relations(tag_keys, 8, 1), [9])
+        self.assertEqual(
+            clinvar_staging.update_changed_relations(tag_keys, 9, 1), [])
+        self.assertEqual(Relation.objects.get(id=8).tags, dict(tags[8], **{
+            'clinvar-rcva:significance': 'Benign'}))
+        self.assertEqual(Relation.objects.get(id=9).tags, dict(tags[9], **{
+            'clinvar-rcva:significance': 'Benign', 'comment': 'A comment.'}))
+        self.assertEqual(
+            clinvar_staging.update_changed_relations(tag_keys, 0, 10), [])
+
+        clinvar_staging.drop_staging_tables()
+
+
+class SaveRevisionBulkTests(APITestCase):
+    """
+    Test recording objects' versions in bulk.
+    """
+
+    def version_data(self, revision):
+        return list(revision.version_set.order_by('object_id_int').values_list(
+            'content_type', 'object_id', 'object_id_int', 'format',
+            'serialized_data', 'object_repr'))
+
+    def test_save_revision_bulk(self):
+        """
+        Test save_revision_bulk records what reversion's save_revision does.
+        """
+        user = get_user_model().objects.get(username='clinvar-data-importer')
+        relations = list(Relation.objects.filter(
+            id__in=[1, 2]).order_by('id'))
+        for relation in relations:
+            relation.tags['clinvar-rcva:version'] = '3'
+
+        with transaction.atomic(), reversion.create_revision():
+            reversion.set_user(user)
+            reversion.set_comment('Update versions.')
+            for relation in relations:
+                relation.save()
+        revision = Revision.objects.latest('id')
+
+        for relation in relations:
+            relation.save()
+        bulk_revision = save_revision_bulk(relations, user=user,
+                                           comment='Update versions.')
+        self.assertGreater(bulk_revision.id, revision.id)
+        self.assertEqual(
+            (bulk_revision.manager_slug, bulk_revision.user,
+             bulk_revision.comment),
+            (revision.manager_slug, revision.user, revision.comment))
+        self.assertEqual(self.version_data(bulk_revision),
+                         self.version_data(revision))
+
+        # Both point the objects at their new versions.
+        version_ids = dict(bulk_revision.version_set.values_list(
+            'object_id_int', 'id'))
+        self.assertEqual(len(version_ids), 2)
+        for relation in relations:
+            self.assertEqual(relation.current_version_id,
+                             version_ids[relation.id])
+            self.assertEqual(
+                Relation.objects.get(id=relation.id).current_version_id,
+                version_ids[relation.id])
+
+
+@skipIf(add_clinvar_data is None, 'vcf2clinvar is not installed')
+class AddClinVarDataTests(APITestCase):
+    """
+    Test the add_clinvar_data command, importing the sample ClinVar files.
+    """
+
+    def setUp(self):
+        super(AddClinVarDataTests, self).setUp()
+        # The command logs its progress.
+        logging.disable(logging.INFO)
+
+    def tearDown(self):
+        logging.disable(logging.NOTSET)
+
+    def history(self, obj):
+        """
+        Return (comment, tags) for each of an object's versions.
+        """
+        versions = list(reversion.get_for_object(obj).order_by('id'))
+        self.assertEqual(obj.current_version_id, versions[-1].id)
+        history = []
+        for version in versions:
+            tags = version.field_dict['tags']
+            # Relation tags are serialized as a JSON string.
+            if isinstance(tags, basestring):
+                tags = json.loads(tags)
+            history.append((version.revision.comment, tags))
+        return history
+
+    def import_sample(self, **options):
+        """
+        Import the sample files, and return the resulting data.
+
+        The import is rolled back after, so a test can compare several. IDs
+        aren't, so Variants are given by b37 key, and Relations by accession.
+        """
+        savepoint = transaction.savepoint()
+        try:
+            call_command('add_clinvar_data', local_vcf=CLINVAR_VCF,
+                         local_xml=CLINVAR_XML, **options)
+            variant_keys = {variant.id: b37_key(variant) for
+                            variant in Variant.objects.all()}
+            return {
+                'variants': {
+                    b37_key(variant): self.history(variant) for
+                    variant in Variant.objects.all()},
+                'relations': {
+                    relation.tags['clinvar-rcva:accession']: (
+                        variant_keys[relation.variant_id],
+                        self.history(relation)) for
+                    relation in Relation.objects.all()},
+            }
+        finally:
+            transaction.savepoint_rollback(savepoint)
+
+    def test_rcva_tags(self):
+        """
+        Test RCVA tags are extracted as the RCVA_DATA functions extract them.
+        """
+        command = add_clinvar_data.Command()
+        clinvar_xml = command._open(CLINVAR_XML)
+        clinvar_sets = list(command._get_elements(clinvar_xml, 'ClinVarSet'))
+        clinvar_xml.close()
+        self.assertEqual(len(clinvar_sets), 14)
+        for clinvar_set in clinvar_sets:
+            tags = command._rcva_tags(clinvar_set)
+            expected = command._lambda_rcva_tags(clinvar_set)
+            if add_clinvar_data.ET.__name__ != 'lxml.etree':
+                # ElementTree can't find the ESP XRef's parent, so its
+                # function never finds the allele frequency.
+                tags.pop('clinvar-rcva:esp-allele-frequency', None)
+            self.assertEqual(tags, expected)
+        self.assertEqual(
+            command._rcva_tags(clinvar_sets[10])[
+                'clinvar-rcva:esp-allele-frequency'], '0.000076886')
+
+    def test_update_relations(self):
+        """
+        Test changed relations' tags are merged, written and recorded.
+        """
+        tags = {relation.id: relation.tags for relation in
+                Relation.objects.filter(id__in=[2, 4])}
+        user = get_user_model().objects.get(username='clinvar-data-importer')
+        add_clinvar_data.Command()._update_relations(
+            [(4, {'clinvar-rcva:significance': 'Likely benign'}),
+             (2, {'clinvar-rcva:version': '3',
+                  'clinvar-rcva:citations': 'PMID22859821'})],
+            user=user, comment='Update relations.')
+
+        revision = Revision.objects.latest('id')
+        self.assertEqual((revision.user, revision.comment),
+                         (user, 'Update relations.'))
+        expected_tags = {
+            4: dict(tags[4], **{'clinvar-rcva:significance': 'Likely benign'}),
+            2: dict(tags[2], **{'clinvar-rcva:version': '3',
+                                'clinvar-rcva:citations': 'PMID22859821'})}
+        for relation in Relation.objects.filter(id__in=[2, 4]):
+            self.assertEqual(relation.tags, expected_tags[relation.id])
+            history = self.history(relation)
+            self.assertEqual(len(history), 2)
+            self.assertEqual(history[-1],
+                             ('Update relations.', relation.tags))
+            self.assertEqual(relation.current_version.revision, revision)
+
+        # Tags are written as given, with one query.
+        relations = list(Relation.objects.filter(id__in=[2, 4]))
+        for relation in relations:
+            relation.tags = {'type': 'note', 'id': str(relation.id)}
+        with self.assertNumQueries(1):
+            update_relation_tags(relations)
+        with self.assertNumQueries(0):
+            update_relation_tags([])
+        self.assertEqual(
+            dict(Relation.objects.filter(id__in=[2, 4]).values_list(
+                'id', 'tags')),
+            {2: {'type': 'note', 'id': '2'}, 4: {'type': 'note', 'id': '4'}})
+
+    def test_import(self):
+        """
+        Test importing adds new variants and records, and updates changed ones.
+        """
+        data = self.import_sample()
+        self.assertEqual(len(data['variants']), 14)
+        for var_key in NEW_VARIANT_KEYS:
+            self.assertEqual(data['variants'][var_key], [(
+                'Variant added based on presence in ClinVar VCF file: '
+                'clinvar_20160401.vcf',
+                dict(zip(['chrom_b37', 'pos_b37', 'ref_allele_b37',
+                          'var_allele_b37'],
+                         [str(value) for value in var_key])))])
+
+        # RCV000200003 is reported for two variants, and RCV000300000 isn't
+        # in the VCF, so they're skipped.
+        self.assertEqual(len(data['relations']), 12)
+        var_key, history = data['relations']['RCV000200001']
+        self.assertEqual(var_key, (1, 977028, 'G', 'A'))
+        self.assertEqual(len(history), 1)
+        self.assertEqual(history[0][0], 'Relation added based on presence '
+                         'in ClinVar XML file: ClinVarFullRelease_2016-04.xml')
+        self.assertEqual(
+            history[0][1]['clinvar-rcva:citations'],
+            'PMID22859821;PMID25326637')
+        self.assertEqual(data['relations']['RCV000200002'][0],
+                         (1, 977028, 'G', 'T'))
+
+        # Only the changed record is updated.
+        for rcv_acc, (var_key, history) in data['relations'].items():
+            self.assertEqual(len(history),
+                             2 if rcv_acc == 'RCV000116282' else 1)
+        history = data['relations']['RCV000116282'][1]
+        self.assertEqual(
+            history[1][0], 'Relation updated based on updated data detected '
+            'in ClinVar XML file: ClinVarFullRelease_2016-04.xml')
+        self.assertEqual(
+            dict(set(history[1][1].items()) - set(history[0][1].items())),
+            {'clinvar-rcva:significance': 'Likely benign',
+             'clinvar-rcva:version': '2',
+             'clinvar-rcva:num-submissions': '2'})
+
+    def test_import_compact_index(self):
+        """
+        Test importing with '--compact-index' gives the same results.
+        """
+        self.assertEqual(self.import_sample(compact_index=True),
+                         self.import_sample())
+
+    def test_import_bulk(self):
+        """
+        Test importing with '--bulk' gives the same results.
+        """
+        self.assertEqual(self.import_sample(bulk=True), self.import_sample())
+
+    def test_import_workers(self):
+        """
+        Test importing with '--workers' gives the same results.
+        """
+        batch_size = add_clinvar_data.XML_BATCH_SIZE
+        # Small batches, so each worker parses several.
+        add_clinvar_data.XML_BATCH_SIZE = 2
+        try:
+            self.assertEqual(self.import_sample(workers=3),
+                             self.import_sample())
+            self.assertEqual(self.import_sample(staging=True, workers=3),
+                             self.import_sample())
+        finally:
+            add_clinvar_data.XML_BATCH_SIZE = batch_size
+
+    def test_import_staging(self):
+        """
+        Test importing with '--staging' gives the same results.
+        """
+        self.assertEqual(self.import_sample(staging=True),
+                         self.import_sample())
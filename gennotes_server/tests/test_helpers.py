@@ -1,11 +1,24 @@
 import json
 import logging
 
+from django.conf import settings
+from django.core.management.color import no_style
+from django.db import connection
+from django.test import override_settings
 from rest_framework.test import APITestCase as BaseAPITestCase
+from reversion.models import Revision, Version
+
+from gennotes_server import api_cache
+from gennotes_server.models import Relation, Variant
 
 logger = logging.getLogger(__name__)
 
 
+# Tests run in one process, so a local memory API cache is enough.
+@override_settings(CACHES=dict(settings.CACHES, api={
+    'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+    'LOCATION': 'gennotes-api-tests',
+}))
 class APITestCase(BaseAPITestCase):
     """
     A helper for writing tests.
@@ -13,6 +26,16 @@ class APITestCase(BaseAPITestCase):
     base_path = ''
     fixtures = ['gennotes_server/fixtures/test-data.json']
 
+    def setUp(self):
+        # Cached data would outlive the database rollback after each test.
+        api_cache.get_cache().clear()
+        # So would sequences. Reset them, so new objects and versions get
+        # the IDs expected in responses.
+        with connection.cursor() as cursor:
+            for sql in connection.ops.sequence_reset_sql(
+                    no_style(), [Variant, Relation, Revision, Version]):
+                cursor.execute(sql)
+
     def verify_request(self, path, method='get',
                        expected_status=200, expected_data=None,
                        **kwargs):
@@ -1,5 +1,19 @@
+from cStringIO import StringIO
+import datetime
 import json
 import logging
+import shutil
+import tempfile
+
+from allauth.account.models import EmailAddress
+from django.conf import settings
+from django.test import override_settings
+from django.utils.timezone import utc
+
+from gennotes_server.events import broker
+from gennotes_server.management.commands import sync_changes
+from gennotes_server.models import ChangeFeedSync, Relation, Variant
+from gennotes_server.permissions import email_verified
 
 from test_helpers import APITestCase
 
@@ -16,6 +30,21 @@ ERR_VAR_INC = {'detail': "Edits must update the 'tags' field of a Variant or "
 logger = logging.getLogger(__name__)
 
 
+class FeedSyncCommand(sync_changes.Command):
+    """
+    A sync_changes command reading changes from a list, not a server.
+    """
+
+    def __init__(self, feed):
+        super(FeedSyncCommand, self).__init__(stdout=StringIO())
+        self.feed = feed
+        self.since = None
+
+    def _changes(self, source, since, page_size):
+        self.since = since
+        return [change for change in self.feed if change['revision'] > since]
+
+
 class RelationTests(APITestCase):
     """
     Test the Relation API.
@@ -44,6 +73,50 @@ class RelationTests(APITestCase):
         self.verify_request(path='/', method='get',
                             expected_data=expected_data, expected_status=200)
 
+    def test_get_relation_list_cursor(self):
+        """
+        Test walking the Relation list with cursor pagination.
+        """
+        response = self.verify_request(path='/', method='get',
+                                       expected_status=200,
+                                       data={'cursor': '', 'page_size': 4})
+        self.assertNotIn('count', response.data)
+        urls = [r['url'] for r in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            self.assertEqual(response.status_code, 200)
+            urls += [r['url'] for r in response.data['results']]
+        self.assertEqual(
+            urls, ['http://testserver/api/relation/{}/'.format(i)
+                   for i in range(1, 11)])
+
+        self.verify_request(path='/', method='get', expected_status=404,
+                            data={'cursor': 'not-a-cursor'})
+
+    def test_get_relation_list_tags(self):
+        """
+        Test filtering the Relation list by tag containment.
+        """
+        response = self.verify_request(
+            path='/', method='get', expected_status=200,
+            data={'tags': json.dumps({
+                'clinvar-rcva:significance': 'Pathogenic'})})
+        self.assertEqual(
+            [r['url'] for r in response.data['results']],
+            ['http://testserver/api/relation/{}/'.format(i)
+             for i in [5, 6, 7]])
+
+        response = self.client.get('/api/relation/', [
+            ('tags', json.dumps({'type': 'clinvar-rcva'})),
+            ('tags', json.dumps({'clinvar-rcva:gene-symbol': 'AGRN'})),
+            ('tags', json.dumps({'clinvar-rcva:significance': 'Benign'}))])
+        self.assertEqual(
+            [r['url'] for r in response.data['results']],
+            ['http://testserver/api/relation/4/'])
+
+        self.verify_request(path='/', method='get', expected_status=400,
+                            data={'tags': '["not", "an", "object"]'})
+
     def test_post_relation(self):
         """
         Test creating a new Relation.
@@ -164,7 +237,7 @@ class RelationTests(APITestCase):
                        "edited_version": 11}
         good_data_2 = {"tags": {"type": "clinvar-rcva",
                                 "comment": "All other tags preserved."},
-                       "edited_version": 22}
+                       "edited_version": 21}
         bad_data_1 = {"tags": {"type": "clinvar-rcva",
                                "comment": "All other tags preserved."},
                       "variant": "http://testserver/api/variant/10/",
@@ -202,8 +275,218 @@ class RelationTests(APITestCase):
                             data=good_data_1, format='json')
 
         # Test good request ('type' tag included and unchanged).
+        expected_data['current_version'] = 22
         self.verify_request(path='/1/', method='patch',
                             expected_data=expected_data, expected_status=200,
                             data=good_data_2, format='json')
 
         self.client.logout()
+
+    def test_patch_relation_email_verified(self):
+        """
+        Test edits need a verified email, and confirmation is seen at once.
+        """
+        data = {"tags": {"comment": "All other tags preserved."},
+                "edited_version": 11}
+        self.client.login(username='testuser', password='password')
+        email = EmailAddress.objects.get(user__username='testuser')
+
+        email.verified = False
+        email.save()
+        self.verify_request(path='/1/', method='patch', expected_status=403,
+                            data=data, format='json')
+
+        email.verified = True
+        email.save()
+        self.verify_request(path='/1/', method='patch', expected_status=200,
+                            data=data, format='json')
+        # The test cache is local to this process, so it isn't used.
+        user = email.user
+        with self.assertNumQueries(1):
+            self.assertTrue(email_verified(user))
+
+        # With a shared cache, verification status is cached, and changes to
+        # it invalidate it.
+        cache_dir = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, cache_dir)
+        with override_settings(CACHES=dict(settings.CACHES, api={
+                'BACKEND':
+                    'django.core.cache.backends.filebased.FileBasedCache',
+                'LOCATION': cache_dir})):
+            self.assertTrue(email_verified(user))
+            with self.assertNumQueries(0):
+                self.assertTrue(email_verified(user))
+            email.verified = False
+            email.save()
+            self.verify_request(path='/1/', method='patch',
+                                expected_status=403, data=data,
+                                format='json')
+
+        self.client.logout()
+
+    def test_get_relation_history(self):
+        """
+        Test paging through a Relation's versions and their tag changes.
+        """
+        self.client.login(username='testuser', password='password')
+        self.verify_request(path='/1/', method='patch', expected_status=200,
+                            data={'tags': {'comment': 'A comment.'},
+                                  'edited_version': 11,
+                                  'commit-comment': 'Add comment.'},
+                            format='json')
+        self.client.logout()
+
+        response = self.verify_request(path='/1/history/', method='get',
+                                       expected_status=200,
+                                       data={'page_size': 1})
+        first = response.data['results'][0]
+        self.assertEqual((first['id'], first['revision'], first['user']),
+                         (11, 2, 'clinvar-data-importer'))
+        self.assertEqual(first['tags_diff']['added']['type'], 'clinvar-rcva')
+        self.assertEqual(len(first['tags_diff']['added']), 12)
+
+        response = self.client.get(response.data['next'])
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['next'], None)
+        latest = response.data['results'][0]
+        self.assertEqual(
+            (latest['id'], latest['user'], latest['comment'],
+             latest['deleted']),
+            (21, 'testuser', 'Add comment.', False))
+        self.assertEqual(latest['tags_diff'],
+                         {'added': {'comment': 'A comment.'},
+                          'changed': {}, 'removed': {}})
+
+        self.verify_request(path='/99/history/', method='get',
+                            expected_status=404)
+
+    def test_get_changes(self):
+        """
+        Test the change feed lists edits and deletions after a revision.
+        """
+        self.client.login(username='testuser', password='password')
+        self.verify_request(path='/1/', method='patch', expected_status=200,
+                            data={'tags': {'comment': 'A comment.'},
+                                  'edited_version': 11},
+                            format='json')
+        self.verify_request(path='/2/', method='delete', expected_status=204,
+                            data={'edited_version': 12}, format='json')
+        self.client.logout()
+
+        response = self.client.get('/api/changes/', {'since': 2})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response.data['next'], None)
+        self.assertEqual(
+            [(c['revision'], c['type'], c['id'], c['version'], c['action'],
+              c['user'], c['variant']) for c in response.data['results']],
+            [(3, 'relation', 1, 21, 'updated', 'testuser', 10),
+             (4, 'relation', 2, 22, 'deleted', 'testuser', 7)])
+        self.assertEqual(response.data['results'][0]['tags']['comment'],
+                         'A comment.')
+
+        # Paging through all changes, from the fixture's revisions on.
+        response = self.client.get('/api/changes/', {'page_size': 15})
+        changes = response.data['results']
+        self.assertEqual((changes[0]['type'], changes[0]['id'],
+                          changes[0]['action']), ('variant', 1, 'created'))
+        response = self.client.get(response.data['next'])
+        changes += response.data['results']
+        self.assertEqual(len(changes), 22)
+        self.assertEqual(changes[-1]['version'], 22)
+
+        response = self.client.get('/api/changes/', {'since': 'latest'})
+        self.assertEqual(response.status_code, 400)
+
+    def test_sync_changes(self):
+        """
+        Test sync_changes applies a change feed with the source's IDs.
+        """
+        change = {'date': '2016-04-01T12:00:00Z', 'user': 'someone'}
+        feed = [
+            dict(change, revision=40, comment='Add a variant.',
+                 type='variant', id=30, version=90, action='created',
+                 tags={'chrom_b37': '1', 'pos_b37': '100',
+                       'ref_allele_b37': 'A', 'var_allele_b37': 'G'}),
+            dict(change, revision=40, comment='Add a variant.',
+                 type='relation', id=30, version=91, action='created',
+                 tags={'type': 'note'}, variant=30),
+            dict(change, revision=41, comment='Edit relations.',
+                 type='relation', id=1, version=92, action='updated',
+                 tags={'type': 'note', 'comment': 'Replaced.'}, variant=10),
+            dict(change, revision=41, comment='Edit relations.',
+                 type='relation', id=2, version=93, action='deleted',
+                 tags={'type': 'clinvar-rcva'}, variant=7),
+        ]
+        command = FeedSyncCommand(feed)
+        command.handle('https://source.example.com/')
+        self.assertEqual(command.since, 0)
+
+        variant = Variant.objects.get(id=30)
+        self.assertEqual((variant.chrom_b37, variant.pos_b37), (1, 100))
+        revision = variant.current_version.revision
+        self.assertEqual(revision.comment, 'Add a variant.')
+        self.assertEqual(revision.date_created,
+                         datetime.datetime(2016, 4, 1, 12, tzinfo=utc))
+        relation = Relation.objects.get(id=30)
+        self.assertEqual(relation.variant_id, 30)
+        self.assertEqual(relation.current_version.revision_id, revision.id)
+        relation = Relation.objects.get(id=1)
+        self.assertEqual(relation.tags['comment'], 'Replaced.')
+        self.assertEqual(relation.current_version.revision.comment,
+                         'Edit relations.')
+        self.assertFalse(Relation.objects.filter(id=2).exists())
+        self.assertEqual(ChangeFeedSync.objects.get(
+            source='https://source.example.com').last_revision, 41)
+
+        # Local creates get IDs after the replayed ones.
+        self.assertEqual(Relation.objects.create(
+            variant_id=1, tags={'type': 'note'}).id, 31)
+        self.assertEqual(Variant.objects.create(tags={
+            'chrom_b37': '1', 'pos_b37': '200', 'ref_allele_b37': 'A',
+            'var_allele_b37': 'G'}).id, 31)
+
+        # A second run continues from the last revision applied.
+        command = FeedSyncCommand(feed)
+        command.handle('https://source.example.com')
+        self.assertEqual(command.since, 41)
+        self.assertIn('Applied 0 revisions', command.stdout._out.getvalue())
+
+    def test_get_events_since(self):
+        """
+        Test the event stream first sends events missed since Last-Event-ID.
+        """
+        self.client.login(username='testuser', password='password')
+        self.verify_request(path='/1/', method='patch', expected_status=200,
+                            data={'tags': {'comment': 'A comment.'},
+                                  'edited_version': 11,
+                                  'commit-comment': 'Add comment.'},
+                            format='json')
+        self.client.logout()
+
+        response = self.client.get('/api/events/', HTTP_LAST_EVENT_ID='2')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        event = next(response.streaming_content).split('\n')
+        # Close the test client's wrapper of the stream, rather than the
+        # response: it keeps the finished request from closing the test's
+        # database connection.
+        response._iterator.close()
+        self.assertEqual(broker.streams, 0)
+        self.assertEqual(event[:2], ['id: 3', 'event: change'])
+        data = json.loads(event[2][len('data: '):])
+        self.assertEqual(
+            (data['type'], data['id'], data['version'], data['action'],
+             data['user'], data['comment']),
+            ('relation', 1, 21, 'updated', 'testuser', 'Add comment.'))
+
+        response = self.client.get('/api/events/', HTTP_LAST_EVENT_ID='x')
+        self.assertEqual(response.status_code, 400)
+
+    def test_get_events_over_stream_limit(self):
+        """
+        Test event streams past the per-process limit are refused.
+        """
+        with override_settings(EVENT_STREAMS_PER_PROCESS=0):
+            response = self.client.get('/api/events/')
+        self.assertEqual(response.status_code, 503)
+        self.assertEqual(response['Retry-After'], '15')
@@ -1,5 +1,16 @@
+from base64 import urlsafe_b64encode
+from cStringIO import StringIO
+import gzip
 import json
 
+from django.contrib.contenttypes.models import ContentType
+from django.core.management import call_command
+from django.test import TransactionTestCase, override_settings
+from reversion.models import Version
+
+from gennotes_server import api_cache, tag_indexes
+from gennotes_server.models import Relation, Variant
+
 from test_helpers import APITestCase
 
 ERR_NO_DELETE = {'detail': 'Method "DELETE" not allowed.'}
@@ -54,6 +65,61 @@ class VariantTests(APITestCase):
                             data=good_data, format='json')
         self.client.logout()
 
+    def test_post_variant_bulk(self):
+        """
+        Test bulk Variant POST, creating new variants in one revision.
+        """
+        new_tags = {'chrom_b37': '1', 'pos_b37': '123456',
+                    'ref_allele_b37': 'A', 'var_allele_b37': 'G'}
+        data = {'variants': [
+            {'tags': new_tags},
+            {'tags': {'chrom_b37': '1', 'pos_b37': '883516',
+                      'ref_allele_b37': 'G', 'var_allele_b37': 'A'}},
+            {'tags': new_tags},
+            {'tags': dict(new_tags, chrom_b37='1AF')}]}
+        expected_data = {
+            'results': [
+                {'b37_id': 'b37-1-123456-A-G', 'id': 11, 'created': True},
+                {'b37_id': 'b37-1-883516-G-A', 'id': 1, 'created': False},
+                {'b37_id': 'b37-1-123456-A-G', 'id': 11, 'created': True}],
+            'errors': [{'index': 3, 'detail': ERR_BAD_CHR['detail']}]}
+
+        self.verify_request(path='/bulk/', method='post',
+                            expected_data=ERR_NOAUTH, expected_status=401,
+                            data=data, format='json')
+
+        self.client.login(username='testuser', password='password')
+        self.verify_request(path='/bulk/', method='post',
+                            expected_data=expected_data, expected_status=201,
+                            data=data, format='json')
+        self.client.logout()
+
+        response = self.verify_request(path='/b37-1-123456-A-G/',
+                                       method='get')
+        self.assertEqual(response.data['current_version'], 21)
+
+    def test_post_duplicate_variant(self):
+        """
+        Test Variant POST for a variant that already exists.
+        """
+        duplicate_data = {'tags': {'chrom_b37': '1', 'pos_b37': '883516',
+                                   'ref_allele_b37': 'G',
+                                   'var_allele_b37': 'A'}}
+        bad_pos_data = {'tags': {'chrom_b37': '1', 'pos_b37': '88x516',
+                                 'ref_allele_b37': 'G', 'var_allele_b37': 'A'}}
+
+        self.client.login(username='testuser', password='password')
+        self.verify_request(path='/', method='post',
+                            expected_status=400,
+                            data=duplicate_data, format='json')
+        self.verify_request(path='/', method='post',
+                            expected_data={
+                                'detail': 'Positions must be positive '
+                                          'integers.'},
+                            expected_status=400,
+                            data=bad_pos_data, format='json')
+        self.client.logout()
+
     def test_delete_variant(self):
         """
         Test Variant DELETE responses.
@@ -82,6 +148,12 @@ class VariantTests(APITestCase):
         self.verify_request(path='/b37-1-883516-G-A/', method='get',
                             expected_data=expected_data, expected_status=200)
 
+        # Look up by build 37 information that doesn't match a variant.
+        self.verify_request(path='/b37-1-883516-G-T/', method='get',
+                            expected_status=404)
+        self.verify_request(path='/b37-1-883x16-G-A/', method='get',
+                            expected_status=404)
+
     def test_get_specified_variant_list(self):
         """
         Test getting data for a specified list of Variants.
@@ -97,6 +169,101 @@ class VariantTests(APITestCase):
                             expected_data=expected_data, expected_status=200,
                             data=data)
 
+    def test_get_variant_region(self):
+        """
+        Test getting Variants overlapping build 37 regions, sorted by position.
+        """
+        response = self.verify_request(
+            path='/', method='get', expected_status=200,
+            data={'region': ['1:976,000-977,000', 'chr1:900000-949600']})
+        self.assertEqual(
+            [v['b37_id'] for v in response.data['results']],
+            ['b37-1-906168-G-A', 'b37-1-949523-C-T', 'b37-1-976629-C-T',
+             'b37-1-976963-A-G'])
+
+        self.verify_request(path='/', method='get', expected_status=400,
+                            data={'region': '1:950000'})
+        self.verify_request(path='/', method='get', expected_status=400,
+                            data={'region': '1:1-2000000000'})
+
+    def test_get_variant_tags(self):
+        """
+        Test filtering Variants by tag key and by key=value tags.
+        """
+        response = self.verify_request(
+            path='/', method='get', expected_status=200,
+            data={'has_tag': 'pos_b37', 'tag': 'ref_allele_b37=C'})
+        self.assertEqual(
+            sorted(v['b37_id'] for v in response.data['results']),
+            ['b37-1-949523-C-T', 'b37-1-949696-C-CG', 'b37-1-957640-C-T',
+             'b37-1-976629-C-T'])
+
+        response = self.verify_request(path='/', method='get',
+                                       expected_status=200,
+                                       data={'has_tag': 'rsid'})
+        self.assertEqual(response.data['results'], [])
+
+        with self.settings(HOT_VARIANT_TAG_KEYS=['pos_b37']):
+            response = self.verify_request(
+                path='/', method='get', expected_status=200,
+                data={'tag': ['pos_b37=883516', 'var_allele_b37=A']})
+        self.assertEqual([v['b37_id'] for v in response.data['results']],
+                         ['b37-1-883516-G-A'])
+
+        self.verify_request(path='/', method='get', expected_status=400,
+                            data={'tag': 'rsid'})
+
+    def test_post_variant_lookup(self):
+        """
+        Test bulk lookup of a POSTed list of Variants.
+        """
+        with open('gennotes_server/tests/expected_data/variant.json') as f:
+            expected_variant = json.load(f)
+        data = {'variant_list': ['b37-1-883516-G-A', '1', 'b37-1-1-A-G',
+                                 'not-a-variant', '99999']}
+
+        response = self.verify_request(path='/lookup/', method='post',
+                                       expected_status=200,
+                                       data=data, format='json')
+        self.assertEqual(response.data['results'],
+                         {'b37-1-883516-G-A': expected_variant,
+                          '1': expected_variant})
+        self.assertEqual(response.data['not_found'],
+                         ['b37-1-1-A-G', 'not-a-variant', '99999'])
+
+        # List filters in the query string don't apply to lookups.
+        response = self.verify_request(path='/lookup/?has_tag=missing',
+                                       method='post', expected_status=200,
+                                       data={'variant_list': ['2']},
+                                       format='json')
+        self.assertEqual(list(response.data['results']), ['2'])
+
+        self.verify_request(path='/lookup/', method='post',
+                            expected_status=400,
+                            data={'variant_list': 'b37-1-883516-G-A'},
+                            format='json')
+
+    def test_get_variant_list_cursor(self):
+        """
+        Test walking the Variant list by position with cursor pagination.
+        """
+        response = self.verify_request(
+            path='/', method='get', expected_status=200,
+            data={'cursor': '', 'page_size': 3, 'ordering': 'position'})
+        b37_ids = [v['b37_id'] for v in response.data['results']]
+        while response.data['next']:
+            response = self.client.get(response.data['next'])
+            self.assertEqual(response.status_code, 200)
+            b37_ids += [v['b37_id'] for v in response.data['results']]
+        self.assertEqual(len(b37_ids), 10)
+        self.assertEqual(b37_ids[:2], ['b37-1-883516-G-A', 'b37-1-891344-G-A'])
+        self.assertEqual(b37_ids[-1], 'b37-1-976963-A-G')
+
+        # A cursor with a value of the wrong type is invalid.
+        self.verify_request(
+            path='/', method='get', expected_status=404,
+            data={'cursor': urlsafe_b64encode(json.dumps(['x']))})
+
     def test_get_variant_list(self):
         """
         Test getting full list of Variant data.
@@ -108,6 +275,198 @@ class VariantTests(APITestCase):
         self.verify_request(path='/', method='get',
                             expected_data=expected_data, expected_status=200)
 
+    def test_get_variant_list_num_queries(self):
+        """
+        Test Variant list and detail queries don't grow with result size.
+        """
+        # Page count, variants, and their prefetched relations.
+        for page_size in [2, 10]:
+            with self.assertNumQueries(3):
+                response = self.verify_request(
+                    path='/', method='get', expected_status=200,
+                    data={'page_size': page_size})
+            self.assertEqual(len(response.data['results']), page_size)
+        # Resolving the b37 ID, the variant and its relations, then cached.
+        with self.assertNumQueries(3):
+            self.verify_request(path='/b37-1-883516-G-A/', method='get',
+                                expected_status=200)
+        with self.assertNumQueries(0):
+            self.verify_request(path='/b37-1-883516-G-A/', method='get',
+                                expected_status=200)
+
+    def test_get_variant_etag(self):
+        """
+        Test conditional Variant GET with the ETag of the current version.
+        """
+        response = self.verify_request(path='/b37-1-883516-G-A/',
+                                       method='get', expected_status=200)
+        etag = response['ETag']
+
+        response = self.verify_request(path='/b37-1-883516-G-A/',
+                                       method='get', expected_status=304,
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response['ETag'], etag)
+
+        # Editing a nested relation changes the variant's ETag.
+        self.client.login(username='testuser', password='password')
+        self.client.patch('/api/relation/8/',
+                          data={'tags': {'test_tag': 'test_value'},
+                                'edited_version': 18}, format='json')
+        self.client.logout()
+        response = self.verify_request(path='/b37-1-883516-G-A/',
+                                       method='get', expected_status=200,
+                                       HTTP_IF_NONE_MATCH=etag)
+        self.assertNotEqual(response['ETag'], etag)
+
+    def test_get_variant_as_of(self):
+        """
+        Test getting Variants as they were at a time, deletions included.
+        """
+        with open('gennotes_server/tests/expected_data/variant.json') as f:
+            expected_data = json.load(f)
+
+        self.client.login(username='testuser', password='password')
+        response = self.client.delete('/api/relation/8/',
+                                      data={'edited_version': 18},
+                                      format='json')
+        self.assertEqual(response.status_code, 204)
+        self.client.logout()
+
+        response = self.verify_request(path='/1/', method='get',
+                                       expected_status=200)
+        self.assertEqual(response.data['relation_set'], [])
+
+        # Before the deletion, and before the Relation was added.
+        self.verify_request(path='/1/', method='get',
+                            expected_data=expected_data, expected_status=200,
+                            data={'as_of': '2016-01-01'})
+        response = self.verify_request(
+            path='/b37-1-883516-G-A/', method='get', expected_status=200,
+            data={'as_of': '2015-07-04T20:41:00Z'})
+        self.assertEqual(response.data['relation_set'], [])
+
+        # Before the Variant was added.
+        self.verify_request(path='/1/', method='get', expected_status=404,
+                            data={'as_of': '2015-07-01'})
+        self.verify_request(path='/1/', method='get', expected_status=400,
+                            data={'as_of': 'yesterday'})
+
+        response = self.verify_request(
+            path='/lookup/', method='post', expected_status=200,
+            data={'variant_list': ['1', '2'], 'as_of': '2016-01-01'},
+            format='json')
+        self.assertEqual(response.data['results']['1'], expected_data)
+        self.assertEqual(response.data['not_found'], [])
+        response = self.verify_request(
+            path='/lookup/', method='post', expected_status=200,
+            data={'variant_list': ['1', '2'], 'as_of': '2015-07-01'},
+            format='json')
+        self.assertEqual(response.data['not_found'], ['1', '2'])
+
+    def test_get_variant_cached(self):
+        """
+        Test Variant GET responses are cached until the variant changes.
+        """
+        api_cache.reset_stats()
+        response = self.verify_request(path='/1/', method='get',
+                                       expected_status=200)
+        self.verify_request(path='/1/', method='get', expected_status=200,
+                            expected_data=response.data)
+        self.assertEqual(api_cache.get_stats(), {'hits': 1, 'misses': 1})
+
+        self.client.login(username='testuser', password='password')
+        self.client.patch('/api/variant/1/',
+                          data={'tags': {'test_tag': 'test_value'},
+                                'edited_version': 1}, format='json')
+        self.client.logout()
+        response = self.verify_request(path='/1/', method='get',
+                                       expected_status=200)
+        self.assertEqual(response.data['current_version'], 21)
+        self.assertEqual(response.data['tags']['test_tag'], 'test_value')
+
+    def test_get_variant_export(self):
+        """
+        Test streaming the NDJSON export of variants and relations.
+        """
+        response = self.client.get('/api/variant/export/')
+        self.assertEqual(response.status_code, 200)
+        content = ''.join(response.streaming_content)
+        variants = [json.loads(line) for line in content.splitlines()]
+        self.assertEqual([v['id'] for v in variants], range(1, 11))
+        self.assertEqual(variants[0]['b37_id'], 'b37-1-883516-G-A')
+        self.assertEqual(variants[0]['current_version'], 1)
+        self.assertEqual([r['id'] for r in variants[0]['relation_set']], [8])
+
+        response = self.client.get('/api/variant/export/', {'chrom': '2'})
+        self.assertEqual(''.join(response.streaming_content), '')
+
+        response = self.client.get('/api/variant/export/',
+                                   {'relation_type': 'clinvar-rcva'},
+                                   HTTP_ACCEPT_ENCODING='gzip')
+        self.assertEqual(response['Content-Encoding'], 'gzip')
+        gzipped = StringIO(''.join(response.streaming_content))
+        self.assertEqual(gzip.GzipFile(fileobj=gzipped).read(), content)
+
+        # Objects saved without a current_version pointer get their latest.
+        Variant.objects.update(current_version=None)
+        Relation.objects.update(current_version=None)
+        response = self.client.get('/api/variant/export/')
+        self.assertEqual(''.join(response.streaming_content), content)
+
+    def test_patch_variant_bulk(self):
+        """
+        Test bulk Variant PATCH, applying valid edits in one revision.
+        """
+        data = {'commit-comment': 'Bulk edit test.',
+                'edits': [
+                    {'id': 1, 'edited_version': 1,
+                     'tags': {'test_tag': 'test_value'}},
+                    {'id': 2, 'edited_version': 1,
+                     'tags': {'test_tag': 'test_value'}},
+                    {'id': 3, 'edited_version': 3,
+                     'tags': {'chrom_b37': '2'}},
+                    {'id': 4, 'edited_version': 4,
+                     'tags': {'test_tag': 'test_value'}},
+                    {'id': 99, 'edited_version': 1,
+                     'tags': {'test_tag': 'test_value'}}]}
+        expected_errors = [
+                {'id': 2, 'current_version': 2,
+                 'detail': 'Edit conflict error! The current version for '
+                           'this object does not match the reported version '
+                           'being edited.'},
+                {'id': 3, 'detail': ERR_CHR_CHNG['detail']},
+                {'id': 99, 'detail': 'Not found.'}]
+
+        self.verify_request(path='/bulk/', method='patch',
+                            expected_data=ERR_NOAUTH, expected_status=401,
+                            data=data, format='json')
+
+        self.client.login(username='testuser', password='password')
+        response = self.verify_request(path='/bulk/', method='patch',
+                                       expected_status=200,
+                                       data=data, format='json')
+        self.client.logout()
+        self.assertEqual(response.data['errors'], expected_errors)
+        self.assertEqual([r['id'] for r in response.data['results']], [1, 4])
+        new_versions = Version.objects.filter(
+            id__in=[r['current_version'] for r in response.data['results']])
+        self.assertEqual(
+            set(new_versions.values_list('object_id_int', flat=True)),
+            set([1, 4]))
+        self.assertEqual(
+            len(set(new_versions.values_list('revision_id', flat=True))), 1)
+
+        response = self.verify_request(path='/4/', method='get')
+        self.assertEqual(response.data['tags']['test_tag'], 'test_value')
+
+        # JSON booleans aren't IDs.
+        self.client.login(username='testuser', password='password')
+        self.verify_request(path='/bulk/', method='patch',
+                            expected_status=400, format='json',
+                            data={'edits': [
+                                {'id': True, 'edited_version': 1,
+                                 'tags': {'test_tag': 'test_value'}}]})
+
     def test_put_variant(self):
         """
         Test Variant PUT responses.
@@ -223,3 +582,44 @@ class VariantTests(APITestCase):
                             data=good_data_2, format='json')
 
         self.client.logout()
+
+
+class HotTagIndexTests(TransactionTestCase):
+    """
+    Test the index_hot_tags command.
+
+    CREATE INDEX CONCURRENTLY can't run in a transaction, so these tests
+    aren't run in one.
+    """
+    long_key = 'clinvar_significance_as_reported_by_submitters'
+
+    def tearDown(self):
+        for name in tag_indexes.existing_indexes().values():
+            tag_indexes.drop_index(name)
+        # The database is flushed next, and permissions recreated. Cached
+        # content types from earlier tests would no longer exist.
+        ContentType.objects.clear_cache()
+
+    def test_index_hot_tags(self):
+        """
+        Test hot tag indexes are created once each, and dropped.
+        """
+        keys = ['rsid', self.long_key]
+        out = StringIO()
+        with override_settings(HOT_VARIANT_TAG_KEYS=keys):
+            call_command('index_hot_tags', stdout=out)
+            self.assertEqual(out.getvalue().count('Creating index'), 2)
+            existing = tag_indexes.existing_indexes()
+            self.assertEqual(existing, {key: tag_indexes.index_name(key)
+                                        for key in keys})
+            self.assertLessEqual(len(existing[self.long_key]),
+                                 tag_indexes.MAX_INDEX_NAME_LENGTH)
+
+            # Existing indexes, including the shortened name, are kept.
+            out = StringIO()
+            call_command('index_hot_tags', stdout=out)
+            self.assertEqual(out.getvalue(), '')
+
+        with override_settings(HOT_VARIANT_TAG_KEYS=['rsid']):
+            call_command('index_hot_tags', drop=True, stdout=StringIO())
+            self.assertEqual(tag_indexes.existing_indexes().keys(), ['rsid'])
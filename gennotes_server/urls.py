@@ -6,10 +6,12 @@ from django.views.generic import TemplateView
 
 from rest_framework import routers
 
-from .views import (CurrentUserView,
+from .views import (ChangeFeedView,
+                    CurrentUserView,
                     EditingAppRegistration,
                     EditingAppUpdate,
                     RelationViewSet,
+                    RevisionEventsView,
                     VariantViewSet)
 
 router = routers.DefaultRouter()
@@ -29,6 +31,8 @@ urlpatterns = [
 
     url(r'^api/', include(router.urls)),
     url(r'^api/me/$', CurrentUserView.as_view(), name='current-user'),
+    url(r'^api/changes/$', ChangeFeedView.as_view(), name='changes'),
+    url(r'^api/events/$', RevisionEventsView.as_view(), name='events'),
 
     url(r'^api-auth/', include('rest_framework.urls',
                                namespace='rest_framework')),
@@ -1,27 +1,106 @@
+from collections import OrderedDict
 import datetime
+import hashlib
 import json
 
 from django.contrib.auth import get_user_model
-from django.db import transaction
-from django.db.models import Q
-from django.http import Http404
+from django.db import connection, IntegrityError, transaction
+from django.http import (Http404, HttpResponse, HttpResponseBadRequest,
+                         StreamingHttpResponse)
+from django.middleware.gzip import re_accepts_gzip
 from django.shortcuts import get_object_or_404
+from django.utils import timezone
+from django.utils.cache import patch_vary_headers
+from django.utils.dateparse import parse_date, parse_datetime
+from django.utils.http import parse_etags, quote_etag
+from django.utils.text import compress_sequence
+from django.views.generic import View
 
 from oauth2_provider.views import (ApplicationRegistration,
                                    ApplicationUpdate)
 from oauth2_provider.ext.rest_framework import TokenHasScope
 
 import rest_framework
+from rest_framework import status
 from rest_framework import viewsets as rest_framework_viewsets
+from rest_framework.decorators import detail_route, list_route
 from rest_framework.generics import RetrieveAPIView
+from rest_framework.permissions import AllowAny
 from rest_framework.response import Response
+from rest_framework.views import APIView
 
 from reversion import revisions as reversion
 
+from . import api_cache
+from .events import HEARTBEAT_SECONDS, broker, event_stream
+from .export import export_lines
 from .forms import EditingAppRegistrationForm
-from .models import CommitDeletion, Relation, Variant, EditingApplication
+from .history import changes_since, objects_as_of, version_history
+from .models import (CommitDeletion, Relation, Variant, EditingApplication,
+                     reserve_ids)
+from .pagination import KeysetCursorPagination, PageNumberOrCursorPagination
 from .permissions import EditAuthorizedOrReadOnly
 from .serializers import RelationSerializer, UserSerializer, VariantSerializer
+from .tag_indexes import filter_tag_value
+from .utils import map_chrom_to_index
+from .versions import current_version_id, latest_version_ids
+
+
+# Build 37 span of a variant as a genome-wide int8range, matching the GiST
+# index in migration 0006. Chromosomes are offset by 10^9 (more than the
+# length of any chromosome) so a single range comparison checks both chromosome
+# and position, and indels overlapping a region's edges are found too.
+B37_SPAN_SQL = (
+    "int8range(chrom_b37::bigint * 1000000000 + pos_b37, "
+    "chrom_b37::bigint * 1000000000 + pos_b37 + "
+    "greatest(length(ref_allele_b37), 1), '[)')")
+B37_CHROM_OFFSET = 1000000000
+
+B37_ORDERING = ('chrom_b37', 'pos_b37', 'ref_allele_b37', 'var_allele_b37')
+
+# Maximum number of variants in a single bulk lookup request.
+BULK_LOOKUP_MAX = 50000
+BULK_EDIT_MAX = 10000
+
+
+def is_id(value):
+    """
+    Return True if a parsed JSON value is an integer ID (not a boolean).
+    """
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+def validation_error_detail(err):
+    """
+    Return the message of a ValidationError, for per-item bulk errors.
+    """
+    if isinstance(err.detail, dict) and 'detail' in err.detail:
+        return err.detail['detail']
+    return err.detail
+
+
+def parse_as_of(value):
+    """
+    Parse an 'as_of' parameter: an ISO 8601 date and time, or a date.
+
+    Times without a timezone are UTC, and a date means midnight (UTC) at its
+    start.
+    """
+    try:
+        as_of = parse_datetime(value)
+        if as_of is None:
+            day = parse_date(value)
+            if day is not None:
+                as_of = datetime.datetime.combine(day, datetime.time())
+    except (TypeError, ValueError):
+        as_of = None
+    if as_of is None:
+        raise rest_framework.serializers.ValidationError(detail={
+            'detail': "The 'as_of' parameter must be a date and time, e.g. "
+            "'2016-03-01T12:00:00Z', or a date, e.g. '2016-03-01'."})
+    if timezone.is_naive(as_of):
+        as_of = timezone.make_aware(as_of, timezone.utc)
+    return as_of
 
 
 class VariantLookupMixin(object):
@@ -29,51 +108,431 @@ class VariantLookupMixin(object):
     Mixin method for looking up a variant according to b37 position.
     """
 
+    @staticmethod
+    def _parse_region(region):
+        """
+        Parse a region string like "7:117,100,000-117,300,000".
+
+        Returns a (chrom, start, end) tuple of ints, with 1-based inclusive
+        coordinates. Raises a ValidationError if the region is invalid.
+        """
+        try:
+            chrom, span = region.replace(',', '').split(':')
+            start, end = [int(x) for x in span.split('-')]
+            chrom = int(map_chrom_to_index(chrom))
+        except ValueError:
+            raise rest_framework.serializers.ValidationError(detail={
+                'detail': "Regions should be formatted like "
+                "'7:117100000-117300000'. Invalid region: {}".format(region)})
+        if not 0 < start <= end:
+            raise rest_framework.serializers.ValidationError(detail={
+                'detail': 'Region start must be positive and no greater than '
+                'region end. Invalid region: {}'.format(region)})
+        # Positions are offset by chromosome in the span index, so larger
+        # ones would overlap the next chromosome's.
+        if end >= B37_CHROM_OFFSET:
+            raise rest_framework.serializers.ValidationError(detail={
+                'detail': 'Region end must be less than {}. Invalid '
+                'region: {}'.format(B37_CHROM_OFFSET, region)})
+        return chrom, start, end
+
+    def _filter_regions(self, queryset, regions):
+        """
+        Filter to variants overlapping any of the regions, sorted by position.
+        """
+        where = []
+        params = []
+        for region in regions:
+            chrom, start, end = self._parse_region(region)
+            where.append(B37_SPAN_SQL + " && int8range(%s, %s, '[]')")
+            params += [chrom * B37_CHROM_OFFSET + start,
+                       chrom * B37_CHROM_OFFSET + end]
+        return queryset.extra(
+            where=['(' + ' OR '.join(where) + ')'],
+            params=params).order_by(*B37_ORDERING)
+
     def _custom_variant_filter_kwargs(self, variant_lookup):
         """
         For a variant lookup string, return the variant filter arguments.
+
+        These filter on the typed build 37 columns, so a lookup is a single
+        probe of their unique index (see migration 0005).
         """
-        try:
-            parts = variant_lookup.split('-')
-            if parts[0] == 'b37':
-                return {
-                    'tags__chrom_b37': parts[1],
-                    'tags__pos_b37': parts[2],
-                    'tags__ref_allele_b37': parts[3],
-                    'tags__var_allele_b37': parts[4],
-                }
-        except IndexError:
+        b37_key = Variant.b37_key_from_id(variant_lookup)
+        if b37_key:
+            return Variant.b37_filter_kwargs(b37_key)
+        return None
+
+    def _resolve_variant_lookups(self, variant_lookups):
+        """
+        Return a dict mapping variant lookup strings to Variant primary keys.
+
+        Lookups may be primary keys or build 37 IDs. They're resolved with a
+        single query joining the variant table against the unnested lookup
+        arrays, so this scales to tens of thousands of lookups. Lookups that
+        don't match a variant are left out of the returned dict.
+        """
+        id_lookups, ids = [], []
+        b37_lookups, b37_keys = [], []
+        for variant_lookup in variant_lookups:
+            if variant_lookup.isdigit():
+                # Larger numbers can't be an integer primary key.
+                if int(variant_lookup) < 2 ** 31:
+                    id_lookups.append(variant_lookup)
+                    ids.append(int(variant_lookup))
+                continue
+            b37_key = Variant.b37_key_from_id(variant_lookup)
+            if b37_key:
+                b37_lookups.append(variant_lookup)
+                b37_keys.append(b37_key)
+        if not (ids or b37_keys):
+            return {}
+        chroms, positions, ref_alleles, var_alleles = (
+            [list(column) for column in zip(*b37_keys)] or [[], [], [], []])
+        with connection.cursor() as cursor:
+            cursor.execute(
+                'SELECT lookup.key, variant.id '
+                'FROM {table} AS variant JOIN unnest('
+                '%s::text[], %s::smallint[], %s::integer[], %s::text[], '
+                '%s::text[]) AS lookup(key, chrom, pos, ref, var) '
+                'ON variant.chrom_b37 = lookup.chrom '
+                'AND variant.pos_b37 = lookup.pos '
+                'AND variant.ref_allele_b37 = lookup.ref '
+                'AND variant.var_allele_b37 = lookup.var '
+                'UNION ALL '
+                'SELECT lookup.key, variant.id '
+                'FROM {table} AS variant JOIN unnest('
+                '%s::text[], %s::integer[]) AS lookup(key, id) '
+                'ON variant.id = lookup.id'.format(
+                    table=Variant._meta.db_table),
+                [b37_lookups, chroms, positions, ref_alleles, var_alleles,
+                 id_lookups, ids])
+            return dict(cursor.fetchall())
+
+
+class CurrentVersionMapMixin(object):
+    """
+    ViewSet mixin to look up current versions for a page of objects at once.
+
+    Objects normally store a pointer to their current version. For any that
+    don't, rather than the serializer querying django-reversion for each
+    object (and each nested relation), list, retrieve and lookup responses
+    load a map of latest Version IDs with one grouped query per model.
+
+    List and retrieve responses also get an ETag made from the current
+    versions of the objects (and nested relations) they contain. If it
+    matches the request's If-None-Match, a 304 is returned without
+    serializing anything.
+
+    Retrieve responses are served from the API cache (see api_cache) when
+    possible.
+    """
+    current_versions = None
+
+    def get_serializer_context(self):
+        context = super(CurrentVersionMapMixin, self).get_serializer_context()
+        if self.current_versions is not None:
+            context['current_versions'] = self.current_versions
+        return context
+
+    def load_current_versions(self, objects):
+        """
+        Store current Version IDs for objects, and relations of Variants.
+        """
+        model = self.queryset.model
+        self.current_versions = {model: latest_version_ids(
+            model, [obj.pk for obj in objects
+                    if obj.current_version_id is None])}
+        if model is Variant:
+            # Relations are prefetched with the variants, see get_queryset.
+            self.current_versions[Relation] = latest_version_ids(
+                Relation, [relation.pk for obj in objects
+                           for relation in obj.relation_set.all()
+                           if relation.current_version_id is None])
+
+    def get_versions(self, objects):
+        """
+        Return the current version IDs of objects (and Variant relations).
+
+        Returns None if any object lacks a current_version pointer.
+        """
+        versions = []
+        for obj in objects:
+            related = []
+            if isinstance(obj, Variant):
+                related = sorted((relation.pk, relation.current_version_id)
+                                 for relation in obj.relation_set.all())
+            if obj.current_version_id is None or any(
+                    version_id is None for _, version_id in related):
+                return None
+            versions.append([obj.pk, obj.current_version_id, related])
+        return versions
+
+    def get_version_etag(self, versions, *extra):
+        """
+        Return an ETag for a response containing data of these versions.
+
+        It's a hash of the versions (see get_versions), plus the requested URL
+        and media type, and any 'extra' data. There's no ETag if 'versions'
+        is None.
+        """
+        if versions is None:
             return None
+        state = [self.request.build_absolute_uri(),
+                 self.request.accepted_media_type, versions] + list(extra)
+        return hashlib.md5(json.dumps(state)).hexdigest()
+
+    def is_not_modified(self, etag):
+        """
+        Return True if the request's If-None-Match matches the ETag.
+        """
+        if_none_match = self.request.META.get('HTTP_IF_NONE_MATCH')
+        if etag is None or not if_none_match:
+            return False
+        etags = parse_etags(if_none_match)
+        return etag in etags or '*' in etags
+
+    def get_version_etag_response(self, etag, response):
+        """
+        Return 'response' with an ETag header, or a 304 if it's not modified.
+
+        'response' is a callable, so that data is only serialized if needed.
+        """
+        if self.is_not_modified(etag):
+            response = Response(status=status.HTTP_304_NOT_MODIFIED)
+        else:
+            response = response()
+        if etag is not None:
+            response['ETag'] = quote_etag(etag)
+        return response
+
+    def list(self, request, *args, **kwargs):
+        queryset = self.filter_queryset(self.get_queryset())
+        page = self.paginate_queryset(queryset)
+        objects = page if page is not None else list(queryset)
+        # Count and links of the page, without results.
+        envelope = (self.get_paginated_response([]).data
+                    if page is not None else None)
+        etag = self.get_version_etag(self.get_versions(objects), envelope)
+
+        def response():
+            self.load_current_versions(objects)
+            serializer = self.get_serializer(objects, many=True)
+            if page is not None:
+                return self.get_paginated_response(serializer.data)
+            return Response(serializer.data)
+        return self.get_version_etag_response(etag, response)
+
+    def get_cache_pk(self, lookup):
+        """
+        Return the pk of the object a detail lookup refers to, or None.
+        """
+        if lookup.isdigit():
+            return int(lookup)
         return None
 
+    def retrieve(self, request, *args, **kwargs):
+        model = self.queryset.model
+        base_url = request.build_absolute_uri('/')
+        pk = self.get_cache_pk(kwargs[self.lookup_url_kwarg or
+                                      self.lookup_field])
+        if 'as_of' in request.query_params:
+            as_of = parse_as_of(request.query_params['as_of'])
+            instance = objects_as_of(model, [pk], as_of).get(pk)
+            if instance is None:
+                raise Http404
+            return Response(self.get_serializer(instance).data)
+
+        found, generations = {}, {}
+        if pk is not None:
+            found, generations = api_cache.get_entries(model, [pk], base_url)
+
+        if pk in found:
+            data, versions = found[pk]['data'], found[pk]['versions']
+        else:
+            instance = self.get_object()
+            self.load_current_versions([instance])
+            data = OrderedDict(self.get_serializer(instance).data)
+            versions = self.get_versions([instance])
+            api_cache.set_entries(model, {instance.pk: (data, versions)},
+                                  generations, base_url)
+
+        etag = self.get_version_etag(versions)
+        return self.get_version_etag_response(etag, lambda: Response(data))
+
+
+class VersionHistoryMixin(object):
+    """
+    Add a 'history' detail route listing an object's versions.
+    """
+    @detail_route(methods=['get'])
+    def history(self, request, *args, **kwargs):
+        """
+        Return an object's versions, oldest first, with their tag changes.
+
+        Pages are walked with the 'cursor' parameter and 'next' links, as for
+        other listings, and each page is a single query. Deleted Relations
+        keep their history.
+        """
+        model = self.queryset.model
+        pk = self.get_cache_pk(kwargs[self.lookup_url_kwarg or
+                                      self.lookup_field])
+        if pk is None:
+            raise Http404
+
+        paginator = KeysetCursorPagination()
+        results = paginator.paginate_rows(
+            lambda position, limit: version_history(
+                model, pk, after=position and position[0], limit=limit),
+            request)
+        if not results and not request.query_params.get(
+                paginator.cursor_query_param):
+            raise Http404
+        return paginator.get_paginated_response(results)
+
 
 class RevisionUpdateMixin(object):
     """
     ViewSet mixin to record django-reversion revision, report current version.
+
+    Revisions are committed before the response data is generated, so
+    responses report the IDs of the Versions just created.
     """
-    @transaction.atomic()
-    @reversion.create_revision()
+
+    def get_queryset(self, *args, **kwargs):
+        """
+        Lock the object being edited, so version checks can't race.
+        """
+        queryset = super(RevisionUpdateMixin, self).get_queryset(
+            *args, **kwargs)
+        if self.request.method in ('PUT', 'PATCH', 'DELETE'):
+            queryset = queryset.select_for_update()
+        return queryset
+
     def update(self, request, *args, **kwargs):
         """
         Custom update method that records revisions and reports new version.
         """
         partial = kwargs.pop('partial', False)
-        instance = self.get_object()
-        serializer = self.get_serializer(instance,
-                                         data=request.data,
-                                         partial=partial,
-                                         context={'request': request})
-        serializer.is_valid(raise_exception=True)
-
-        commit_comment = self.request.data.get('commit-comment', '')
-        reversion.set_comment(comment=commit_comment)
-        reversion.set_user(user=self.request.user)
-        self.perform_update(serializer)
+        with transaction.atomic(), reversion.create_revision():
+            instance = self.get_object()
+            serializer = self.get_serializer(instance,
+                                             data=request.data,
+                                             partial=partial,
+                                             context={'request': request})
+            serializer.is_valid(raise_exception=True)
+
+            commit_comment = self.request.data.get('commit-comment', '')
+            reversion.set_comment(comment=commit_comment)
+            reversion.set_user(user=self.request.user)
+            self.perform_update(serializer)
 
         return Response(serializer.data)
 
+    def create(self, request, *args, **kwargs):
+        """
+        Custom create method that records revisions and reports new version.
+        """
+        with transaction.atomic(), reversion.create_revision():
+            serializer = self.get_serializer(data=request.data)
+            serializer.is_valid(raise_exception=True)
+
+            commit_comment = request.data.get('commit-comment', '')
+            reversion.set_user(user=self.request.user)
+            reversion.set_comment(comment=commit_comment)
+            self.perform_create(serializer)
+
+        headers = self.get_success_headers(serializer.data)
+        return Response(serializer.data, status=status.HTTP_201_CREATED,
+                        headers=headers)
+
+    @list_route(methods=['patch'])
+    def bulk(self, request):
+        """
+        Apply a list of PATCH-like tag edits in one transaction and revision.
+
+        'edits' is a list of objects with 'id', 'edited_version' and 'tags'.
+        The edited objects are locked and their versions checked with one
+        query. Edits that conflict or are invalid are skipped and reported in
+        'errors'; the others are applied, and reported in 'results' with the
+        ID of the version they created.
+        """
+        edits = request.data.get('edits', None)
+        if (not isinstance(edits, list) or not all(
+                isinstance(edit, dict) and
+                is_id(edit.get('id', None)) and
+                is_id(edit.get('edited_version', None)) and
+                'tags' in edit for edit in edits)):
+            raise rest_framework.serializers.ValidationError(detail={
+                'detail': "Bulk edits must include 'edits', a list of "
+                "objects with 'id', 'edited_version' and 'tags' fields."})
+        if len(edits) > BULK_EDIT_MAX:
+            raise rest_framework.serializers.ValidationError(detail={
+                'detail': 'Bulk edits are limited to {} objects per '
+                'request.'.format(BULK_EDIT_MAX)})
+        ids = [edit['id'] for edit in edits]
+        if len(set(ids)) < len(ids):
+            raise rest_framework.serializers.ValidationError(detail={
+                'detail': 'Bulk edits may only edit each object once.'})
+
+        model = self.queryset.model
+        serializer = self.get_serializer(partial=True)
+        edited = []
+        errors = []
+        with transaction.atomic(), reversion.create_revision():
+            # Rows are locked in ID order, so concurrent bulk edits of the
+            # same objects wait for each other rather than deadlocking.
+            instances = {
+                instance.pk: instance for instance in
+                model.objects.filter(id__in=ids).order_by(
+                    'id').select_for_update()}
+            unversioned = latest_version_ids(
+                model, [pk for pk, instance in instances.items()
+                        if instance.current_version_id is None])
+
+            for edit in edits:
+                instance = instances.get(edit['id'], None)
+                if instance is None:
+                    errors.append(OrderedDict([
+                        ('id', edit['id']), ('detail', 'Not found.')]))
+                    continue
+                current_version = (instance.current_version_id or
+                                   unversioned.get(instance.pk, None))
+                if current_version != edit['edited_version']:
+                    errors.append(OrderedDict([
+                        ('id', edit['id']),
+                        ('detail', 'Edit conflict error! The current version '
+                         'for this object does not match the reported '
+                         'version being edited.'),
+                        ('current_version', current_version)]))
+                    continue
+                try:
+                    tag_data = serializer.validate_tags_edit(
+                        instance, edit['tags'])
+                except rest_framework.serializers.ValidationError as err:
+                    errors.append(OrderedDict([
+                        ('id', edit['id']),
+                        ('detail', validation_error_detail(err))]))
+                    continue
+                instance.tags.update(tag_data)
+                instance.save()
+                edited.append(instance)
+
+            commit_comment = request.data.get('commit-comment', '')
+            reversion.set_comment(comment=commit_comment)
+            reversion.set_user(user=self.request.user)
+
+        # The revision has been committed, updating current versions.
+        results = [OrderedDict([('id', instance.pk),
+                                ('current_version',
+                                 instance.current_version_id)])
+                   for instance in edited]
+        return Response({'results': results, 'errors': errors})
+
 
 class VariantViewSet(VariantLookupMixin,
+                     CurrentVersionMapMixin,
+                     VersionHistoryMixin,
                      RevisionUpdateMixin,
                      rest_framework.mixins.RetrieveModelMixin,
                      rest_framework.mixins.ListModelMixin,
@@ -85,7 +544,8 @@ class VariantViewSet(VariantLookupMixin,
 
     In addition to lookup by primary key, Variants may be referenced by
     build 37 information (e.g. 'b37-1-123456-C-T'). Bulk GET requests can be
-    formed by specifying a list of variants as a parameter.
+    formed by specifying a list of variants as a parameter, or one or more
+    build 37 regions (results are then sorted by position).
 
     Uses django-reversion to record the revision, user, and commit comment.
 
@@ -95,32 +555,252 @@ class VariantViewSet(VariantLookupMixin,
     required_scopes = ['commit-edit']
     queryset = Variant.objects.all()
     serializer_class = VariantSerializer
+    pagination_class = PageNumberOrCursorPagination
+    cursor_orderings = {'id': ('id',), 'position': B37_ORDERING}
 
     def get_queryset(self, *args, **kwargs):
         """
         Return all variant data, or a subset if a specific list is requested.
+
+        The subset may also be restricted to variants overlapping one or more
+        build 37 regions, e.g. '?region=7:117100000-117300000', and by tags:
+        'has_tag' to variants with a tag key, e.g. '?has_tag=rsid', and 'tag'
+        to variants with a key=value tag, e.g. '?tag=rsid=rs123'. Each may be
+        repeated, and variants must then match all of them.
+
+        Relations are prefetched, so a page of variants and their nested
+        relation_set is two queries however many variants it holds.
         """
-        queryset = super(VariantViewSet, self).get_queryset(*args, **kwargs)
+        queryset = super(VariantViewSet, self).get_queryset(
+            *args, **kwargs).prefetch_related('relation_set')
+
+        regions = self.request.query_params.getlist('region')
+        if regions:
+            queryset = self._filter_regions(queryset, regions)
+        for key in self.request.query_params.getlist('has_tag'):
+            queryset = queryset.filter(tags__has_key=key)
+        for tag in self.request.query_params.getlist('tag'):
+            key, sep, value = tag.partition('=')
+            if not key or not sep:
+                raise rest_framework.serializers.ValidationError(detail={
+                    'detail': "The 'tag' parameter must be of the form "
+                    "'key=value', e.g. 'rsid=rs123'."})
+            queryset = filter_tag_value(queryset, key, value)
 
         variant_list_json = self.request.query_params.get('variant_list', None)
         if not variant_list_json:
             return queryset
         variant_list = json.loads(variant_list_json)
 
-        # Combine the variant list to make a single db query.
-        Q_obj = None
+        variant_ids = self._resolve_variant_lookups(variant_list).values()
+        return queryset.filter(id__in=variant_ids)
+
+    @list_route(methods=['post'], permission_classes=[AllowAny])
+    def lookup(self, request):
+        """
+        Return data for a list of variants POSTed as 'variant_list'.
+
+        Unlike the 'variant_list' GET parameter, this isn't limited by query
+        string length and handles up to BULK_LOOKUP_MAX variants. Results are
+        keyed by the requested variant ID, and IDs that don't match a variant
+        are listed in 'not_found'. Variant data is served from the API cache
+        where possible.
+
+        With 'as_of', variants are returned as they were at that time, and
+        variants that didn't exist yet are listed in 'not_found'.
+        """
+        variant_list = request.data.get('variant_list', None)
+        if (not isinstance(variant_list, list) or not
+                all(isinstance(v, basestring) for v in variant_list)):
+            raise rest_framework.serializers.ValidationError(detail={
+                'detail': "Bulk lookups must include 'variant_list', a list "
+                'of variant ID strings.'})
+        if len(variant_list) > BULK_LOOKUP_MAX:
+            raise rest_framework.serializers.ValidationError(detail={
+                'detail': 'Bulk lookups are limited to {} variants per '
+                'request.'.format(BULK_LOOKUP_MAX)})
+
+        # Build 37 IDs are cached, numeric IDs are checked in the database.
+        variant_ids = api_cache.get_variant_ids(
+            set(v for v in variant_list if not v.isdigit()))
+        cached_lookups = set(variant_ids)
+        unresolved = set(variant_list) - set(variant_ids)
+        if unresolved:
+            resolved = self._resolve_variant_lookups(list(unresolved))
+            api_cache.set_variant_ids({
+                v: variant_id for v, variant_id in resolved.items()
+                if not v.isdigit()})
+            variant_ids.update(resolved)
+
+        as_of = request.data.get('as_of', request.query_params.get('as_of'))
+        if as_of is not None:
+            variants = objects_as_of(Variant, set(variant_ids.values()),
+                                     parse_as_of(as_of))
+            serializer = self.get_serializer(variants.values(), many=True)
+            data_by_id = dict(zip(variants.keys(), serializer.data))
+            variant_ids = {v: pk for v, pk in variant_ids.items()
+                           if pk in data_by_id}
+        else:
+            base_url = request.build_absolute_uri('/')
+            found, generations = api_cache.get_entries(
+                Variant, set(variant_ids.values()), base_url)
+            data_by_id = {pk: entry['data'] for pk, entry in found.items()}
+            if generations:
+                # Not get_queryset, as this POST isn't filtered by the URL's
+                # query parameters.
+                variants = list(Variant.objects.prefetch_related(
+                    'relation_set').filter(id__in=generations.keys()))
+                self.load_current_versions(variants)
+                serializer = self.get_serializer(variants, many=True)
+                entries = {
+                    variant.pk: (data, self.get_versions([variant]))
+                    for variant, data in zip(variants, serializer.data)}
+                api_cache.set_entries(Variant, entries, generations,
+                                      base_url)
+                data_by_id.update(
+                    (pk, data) for pk, (data, _) in entries.items())
+            # Variants deleted since their b37 ID was cached aren't found.
+            api_cache.invalidate_variant_ids([
+                v for v in cached_lookups
+                if variant_ids[v] not in data_by_id])
+            variant_ids = {v: pk for v, pk in variant_ids.items()
+                           if pk in data_by_id}
+
+        results = {}
+        not_found = []
         for variant_lookup in variant_list:
-            if variant_lookup.isdigit():
-                filter_kwargs = {'id': variant_lookup}
-            else:
-                filter_kwargs = self._custom_variant_filter_kwargs(variant_lookup)
-            if filter_kwargs:
-                if not Q_obj:
-                    Q_obj = Q(**filter_kwargs)
-                else:
-                    Q_obj = Q_obj | Q(**filter_kwargs)
-        queryset = queryset.filter(Q_obj)
-        return queryset
+            if variant_lookup in variant_ids:
+                results[variant_lookup] = data_by_id[
+                    variant_ids[variant_lookup]]
+            elif variant_lookup not in not_found:
+                not_found.append(variant_lookup)
+        return Response({'results': results, 'not_found': not_found})
+
+    @list_route(methods=['patch', 'post'])
+    def bulk(self, request):
+        """
+        PATCH to edit many variants, or POST to create them (see bulk_create).
+        """
+        if request.method == 'POST':
+            return self.bulk_create(request)
+        return super(VariantViewSet, self).bulk(request)
+
+    def bulk_create(self, request):
+        """
+        Create many variants, POSTed as 'variants', in one revision.
+
+        'variants' is a list of objects with 'tags', each validated as for a
+        single POST. Variants that already exist are found with one query,
+        and the rest are inserted together. If a variant is repeated, the
+        first tags are used.
+
+        Returns 'results', the ID of the variant for each valid submission
+        (in order) and whether it was created, and 'errors' for the rest.
+        """
+        variants = request.data.get('variants', None)
+        if (not isinstance(variants, list) or not all(
+                isinstance(variant, dict) and 'tags' in variant
+                for variant in variants)):
+            raise rest_framework.serializers.ValidationError(detail={
+                'detail': "Bulk creates must include 'variants', a list of "
+                "objects with a 'tags' field."})
+        if len(variants) > BULK_EDIT_MAX:
+            raise rest_framework.serializers.ValidationError(detail={
+                'detail': 'Bulk creates are limited to {} variants per '
+                'request.'.format(BULK_EDIT_MAX)})
+
+        serializer = self.get_serializer()
+        submitted = []
+        tags_by_b37_id = OrderedDict()
+        errors = []
+        for index, variant in enumerate(variants):
+            try:
+                tags = serializer.fields['tags'].run_validation(
+                    variant['tags'])
+                b37_id = 'b37-{}-{}-{}-{}'.format(
+                    *serializer.validate_new_tags(tags))
+            except rest_framework.serializers.ValidationError as err:
+                errors.append(OrderedDict([
+                    ('index', index),
+                    ('detail', validation_error_detail(err))]))
+                continue
+            tags_by_b37_id.setdefault(b37_id, tags)
+            submitted.append(b37_id)
+
+        with transaction.atomic():
+            variant_ids = self._resolve_variant_lookups(tags_by_b37_id.keys())
+            new_variants = OrderedDict(
+                (b37_id, Variant(tags=tags)) for b37_id, tags in
+                tags_by_b37_id.items() if b37_id not in variant_ids)
+            for variant, pk in zip(new_variants.values(),
+                                   reserve_ids(Variant, len(new_variants))):
+                variant.pk = pk
+                variant.sync_b37_fields()
+            try:
+                with transaction.atomic():
+                    Variant.objects.bulk_create(new_variants.values())
+            except IntegrityError:
+                raise rest_framework.serializers.ValidationError(detail={
+                    'detail': 'Some of these variants were created by '
+                    'another request at the same time. Please resubmit.'})
+            if new_variants:
+                reversion.default_revision_manager.save_revision(
+                    new_variants.values(), user=request.user,
+                    comment=request.data.get('commit-comment', ''))
+
+        variant_ids.update((b37_id, variant.pk) for b37_id, variant in
+                           new_variants.items())
+        results = [OrderedDict([('b37_id', b37_id),
+                                ('id', variant_ids[b37_id]),
+                                ('created', b37_id in new_variants)])
+                   for b37_id in submitted]
+        return Response(
+            {'results': results, 'errors': errors},
+            status=(status.HTTP_201_CREATED if new_variants else
+                    status.HTTP_200_OK))
+
+    @list_route(methods=['get'])
+    def export(self, request):
+        """
+        Stream all variants, with their relations, as newline-delimited JSON.
+
+        May be restricted to a chromosome ('chrom', e.g. '1' or 'X') and to
+        variants with relations of a given type ('relation_type'). The export
+        is gzip compressed if the client accepts it.
+        """
+        chrom = request.query_params.get('chrom', None)
+        if chrom:
+            try:
+                chrom = int(map_chrom_to_index(chrom))
+            except ValueError as err:
+                raise rest_framework.serializers.ValidationError(detail={
+                    'detail': str(err)})
+        relation_type = request.query_params.get('relation_type', None)
+
+        content = export_lines(chrom=chrom or None,
+                               relation_type=relation_type or None)
+        gzipped = re_accepts_gzip.search(
+            request.META.get('HTTP_ACCEPT_ENCODING', ''))
+        if gzipped:
+            content = compress_sequence(content)
+        response = StreamingHttpResponse(
+            content, content_type='application/x-ndjson')
+        if gzipped:
+            response['Content-Encoding'] = 'gzip'
+        patch_vary_headers(response, ('Accept-Encoding',))
+        return response
+
+    def get_cache_pk(self, lookup):
+        """
+        Return the pk of a variant, whether looked up by pk or b37 ID.
+        """
+        if lookup.isdigit() or not self._custom_variant_filter_kwargs(lookup):
+            return super(VariantViewSet, self).get_cache_pk(lookup)
+        variant_ids = api_cache.get_variant_ids([lookup])
+        if lookup not in variant_ids:
+            variant_ids = self._resolve_variant_lookups([lookup])
+            api_cache.set_variant_ids(variant_ids)
+        return variant_ids.get(lookup)
 
     def get_object(self):
         """
@@ -143,20 +823,14 @@ class VariantViewSet(VariantLookupMixin,
         self.check_object_permissions(self.request, obj)
         return obj
 
-    @transaction.atomic()
-    @reversion.create_revision()
-    def create(self, request, *args, **kwargs):
-        commit_comment = request.data.get('commit-comment', '')
-        reversion.set_user(user=self.request.user)
-        reversion.set_comment(comment=commit_comment)
-        return super(VariantViewSet, self).create(request, *args, **kwargs)
-
 
 # http GET localhost:8000/api/relation/   # all relations
 # http GET localhost:8000/api/relation/2/ # relation with ID 2
 # http -a youruser:yourpass PATCH localhost:8000/api/relation/2/ \
 #  tags:='{"foo": "bar"}'                # set tags to '{"foo": "bar"}'
-class RelationViewSet(RevisionUpdateMixin,
+class RelationViewSet(CurrentVersionMapMixin,
+                      VersionHistoryMixin,
+                      RevisionUpdateMixin,
                       rest_framework.viewsets.ModelViewSet):
     """
     A viewset for Relations.
@@ -168,14 +842,28 @@ class RelationViewSet(RevisionUpdateMixin,
     required_scopes = ['commit-edit']
     queryset = Relation.objects.all()
     serializer_class = RelationSerializer
+    pagination_class = PageNumberOrCursorPagination
 
-    @transaction.atomic()
-    @reversion.create_revision()
-    def create(self, request, *args, **kwargs):
-        commit_comment = request.data.get('commit-comment', '')
-        reversion.set_user(user=self.request.user)
-        reversion.set_comment(comment=commit_comment)
-        return super(RelationViewSet, self).create(request, *args, **kwargs)
+    def get_queryset(self, *args, **kwargs):
+        """
+        Return all relations, or those containing the tags in 'tags'.
+
+        'tags' is a JSON object, e.g. '?tags={"type":"clinvar-rcva"}'. It may
+        be repeated, and relations must then contain all of them. This is a
+        jsonb containment (@>) query, using the GIN index in migration 0008.
+        """
+        queryset = super(RelationViewSet, self).get_queryset(*args, **kwargs)
+        for tags_json in self.request.query_params.getlist('tags'):
+            try:
+                tags = json.loads(tags_json)
+            except ValueError:
+                tags = None
+            if not isinstance(tags, dict):
+                raise rest_framework.serializers.ValidationError(detail={
+                    'detail': "The 'tags' parameter must be a JSON object, "
+                    'e.g. {"type": "clinvar-rcva"}.'})
+            queryset = queryset.filter(tags__contains=tags)
+        return queryset
 
     @transaction.atomic()
     @reversion.create_revision()
@@ -186,6 +874,7 @@ class RelationViewSet(RevisionUpdateMixin,
         reversion.set_comment(comment=commit_comment)
         reversion.add_meta(CommitDeletion)
 
+    @transaction.atomic()
     def destroy(self, request, *args, **kwargs):
         """
         Check version is the latest. If so: record CommitDeletion, then delete.
@@ -198,18 +887,79 @@ class RelationViewSet(RevisionUpdateMixin,
                     'being deleted.'
             })
         instance = self.get_object()
-        current_version = reversion.get_for_date(
-            instance, datetime.datetime.now()).id
+        current_version = current_version_id(instance)
         if not current_version == request.data['edited_version']:
             raise rest_framework.serializers.ValidationError(detail={
                 'detail':
                     'Edit conflict error! The current version for this object '
                     'does not match the reported version being deleted.',
                 'current_version': current_version,
-                'submitted_data': self.context['request'].data,
+                'submitted_data': request.data,
             })
         self.record_destroy(request, instance)
-        return super(RelationViewSet, self).destroy(request, *args, **kwargs)
+        self.perform_destroy(instance)
+        return Response(status=status.HTTP_204_NO_CONTENT)
+
+
+class ChangeFeedView(APIView):
+    """
+    List changes to Variants and Relations in revisions after 'since'.
+
+    Changes are in order and cursor paginated, for replicas to follow 'next'
+    links and apply them (see the sync_changes command). Revisions commit in
+    ID order (see lock_revision_commits in models.py), so a replica that has
+    read up to a revision won't later miss an earlier one. Each page is one
+    query, so reading the changes since a revision costs time proportional
+    to their number.
+    """
+    permission_classes = (AllowAny,)
+
+    def get(self, request):
+        since = request.query_params.get('since', '0')
+        if not since.isdigit():
+            raise rest_framework.serializers.ValidationError(detail={
+                'detail': "The 'since' parameter must be a revision ID."})
+        paginator = KeysetCursorPagination()
+        results = paginator.paginate_rows(
+            lambda position, limit: changes_since(
+                int(since), after=position, limit=limit),
+            request, ordering=('revision', 'version'))
+        return paginator.get_paginated_response(results)
+
+
+class RevisionEventsView(View):
+    """
+    Stream revision events to clients as server-sent events.
+
+    Each change is sent as a 'change' event right after its revision commits
+    (see events.py). Clients reconnecting with a Last-Event-ID header, or a
+    'last_event_id' parameter, first get the events they missed. If this
+    process already serves its maximum number of streams, the response is a
+    503, with a Retry-After header.
+    """
+
+    def get(self, request):
+        last_event_id = request.META.get(
+            'HTTP_LAST_EVENT_ID', request.GET.get('last_event_id'))
+        if last_event_id is not None:
+            if not last_event_id.isdigit():
+                return HttpResponseBadRequest(
+                    'The last event ID must be a revision ID.')
+            last_event_id = int(last_event_id)
+        subscriber = broker.subscribe()
+        if subscriber is None:
+            response = HttpResponse(
+                'Too many event streams; try again later.',
+                status=status.HTTP_503_SERVICE_UNAVAILABLE)
+            response['Retry-After'] = str(HEARTBEAT_SECONDS)
+            return response
+        response = StreamingHttpResponse(
+            event_stream(subscriber, last_event_id),
+            content_type='text/event-stream')
+        response['Cache-Control'] = 'no-cache'
+        # Stop proxies such as nginx buffering the stream.
+        response['X-Accel-Buffering'] = 'no'
+        return response
 
 
 class CurrentUserView(RetrieveAPIView):